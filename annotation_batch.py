@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Coalesced annotation broadcast for server.py.
+
+The doctor page emits one 'annotation' per pen segment (every mousemove).
+Instead of re-broadcasting each one, AnnotationBatcher collects them per
+key (the drawing client's sid) for BATCH_WINDOW_S and hands the whole batch
+to one emit. compact() first joins runs of connected pen segments into a
+single {"tool": "stroke", "points": [...]} item, so a batch of N segments
+usually goes out as one item with N+1 points.
+
+AnnotationLog is what late joiners get: the compacted items as broadcast,
+capped at MAX_STORED (oldest dropped), with each client's current pen stroke
+kept open and extended in place rather than stored segment by segment. Each
+item is also encoded to an annotation_codec record (simplified, whole
+pixels) once, when it is stored or the stroke ends; only packed() output
+(the AR glasses' ?format=packed) carries that lossy form.
+
+The window only pays off once it spans several input events: a 16 ms
+window still flushes almost every 60 Hz mousemove, so the default is 40 ms,
+which batches 2-3 events at 60 Hz and more on 120 Hz+ pointers, at the cost
+of up to 40 ms extra delay before remote viewers see the ink.
+
+Run this file directly for message counts and CPU time under a synthetic
+drawing workload, against emitting per segment.
+"""
+
+import threading
+import time
+from collections import deque
+
+import annotation_codec
+from service_log import get_logger
+
+# === CONFIG ===
+BATCH_WINDOW_S = 0.040
+MAX_BATCH = 512      # flush early if a client sends this many within a window
+MAX_STORED = 2000    # annotations kept for late joiners
+# ==============
+
+log = get_logger("annotations")
+
+
+def _continues(stroke, seg):
+    """Does pen segment `seg` start where `stroke` ends, in the same style?"""
+    last = stroke["points"][-1]
+    return (last["x"] == seg.get("startX") and last["y"] == seg.get("startY")
+            and stroke.get("color") == seg.get("color") and stroke.get("lineWidth") == seg.get("lineWidth"))
+
+
+def _is_segment(item):
+    return item.get("tool") == "pen" and {"startX", "startY", "endX", "endY"} <= item.keys()
+
+
+def _new_stroke(seg):
+    stroke = {"tool": "stroke",
+              "points": [{"x": seg["startX"], "y": seg["startY"]}, {"x": seg["endX"], "y": seg["endY"]}]}
+    for k in ("color", "lineWidth"):
+        if k in seg:
+            stroke[k] = seg[k]
+    return stroke
+
+
+def compact(items):
+    """Join consecutive connected pen segments into strokes; other items pass through."""
+    out = []
+    for item in items:
+        if _is_segment(item):
+            if out and out[-1].get("tool") == "stroke" and _continues(out[-1], item):
+                out[-1]["points"].append({"x": item["endX"], "y": item["endY"]})
+                continue
+            out.append(_new_stroke(item))
+        else:
+            out.append(item)
+    return out
+
+
+class AnnotationBatcher:
+    """
+    add(key, item) from any thread; emit(key, items) is called from the
+    batcher's thread at most once per key per window. Emits run under
+    emit_lock, and discard() also drops batches taken but not yet emitted.
+    """
+
+    def __init__(self, emit, window=BATCH_WINDOW_S, max_batch=MAX_BATCH):
+        self.emit = emit
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {}  # key -> (deadline, [items])
+        self.cond = threading.Condition()
+        self.emit_lock = threading.Lock()
+        self.taken = {}  # key -> [items]: due batches the thread is about to emit
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def add(self, key, item):
+        with self.cond:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = (time.monotonic() + self.window, [item])
+                self.cond.notify()
+            else:
+                entry[1].append(item)
+                if len(entry[1]) >= self.max_batch:
+                    self.pending[key] = (0.0, entry[1])
+                    self.cond.notify()
+
+    def discard(self, key=None, then=None):
+        """
+        Drop pending items (all keys by default), e.g. on clear, including a
+        batch already taken by the batcher thread but not yet emitted.
+        then() runs before any later batch can be emitted.
+        """
+        with self.emit_lock:
+            with self.cond:
+                if key is None:
+                    self.pending.clear()
+                    self.taken.clear()
+                else:
+                    self.pending.pop(key, None)
+                    self.taken.pop(key, None)
+            if then is not None:
+                then()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                now = time.monotonic()
+                due = [k for k, (deadline, _) in self.pending.items() if deadline <= now]
+                if not due:
+                    self.cond.wait(min(d for d, _ in self.pending.values()) - now)
+                    continue
+                self.taken = {k: self.pending.pop(k)[1] for k in due}
+            for key in due:
+                with self.emit_lock:
+                    with self.cond:
+                        items = self.taken.pop(key, None)
+                    if items is None:
+                        continue  # discarded while waiting for emit_lock
+                    self.batches += 1
+                    self.items += len(items)
+                    try:
+                        self.emit(key, items)
+                    except Exception as e:
+                        log.warning("batch emit failed: %s", e, extra={"key": "batch_emit", "sender": key})
+
+
+class AnnotationLog:
+    """
+    Capped, compacted annotation history for late joiners. Items are kept as
+    drawn, so late joiners get what live viewers got; the annotation_codec
+    record (simplified, whole pixels) is made once per item, for packed().
+    """
+
+    def __init__(self, max_stored=MAX_STORED):
+        self.entries = deque(maxlen=max_stored)  # (item, annotation_codec record)
+        self.open = {}  # key -> stroke still being drawn
+        self.lock = threading.Lock()
+
+    def add(self, key, items):
+        """Append compacted items drawn by `key`."""
+        with self.lock:
+            for item in items:
+                stroke = self.open.get(key)
+                if item.get("tool") == "stroke":
+                    if stroke is not None and _continues(stroke, {
+                            "startX": item["points"][0]["x"], "startY": item["points"][0]["y"],
+                            "color": item.get("color"), "lineWidth": item.get("lineWidth")}):
+                        stroke["points"].extend(item["points"][1:])
+                        continue
+                    self._close(key)
+                    self.open[key] = {**item, "points": list(item["points"])}
+                else:
+                    self._close(key)
+                    self.entries.append((item, annotation_codec.encode(item)))
+
+    def _close(self, key):
+        stroke = self.open.pop(key, None)
+        if stroke is not None:
+            self.entries.append((stroke, annotation_codec.encode(stroke)))
+
+    def end_strokes(self, key=None):
+        """Encode open strokes (all, or `key`'s when that client leaves)."""
+        with self.lock:
+            for k in ([key] if key is not None else list(self.open)):
+                self._close(k)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.open.clear()
+
+    def snapshot(self):
+        """(closed (item, record) entries, open strokes as dicts), oldest first."""
+        with self.lock:
+            return list(self.entries), [dict(s, points=list(s["points"])) for s in self.open.values()]
+
+    def annotations(self):
+        entries, strokes = self.snapshot()
+        return [item for item, _ in entries] + strokes
+
+    def packed(self):
+        entries, strokes = self.snapshot()
+        return annotation_codec.pack([record for _, record in entries] + [annotation_codec.encode(s) for s in strokes])
+
+    def __len__(self):
+        return len(self.entries) + len(self.open)
+
+
+def synthetic_scribble(seconds=1.0, rate_hz=60, seed=3):
+    """Pen segments as server.py's page emits them: one per mousemove."""
+    import math
+    import random
+
+    rng = random.Random(seed)
+    x, y = 320.0, 240.0
+    segments = []
+    for i in range(int(seconds * rate_hz)):
+        nx = min(max(x + 6 * math.cos(i / 7) + rng.gauss(0, 1), 0), 639)
+        ny = min(max(y + 6 * math.sin(i / 5) + rng.gauss(0, 1), 0), 479)
+        segments.append({"tool": "pen", "startX": x, "startY": y, "endX": nx, "endY": ny,
+                         "color": "#ff0000", "lineWidth": "3"})
+        x, y = nx, ny
+    return segments
+
+
+def _bench(viewers=20, seconds=1.0, repeats=3):
+    """Print the table; fail unless the default window cuts emits and CPU."""
+    import json
+    import socket
+
+    def run(segments, rate, window):
+        """Paced like real input; returns ((emits, viewer messages, bytes out), CPU s, stored)."""
+        pairs = [socket.socketpair() for _ in range(viewers)]
+        sent = [0, 0, 0]
+
+        def fan_out(event, data):
+            # one encode per emit, one socket write per viewer (as python-socketio does)
+            payload = json.dumps([event, data]).encode()
+            for ours, theirs in pairs:
+                ours.sendall(payload)
+                theirs.recv(1 << 16)
+            sent[0] += 1
+            sent[1] += viewers
+            sent[2] += len(payload) * viewers
+
+        if window is None:
+            stored = []
+
+            def handle(seg):
+                stored.append(seg)
+                fan_out("new_annotation", seg)
+        else:
+            stored = AnnotationLog()
+
+            def emit(key, items):
+                batch = compact(items)
+                stored.add(key, batch)
+                fan_out("annotation_batch", {"items": batch})
+
+            batcher = AnnotationBatcher(emit, window=window)
+
+            def handle(seg):
+                batcher.add("doctor", seg)
+
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for i, seg in enumerate(segments):
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            handle(seg)
+        if window is not None:
+            time.sleep(window * 3)
+            stored.end_strokes()
+        cpu = time.process_time() - cpu
+        for a, b in pairs:
+            a.close()
+            b.close()
+        return sent, cpu, stored
+
+    print(f"{seconds:.0f} s scribble, {viewers} viewers")
+    print(f"{'input':>8}{'window':>9}{'emits':>8}{'to viewers':>12}{'bytes out':>11}{'CPU ms':>9}  stored")
+    totals = {None: 0.0, BATCH_WINDOW_S: 0.0}  # best-of-`repeats` CPU, summed over rates
+    for rate in (60, 120, 240):
+        segments = synthetic_scribble(seconds, rate)
+        baseline = None
+        for window in (None, 0.016, BATCH_WINDOW_S, 0.1):
+            (emits, messages, nbytes), cpu, stored = run(segments, rate, window)
+            if window in totals:
+                # CPU time of a 1 s run is noisy; keep the best of a few
+                cpu = min([cpu] + [run(segments, rate, window)[1] for _ in range(repeats - 1)])
+                totals[window] += cpu
+            if window is None:
+                baseline = emits
+            elif window == BATCH_WINDOW_S:
+                assert emits * 2 <= baseline, f"{rate} Hz: {emits} emits vs {baseline} unbatched"
+            if window is None:
+                label, kept = "none", f"{len(stored)} segments, {len(json.dumps(stored))} B JSON"
+            else:
+                label, kept = f"{window * 1000:.0f}ms", f"{len(stored)} record(s), {len(stored.packed())} B"
+            print(f"{rate:>6}Hz{label:>9}{emits:>8}{messages:>12}{nbytes:>11}{cpu * 1000:>9.1f}  {kept}")
+    batched, unbatched = totals[BATCH_WINDOW_S], totals[None]
+    print(f"CPU at the {BATCH_WINDOW_S * 1000:.0f} ms default: {batched * 1000:.1f} ms vs {unbatched * 1000:.1f} ms unbatched")
+    assert batched < unbatched, "default window did not save CPU"
+
+
+if __name__ == "__main__":
+    _bench()
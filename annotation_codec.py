@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Compact binary form for drawing annotations.
+
+Freehand paths arrive as one {x, y} object per mousemove. encode() turns an
+annotation into a short record:
+
+  1. paths are simplified with Ramer-Douglas-Peucker, dropping points that
+     lie within PATH_TOLERANCE_PX of the segment between kept neighbours;
+  2. coordinates are rounded to whole pixels of the 640x480 frame/canvas
+     (the drawing canvases are frame-sized, so canvas px == frame px);
+  3. each coordinate is stored as the zigzag varint of its difference from
+     the previous one, so a stroke costs 1-2 bytes per point.
+
+Record layout (all integers are unsigned LEB128 varints):
+
+    kind | flags        1 byte: kind in the low nibble, flags in the high
+    id                  len + UTF-8           (flag ID)
+    timestamp           ms                    (flag TS)
+    color               3 bytes RGB           (flag COLOR)
+    lineWidth           px << 1 | is-string   (flag WIDTH; "3" and 3 both round-trip)
+    geometry            per kind, see KINDS
+
+Both annotation shapes in the repo are covered: doctor_ui.py's
+{"type": "path"|"circle"|"arrow", ...} and server.py's
+{"tool": "pen"|"stroke"|"arrow"|"circle"|"rectangle"|"text", ...}. Anything else
+(extra keys, non-string ids, fractional widths, ...) is stored as a JSON
+record, so decode() always gives back what was stored, up to simplification
+and rounding of coordinates.
+
+That loss is for the wire and for stores whose readers all go through the
+codec (doctor_data_server.py serves every client from its records, so live
+and late readers see the same strokes). server.py's AnnotationLog keeps the
+items as drawn and uses records only for packed output.
+
+pack()/unpack() frame a list of records: count, then length + record each.
+
+Run this file directly for a size/speed benchmark on synthetic strokes.
+"""
+
+import json
+
+# === CONFIG ===
+PATH_TOLERANCE_PX = 1.0
+# ==============
+
+F_ID, F_TS, F_COLOR, F_WIDTH = 0x10, 0x20, 0x40, 0x80
+KIND_JSON = 0x0F
+
+# kind -> (schema key, name, geometry fields). Field codes:
+#   ("pt", kx, ky)  point, delta-coded against the previous coordinate
+#   ("d", k)        signed length (zigzag), ("u", k) unsigned length
+#   ("pts", k)      list of {x, y}, simplified, delta-coded
+#   ("s", k)        UTF-8 string
+KINDS = {
+    0: ("type", "path", (("pts", "points"),)),
+    1: ("type", "circle", (("pt", "x", "y"), ("u", "radius"))),
+    2: ("type", "arrow", (("pt", "startX", "startY"), ("pt", "endX", "endY"))),
+    3: ("tool", "pen", (("pt", "startX", "startY"), ("pt", "endX", "endY"))),
+    4: ("tool", "arrow", (("pt", "startX", "startY"), ("pt", "endX", "endY"))),
+    5: ("tool", "circle", (("pt", "centerX", "centerY"), ("u", "radius"))),
+    6: ("tool", "rectangle", (("pt", "startX", "startY"), ("d", "width"), ("d", "height"))),
+    7: ("tool", "text", (("pt", "x", "y"), ("s", "text"))),
+    8: ("tool", "stroke", (("pts", "points"),)),  # pen segments joined by annotation_batch
+}
+_KIND_OF = {(key, name): kind for kind, (key, name, _) in KINDS.items()}
+_COMMON = {"id", "timestamp", "color", "lineWidth"}
+
+
+class CodecError(ValueError):
+    pass
+
+
+# --- varints ---------------------------------------------------------------
+
+def _put_uvarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _put_svarint(out, n):
+    _put_uvarint(out, n << 1 if n >= 0 else ((-n) << 1) - 1)
+
+
+def _get_uvarint(buf, pos):
+    n = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise CodecError("truncated varint")
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _get_svarint(buf, pos):
+    n, pos = _get_uvarint(buf, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+
+# --- geometry --------------------------------------------------------------
+
+def simplify(points, tolerance=PATH_TOLERANCE_PX):
+    """Ramer-Douglas-Peucker on [(x, y)]; iterative, keeps both ends."""
+    n = len(points)
+    if n < 3:
+        return list(points)
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    tol2 = tolerance * tolerance
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        x2, y2 = points[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm2 = dx * dx + dy * dy
+        worst, index = -1.0, -1
+        for i in range(first + 1, last):
+            px, py = points[i]
+            # distance to the segment, not the infinite line: strokes double back
+            t = ((px - x1) * dx + (py - y1) * dy) / norm2 if norm2 else 0.0
+            t = 0.0 if t < 0.0 else 1.0 if t > 1.0 else t
+            ex, ey = px - x1 - t * dx, py - y1 - t * dy
+            d2 = ex * ex + ey * ey
+            if d2 > worst:
+                worst, index = d2, i
+        if worst > tol2:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def _quantize_path(points, tolerance):
+    pts = [(float(p["x"]), float(p["y"])) for p in points]
+    out = []
+    for x, y in simplify(pts, tolerance):
+        q = (round(x), round(y))
+        if not out or out[-1] != q:
+            out.append(q)
+    return out
+
+
+# --- records ---------------------------------------------------------------
+
+def _json_record(ann):
+    return bytes([KIND_JSON]) + json.dumps(ann, separators=(",", ":")).encode()
+
+
+def _width_code(width):
+    """Whole-pixel lineWidth as px << 1 | is-string; None if it wouldn't decode back exactly."""
+    if isinstance(width, int) and not isinstance(width, bool) and width >= 0:
+        return width << 1
+    if isinstance(width, str) and width.isdigit() and str(int(width)) == width:
+        return int(width) << 1 | 1
+    return None
+
+
+def _encodable(ann):
+    if "type" in ann and "tool" not in ann:
+        kind = _KIND_OF.get(("type", ann["type"]))
+    elif "tool" in ann and "type" not in ann:
+        kind = _KIND_OF.get(("tool", ann["tool"]))
+    else:
+        return None
+    if kind is None:
+        return None
+    key, _, fields = KINDS[kind]
+    names = {key} | _COMMON | {k for f in fields for k in f[1:]}
+    if not names.issuperset(ann):
+        return None  # something we'd lose
+    if "id" in ann and not isinstance(ann["id"], str):
+        return None
+    ts = ann.get("timestamp")
+    if ts is not None and (not isinstance(ts, int) or isinstance(ts, bool) or ts < 0):
+        return None
+    color = ann.get("color")
+    if color is not None and not (isinstance(color, str) and len(color) == 7 and color[0] == "#"):
+        return None
+    width = ann.get("lineWidth")
+    if width is not None and _width_code(width) is None:
+        return None
+    return kind
+
+
+def encode(ann, tolerance=PATH_TOLERANCE_PX):
+    """One annotation dict -> record bytes."""
+    kind = _encodable(ann)
+    if kind is None:
+        return _json_record(ann)
+    _, _, fields = KINDS[kind]
+    out = bytearray(1)
+    flags = 0
+    try:
+        if "id" in ann:
+            flags |= F_ID
+            raw = ann["id"].encode()
+            _put_uvarint(out, len(raw))
+            out += raw
+        if "timestamp" in ann:
+            flags |= F_TS
+            _put_uvarint(out, ann["timestamp"])
+        if "color" in ann:
+            flags |= F_COLOR
+            out += bytes.fromhex(ann["color"][1:])
+        if "lineWidth" in ann:
+            flags |= F_WIDTH
+            _put_uvarint(out, _width_code(ann["lineWidth"]))
+
+        prev = [0, 0]
+        for field in fields:
+            code = field[0]
+            if code == "pt":
+                for axis, k in enumerate(field[1:]):
+                    v = round(float(ann[k]))
+                    _put_svarint(out, v - prev[axis])
+                    prev[axis] = v
+            elif code == "pts":
+                pts = _quantize_path(ann[field[1]], tolerance)
+                _put_uvarint(out, len(pts))
+                for x, y in pts:
+                    _put_svarint(out, x - prev[0])
+                    _put_svarint(out, y - prev[1])
+                    prev = [x, y]
+            elif code == "d":
+                _put_svarint(out, round(float(ann[field[1]])))
+            elif code == "u":
+                _put_uvarint(out, max(round(float(ann[field[1]])), 0))
+            elif code == "s":
+                raw = str(ann[field[1]]).encode()
+                _put_uvarint(out, len(raw))
+                out += raw
+    except (KeyError, TypeError, ValueError):
+        return _json_record(ann)  # missing or odd field: keep it verbatim
+    out[0] = kind | flags
+    return bytes(out)
+
+
+def decode(record):
+    """Record bytes -> annotation dict."""
+    if not record:
+        raise CodecError("empty record")
+    kind, flags = record[0] & 0x0F, record[0] & 0xF0
+    if kind == KIND_JSON:
+        return json.loads(record[1:])
+    if kind not in KINDS:
+        raise CodecError(f"unknown kind {kind}")
+    key, name, fields = KINDS[kind]
+    ann = {key: name}
+    pos = 1
+    if flags & F_ID:
+        n, pos = _get_uvarint(record, pos)
+        ann["id"] = bytes(record[pos:pos + n]).decode()
+        pos += n
+    if flags & F_TS:
+        ann["timestamp"], pos = _get_uvarint(record, pos)
+    if flags & F_COLOR:
+        ann["color"] = "#" + bytes(record[pos:pos + 3]).hex()
+        pos += 3
+    if flags & F_WIDTH:
+        code, pos = _get_uvarint(record, pos)
+        ann["lineWidth"] = str(code >> 1) if code & 1 else code >> 1
+
+    prev = [0, 0]
+    for field in fields:
+        code = field[0]
+        if code == "pt":
+            for axis, k in enumerate(field[1:]):
+                d, pos = _get_svarint(record, pos)
+                prev[axis] += d
+                ann[k] = prev[axis]
+        elif code == "pts":
+            n, pos = _get_uvarint(record, pos)
+            pts = []
+            for _ in range(n):
+                dx, pos = _get_svarint(record, pos)
+                dy, pos = _get_svarint(record, pos)
+                prev = [prev[0] + dx, prev[1] + dy]
+                pts.append({"x": prev[0], "y": prev[1]})
+            ann[field[1]] = pts
+        elif code == "d":
+            ann[field[1]], pos = _get_svarint(record, pos)
+        elif code == "u":
+            ann[field[1]], pos = _get_uvarint(record, pos)
+        elif code == "s":
+            n, pos = _get_uvarint(record, pos)
+            ann[field[1]] = bytes(record[pos:pos + n]).decode()
+            pos += n
+    if pos != len(record):
+        raise CodecError("trailing bytes in record")
+    return ann
+
+
+def pack(records):
+    """[record bytes] -> one blob: count, then (length, record) each."""
+    out = bytearray()
+    _put_uvarint(out, len(records))
+    for rec in records:
+        _put_uvarint(out, len(rec))
+        out += rec
+    return bytes(out)
+
+
+def unpack(blob):
+    """pack() output -> [record bytes]"""
+    count, pos = _get_uvarint(blob, 0)
+    records = []
+    for _ in range(count):
+        n, pos = _get_uvarint(blob, pos)
+        if pos + n > len(blob):
+            raise CodecError("truncated pack")
+        records.append(bytes(blob[pos:pos + n]))
+        pos += n
+    return records
+
+
+# --- benchmark -------------------------------------------------------------
+
+def synthetic_strokes(count=200, seed=7):
+    """
+    Freehand strokes shaped like doctor_ui.py mousemove captures: 60 Hz
+    samples along a smooth curve, sub-pixel client coordinates, hand jitter.
+    (Stand-in for recorded strokes; the repo ships none.)
+    """
+    import math
+    import random
+
+    rng = random.Random(seed)
+    strokes = []
+    for i in range(count):
+        x, y = rng.uniform(100, 540), rng.uniform(80, 400)
+        heading = rng.uniform(0, 2 * math.pi)
+        speed = rng.uniform(3, 12)  # px per sample
+        turn = rng.uniform(-0.08, 0.08)
+        points = []
+        for _ in range(rng.randint(20, 180)):
+            points.append({"x": round(x + rng.gauss(0, 0.35), 2), "y": round(y + rng.gauss(0, 0.35), 2)})
+            heading += turn + rng.gauss(0, 0.03)
+            x = min(max(x + speed * math.cos(heading), 0), 639)
+            y = min(max(y + speed * math.sin(heading), 0), 479)
+        strokes.append({"type": "path", "points": points, "timestamp": 1_700_000_000_000 + i * 750,
+                        "id": f"{rng.getrandbits(40):010x}"[:9]})
+    return strokes
+
+
+def _bench():
+    import time
+
+    strokes = synthetic_strokes()
+    raw_points = sum(len(s["points"]) for s in strokes)
+    json_bytes = sum(len(json.dumps(s)) for s in strokes)
+
+    t0 = time.perf_counter()
+    records = [encode(s) for s in strokes]
+    encode_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    decoded = [decode(r) for r in records]
+    decode_s = time.perf_counter() - t0
+
+    kept = sum(len(d["points"]) for d in decoded)
+    packed = len(pack(records))
+    print(f"{len(strokes)} strokes, {raw_points} points")
+    print(f"  JSON:    {json_bytes:8d} B ({json_bytes / raw_points:.1f} B/point)")
+    print(f"  packed:  {packed:8d} B ({packed / raw_points:.2f} B/input point), "
+          f"{kept} points kept at {PATH_TOLERANCE_PX}px tolerance ({json_bytes / packed:.0f}x smaller)")
+    print(f"  encode:  {encode_s / len(strokes) * 1e6:8.1f} us/stroke, decode {decode_s / len(strokes) * 1e6:.1f} us/stroke")
+
+    # every input point lies within tolerance (+ rounding) of the kept polyline
+    worst = 0.0
+    for s, d in zip(strokes, decoded):
+        kept_pts = [(p["x"], p["y"]) for p in d["points"]]
+        for p in s["points"]:
+            worst = max(worst, _distance_to_polyline((p["x"], p["y"]), kept_pts))
+    assert worst <= PATH_TOLERANCE_PX + 0.75, worst
+    print(f"  max deviation from input: {worst:.2f} px")
+
+    # the other shapes round-trip (up to pixel rounding)
+    for ann in ({"tool": "pen", "startX": 10.4, "startY": 20, "endX": 12, "endY": 19.6,
+                 "color": "#ff0000", "lineWidth": "3"},
+                {"tool": "rectangle", "startX": 100, "startY": 50, "width": -30, "height": 40,
+                 "color": "#00ff7f", "lineWidth": "5"},
+                {"tool": "text", "text": "incision here", "x": 300, "y": 200, "color": "#ffffff"},
+                {"type": "circle", "x": 320, "y": 240, "radius": 37.2, "timestamp": 1, "id": "abc"},
+                {"type": "arrow", "startX": 1, "startY": 2, "endX": 600, "endY": 470, "id": "z", "timestamp": 5},
+                {"type": "path", "points": [], "note": "extra key -> JSON record"}):
+        rec = encode(ann)
+        back = decode(rec)
+        assert set(back) == set(ann), (ann, back)
+        print(f"  {ann.get('type') or ann.get('tool'):>9}: JSON {len(json.dumps(ann)):3d} B -> {len(rec):3d} B")
+
+    # style fields come back exactly as sent, whatever their type
+    for width in ("3", 3, 2.5, "03", 0):
+        ann = {"tool": "pen", "startX": 0, "startY": 0, "endX": 1, "endY": 1, "lineWidth": width}
+        back = decode(encode(ann))["lineWidth"]
+        assert back == width and type(back) is type(width), (width, back)
+
+
+def _distance_to_polyline(p, pts):
+    import math
+
+    if len(pts) == 1:
+        return math.dist(p, pts[0])
+    best = float("inf")
+    for a, b in zip(pts, pts[1:]):
+        ax, ay = a
+        dx, dy = b[0] - ax, b[1] - ay
+        norm2 = dx * dx + dy * dy
+        t = 0.0 if not norm2 else max(0.0, min(1.0, ((p[0] - ax) * dx + (p[1] - ay) * dy) / norm2))
+        best = min(best, math.dist(p, (ax + t * dx, ay + t * dy)))
+    return best
+
+
+if __name__ == "__main__":
+    _bench()
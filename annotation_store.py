@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Per-session annotation store: O(1) upsert by id, time-ordered expiry, and
+a revisioned operation log for delta sync.
+
+Each session keeps a dict id -> annotation (insertion ordered, so an
+upsert moves the annotation to the end, like the old list rebuild did)
+and a min-heap of (timestamp, id) for expiry. Replacing an annotation
+leaves its old heap entry behind; expire() skips entries whose timestamp
+no longer matches the stored annotation. So a batch of k annotations
+costs O(k log n) instead of O(n*k), and expiry only touches what expired.
+
+Every change is also appended to the session's op log with a revision
+number from a store-wide counter (so revisions never repeat, even for a
+session that expired and came back):
+
+    {"rev": 17, "op": "add",    "id": "k3j9", "annotation": {...}}
+    {"rev": 18, "op": "update", "id": "k3j9", "annotation": {...}}
+    {"rev": 19, "op": "delete", "id": "k3j9"}          (also on expiry)
+    {"rev": 20, "op": "clear"}
+
+Clients pull changes_since(rev) and apply the ops; a rev older than the
+log reaches back gets None, meaning "fetch a snapshot". Re-sending an
+unchanged annotation is not a change and isn't logged, so traffic follows
+drawing activity rather than the number of annotations on screen.
+
+With a codec (annotation_codec), annotations are kept in its compact
+binary form: encoded once on upsert, decoded when served as JSON, and
+available as-is through records() for packed responses.
+
+Sessions have their own lock; the store lock is only held to find or
+create a session.
+
+Timestamps are the client's milliseconds (Date.now()), as doctor_ui.py
+sends them; an annotation without one expires at once, as before.
+
+Run this file directly for a benchmark against the list-rebuild store.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+# === CONFIG ===
+ANNOTATION_TTL_MS = 15000
+OPLOG_MAX = 10000  # ops kept per session for ?since_rev=; older revs get a snapshot
+# ==============
+
+
+class SessionAnnotations:
+    def __init__(self, ttl_ms=ANNOTATION_TTL_MS, revs=None, codec=None):
+        self.ttl_ms = ttl_ms
+        self.codec = codec
+        self.by_id = {}  # id -> (timestamp, annotation or encoded record)
+        self.expiry = []  # heap of (timestamp, id); may hold stale entries
+        self.lock = threading.Lock()
+        self.revs = revs or itertools.count(1)
+        self.rev = next(self.revs)
+        self.base_rev = self.rev  # the log holds every op after this
+        self.oplog = deque()
+
+    def _log(self, op, ann_id=None, ann=None):
+        self.rev = next(self.revs)
+        entry = {'rev': self.rev, 'op': op}
+        if op != 'clear':
+            entry['id'] = ann_id
+        if ann is not None:
+            entry['annotation'] = ann
+        if len(self.oplog) >= OPLOG_MAX:
+            self.base_rev = self.oplog.popleft()['rev']
+        self.oplog.append(entry)
+
+    def _decode(self, value):
+        return self.codec.decode(value) if self.codec else value
+
+    def _upsert(self, ann):
+        ann_id = ann.get('id')
+        ts = ann.get('timestamp', 0)
+        value = self.codec.encode(ann) if self.codec else ann
+        old = self.by_id.get(ann_id)
+        if old is not None and old[1] == value:
+            return  # re-sent unchanged
+        # pop first so a replacement moves to the end
+        self.by_id.pop(ann_id, None)
+        self.by_id[ann_id] = (ts, value)
+        heapq.heappush(self.expiry, (ts, _order_key(ann_id)))
+        self._log('add' if old is None else 'update', ann_id, value)
+
+    def upsert(self, annotations, now_ms=None):
+        """Add or replace annotations by id, then drop expired ones."""
+        with self.lock:
+            for ann in annotations:
+                self._upsert(ann)
+            self._expire(now_ms)
+            self._compact()
+            return self.rev
+
+    def apply(self, ops, now_ms=None):
+        """
+        Apply client ops: {"op": "add"|"update", "annotation": {...}},
+        {"op": "delete", "id": ...} or {"op": "clear"}. Returns the new rev.
+        """
+        for op in ops:
+            # check the whole batch first so a bad op doesn't leave half of it applied
+            if not isinstance(op, dict) or op.get('op') not in ('add', 'update', 'delete', 'clear') or (
+                    op['op'] in ('add', 'update') and not isinstance(op.get('annotation'), dict)):
+                raise ValueError(f"bad annotation op {op!r}")
+        with self.lock:
+            for op in ops:
+                kind = op['op']
+                if kind == 'delete':
+                    self._remove(op.get('id'))
+                elif kind == 'clear':
+                    self._clear()
+                else:
+                    self._upsert(op['annotation'])
+            self._expire(now_ms)
+            self._compact()
+            return self.rev
+
+    def _remove(self, ann_id):
+        if self.by_id.pop(ann_id, None) is None:
+            return False
+        self._log('delete', ann_id)
+        return True
+
+    def remove(self, ann_id):
+        with self.lock:
+            return self._remove(ann_id)
+
+    def _clear(self):
+        self.by_id.clear()
+        self.expiry.clear()
+        self._log('clear')
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def expire(self, now_ms=None):
+        with self.lock:
+            self._expire(now_ms)
+
+    def _expire(self, now_ms):
+        cutoff = (now_ms if now_ms is not None else time.time() * 1000) - self.ttl_ms
+        heap = self.expiry
+        while heap and heap[0][0] <= cutoff:
+            ts, key = heapq.heappop(heap)
+            ann_id = key[1]
+            entry = self.by_id.get(ann_id)
+            if entry is not None and entry[0] == ts:
+                del self.by_id[ann_id]
+                self._log('delete', ann_id)
+
+    def _compact(self):
+        # re-sent annotations pile up stale heap entries; rebuild when they dominate
+        if len(self.expiry) > 2 * len(self.by_id) + 64:
+            self.expiry = [(ts, _order_key(i)) for i, (ts, _) in self.by_id.items()]
+            heapq.heapify(self.expiry)
+
+    def items(self, now_ms=None):
+        """Live annotations, oldest upsert first."""
+        with self.lock:
+            self._expire(now_ms)
+            values = [v for _, v in self.by_id.values()]
+        return [self._decode(v) for v in values]
+
+    def records(self, now_ms=None):
+        """(rev, live annotations as stored: codec records, or dicts without a codec)"""
+        with self.lock:
+            self._expire(now_ms)
+            return self.rev, [v for _, v in self.by_id.values()]
+
+    def snapshot(self, now_ms=None):
+        """(rev, live annotations) taken together."""
+        rev, values = self.records(now_ms)
+        return rev, [self._decode(v) for v in values]
+
+    def changes_since(self, since_rev, now_ms=None):
+        """(rev, ops after since_rev), or (rev, None) if the log doesn't reach back that far."""
+        with self.lock:
+            self._expire(now_ms)
+            if since_rev < self.base_rev or since_rev > self.rev:
+                return self.rev, None
+            ops = []
+            # newest first until we reach what the client has: O(ops returned)
+            for entry in reversed(self.oplog):
+                if entry['rev'] <= since_rev:
+                    break
+                ops.append(entry)
+            ops.reverse()
+            rev = self.rev
+        if self.codec:
+            ops = [dict(e, annotation=self.codec.decode(e['annotation'])) if 'annotation' in e else e
+                   for e in ops]
+        return rev, ops
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+def _order_key(ann_id):
+    # ids can be None or mixed types; this keeps heap ties comparable
+    return (type(ann_id).__name__, ann_id if ann_id is not None else '')
+
+
+class AnnotationStore:
+    """session_id -> SessionAnnotations"""
+
+    def __init__(self, ttl_ms=ANNOTATION_TTL_MS, codec=None):
+        self.ttl_ms = ttl_ms
+        self.codec = codec
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.revs = itertools.count(1)  # shared: revisions are unique store-wide
+
+    def session(self, session_id, create=True):
+        s = self.sessions.get(session_id)
+        if s is None and create:
+            with self.lock:
+                s = self.sessions.get(session_id)
+                if s is None:
+                    s = self.sessions[session_id] = SessionAnnotations(self.ttl_ms, self.revs, self.codec)
+        return s
+
+    def upsert(self, session_id, annotations, now_ms=None):
+        return self.session(session_id).upsert(annotations, now_ms)
+
+    def apply(self, session_id, ops, now_ms=None):
+        return self.session(session_id).apply(ops, now_ms)
+
+    def get(self, session_id, now_ms=None):
+        s = self.session(session_id, create=False)
+        return s.items(now_ms) if s is not None else []
+
+    def snapshot(self, session_id, now_ms=None):
+        return self.session(session_id).snapshot(now_ms)
+
+    def records(self, session_id, now_ms=None):
+        return self.session(session_id).records(now_ms)
+
+    def changes_since(self, session_id, since_rev, now_ms=None):
+        return self.session(session_id).changes_since(since_rev, now_ms)
+
+    def expire(self, now_ms=None):
+        """Expire every session; forget sessions left empty."""
+        for session_id, s in list(self.sessions.items()):
+            s.expire(now_ms)
+            if not len(s):
+                with self.lock:
+                    if not len(s):
+                        self.sessions.pop(session_id, None)
+
+    def counts(self):
+        return {sid: len(s) for sid, s in list(self.sessions.items())}
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+
+def _legacy_add(store, annotations, now_ms):
+    """DoctorDataStore.add_annotations before this module (for the benchmark)."""
+    for new_ann in annotations:
+        store[:] = [ann for ann in store if ann.get('id') != new_ann.get('id')]
+        store.append(new_ann)
+    store[:] = [ann for ann in store if now_ms - ann.get('timestamp', 0) < ANNOTATION_TTL_MS]
+
+
+def _bench(n=10_000, batch=100, rounds=20):
+    now = time.time() * 1000
+    base = [{'id': f'a{i}', 'type': 'circle', 'x': i % 640, 'y': i % 480, 'radius': 5,
+             'timestamp': now - ANNOTATION_TTL_MS + 1000 + i * 0.1} for i in range(n)]
+    batches = [[dict(base[(r * batch + j * 97) % n], timestamp=now + r) for j in range(batch)]
+               for r in range(rounds)]
+
+    legacy = list(base)
+    t0 = time.perf_counter()
+    for b in batches:
+        _legacy_add(legacy, b, now)
+    legacy_s = time.perf_counter() - t0
+
+    store = AnnotationStore()
+    store.upsert('bench', base, now)
+    t0 = time.perf_counter()
+    for b in batches:
+        store.upsert('bench', b, now)
+    indexed_s = time.perf_counter() - t0
+
+    assert [a['id'] for a in store.get('bench', now)] == [a['id'] for a in legacy]
+
+    # expiry: everything not re-sent ages out
+    later = now + 1000 + n * 0.1 + 1
+    t0 = time.perf_counter()
+    store.expire(later)
+    expire_s = time.perf_counter() - t0
+    kept = len(store.get('bench', later))
+    legacy = [a for a in legacy if later - a.get('timestamp', 0) < ANNOTATION_TTL_MS]
+    assert kept == len(legacy), (kept, len(legacy))
+
+    # delta sync: one more stroke on a busy screen, full re-POST vs one op
+    import json
+    live = SessionAnnotations()
+    screen = [dict(a, timestamp=now) for a in base[:200]]
+    live.upsert(screen, now)
+    rev = live.rev
+    stroke = {'id': 'new', 'type': 'path', 'points': [{'x': i, 'y': i} for i in range(40)], 'timestamp': now}
+    full = len(json.dumps({'annotations': screen + [stroke]}))
+    t0 = time.perf_counter()
+    live.upsert(screen + [stroke], now)
+    full_us = (time.perf_counter() - t0) * 1e6
+    _, ops = live.changes_since(rev, now)
+    delta = len(json.dumps({'ops': [{'op': 'add', 'annotation': stroke}]}))
+    pulled = len(json.dumps({'rev': live.rev, 'ops': ops}))
+
+    print(f"{n} stored annotations, {rounds} batches of {batch} upserts")
+    print(f"  list rebuild: {legacy_s / rounds * 1000:8.2f} ms/batch")
+    print(f"  indexed:      {indexed_s / rounds * 1000:8.2f} ms/batch")
+    print(f"  expire {n - kept} of {n}: {expire_s * 1000:.2f} ms ({kept} left)")
+    print(f"one new stroke with 200 on screen: full re-POST {full} B ({full_us:.0f} us to merge), "
+          f"delta POST {delta} B, ?since_rev= pull {pulled} B ({len(ops)} op)")
+
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Audio codecs for the Pi microphone uplink, with matching decoders for the
+servers.
+
+    enc = make_encoder("adpcm", 48000)   # or "opus"; see make_encoder for fallback
+    payload = enc.encode(pcm)            # s16le mono in
+    dec = make_decoder(enc.codec_id, 48000)
+    pcm = dec.decode(payload)            # s16le mono out
+
+Codecs (the id goes on the wire in stream_protocol's flags, or in
+pi.py's JSON "audio_format"):
+
+  0  as sent   no codec; whatever the sender produced before codecs
+               (WAV from older pi.py, raw PCM from pi_streamer.py)
+  1  adpcm     IMA ADPCM, 4 bits/sample: 4x smaller than PCM at any rate.
+               Every chunk carries its own 4-byte header (first sample,
+               step index, odd-length flag), so a lost chunk never
+               desyncs the decoder. The encoder is a table-driven Python
+               loop (ADPCM is inherently sequential). The decoder is
+               NumPy-vectorized, with a plain loop only when a chunk clips.
+  2  opus      libopus via opuslib, if installed: 20 ms VOIP frames at
+               OPUS_BITRATE, about 30x smaller at 48 kHz. Each frame is
+               length-prefixed. Encoder and decoder keep state across
+               chunks (one decoder per upload).
+  3  pcm       raw s16le samples, no header: rate and channels are stream
+               parameters, sent once rather than wrapped around every chunk.
+
+Opus only takes 8/12/16/24/48 kHz. make_encoder falls back along
+ENCODER_FALLBACK ("opus" -> "adpcm") when a codec isn't usable, so a
+Pi without libopus or with a 44.1 kHz microphone still gets ADPCM. The
+same applies to codecs the server can't decode: servers list
+decodable_codecs() in their hello, and make_encoder(accepted=...) skips
+the rest.
+
+Run this file directly for encode/decode CPU per 100 ms chunk and the
+compression ratio of each available codec. Run it on the Pi for the
+numbers that matter.
+"""
+
+import struct
+from array import array
+
+# === CONFIG ===
+OPUS_BITRATE = 24000
+OPUS_FRAME_MS = 20
+ENCODER_FALLBACK = {"opus": "adpcm"}
+# ==============
+
+CODEC_NONE, CODEC_ADPCM, CODEC_OPUS, CODEC_PCM = 0, 1, 2, 3
+CODEC_IDS = {"adpcm": CODEC_ADPCM, "opus": CODEC_OPUS, "pcm": CODEC_PCM}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+# --- IMA ADPCM ---
+
+INDEX_TABLE = (-1, -1, -1, -1, 2, 4, 6, 8) * 2
+STEP_TABLE = (
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487,
+    12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794, 32767,
+)
+ADPCM_HEADER = struct.Struct("<hBB")  # first sample, step index, 1 if the last nibble is padding
+
+# magnitude of the reconstructed difference for each (step index, 3-bit code)
+_DIFF = [[(s >> 3) + (s if c & 4 else 0) + (s >> 1 if c & 2 else 0) + (s >> 2 if c & 1 else 0)
+          for c in range(8)] for s in STEP_TABLE]
+_NEXT_INDEX = [[min(max(i + INDEX_TABLE[c], 0), 88) for c in range(16)] for i in range(89)]
+
+
+class AdpcmEncoder:
+    codec_id = CODEC_ADPCM
+
+    def __init__(self, rate, channels=1):
+        if channels != 1:
+            raise ValueError("adpcm: mono only")
+        self.rate = rate
+        self.index = 0  # carried between chunks so each starts well adapted
+
+    def encode(self, pcm):
+        samples = array("h")
+        samples.frombytes(bytes(pcm))
+        if not samples:
+            return b""
+        pred = samples[0]
+        index = self.index
+        header = ADPCM_HEADER.pack(pred, index, (len(samples) - 1) % 2)
+        codes = bytearray()
+        append = codes.append
+        step_table, diff_table, next_index = STEP_TABLE, _DIFF, _NEXT_INDEX
+        for s in samples[1:]:
+            step = step_table[index]
+            diff = s - pred
+            code = 0
+            if diff < 0:
+                code = 8
+                diff = -diff
+            if diff >= step:
+                code |= 4
+                diff -= step
+            half = step >> 1
+            if diff >= half:
+                code |= 2
+                diff -= half
+            if diff >= step >> 2:
+                code |= 1
+            d = diff_table[index][code & 7]
+            pred = pred - d if code & 8 else pred + d
+            if pred > 32767:
+                pred = 32767
+            elif pred < -32768:
+                pred = -32768
+            index = next_index[index][code]
+            append(code)
+        self.index = index
+        if len(codes) % 2:
+            append(0)
+        # two codes per byte, first in the low nibble
+        packed = bytes(codes[0::2])
+        high = bytes(codes[1::2])
+        return header + bytes(a | (b << 4) for a, b in zip(packed, high))
+
+
+class AdpcmDecoder:
+    codec_id = CODEC_ADPCM
+
+    def __init__(self, rate, channels=1):
+        self.rate = rate
+
+    def decode(self, payload):
+        import numpy as np
+
+        if len(payload) < ADPCM_HEADER.size:
+            return b""
+        first, index0, pad = ADPCM_HEADER.unpack_from(payload)
+        packed = np.frombuffer(payload, np.uint8, offset=ADPCM_HEADER.size)
+        codes = np.empty(packed.size * 2, np.uint8)
+        codes[0::2] = packed & 0x0F
+        codes[1::2] = packed >> 4
+        if pad:
+            codes = codes[:-1]
+
+        # step index before each code: a running sum floored at 0 has a closed form
+        deltas = np.asarray(INDEX_TABLE, np.int32)[codes]
+        run = index0 + np.concatenate(([0], np.cumsum(deltas[:-1], dtype=np.int32)))
+        index = run - np.minimum(np.minimum.accumulate(run), 0)
+        if index.size and index.max() > 88:
+            return _adpcm_decode_loop(first, index0, codes)
+        steps = np.asarray(STEP_TABLE, np.int32)[index]
+        diff = (steps >> 3) + np.where(codes & 4, steps, 0) + np.where(codes & 2, steps >> 1, 0) \
+            + np.where(codes & 1, steps >> 2, 0)
+        diff = np.where(codes & 8, -diff, diff)
+        out = first + np.cumsum(diff, dtype=np.int32)
+        if out.size and (out.max() > 32767 or out.min() < -32768):
+            return _adpcm_decode_loop(first, index0, codes)  # clipped: the predictor saturates, go step by step
+        return np.concatenate(([first], out)).astype("<i2").tobytes()
+
+
+def _adpcm_decode_loop(first, index, codes):
+    out = array("h", [first])
+    pred = first
+    for code in codes.tolist():
+        d = _DIFF[index][code & 7]
+        pred = min(max(pred - d if code & 8 else pred + d, -32768), 32767)
+        index = _NEXT_INDEX[index][code]
+        out.append(pred)
+    return out.tobytes()
+
+
+# --- Opus ---
+
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+OPUS_LEN = struct.Struct("<H")
+
+
+class OpusEncoder:
+    codec_id = CODEC_OPUS
+
+    def __init__(self, rate, channels=1):
+        import opuslib
+
+        if rate not in OPUS_RATES:
+            raise ValueError(f"opus: unsupported rate {rate}")
+        self.rate = rate
+        self.channels = channels
+        self.frame = rate * OPUS_FRAME_MS // 1000
+        self.enc = opuslib.Encoder(rate, channels, opuslib.APPLICATION_VOIP)
+        self.enc.bitrate = OPUS_BITRATE
+        self.pending = b""  # samples short of a whole frame, carried to the next chunk
+
+    def encode(self, pcm):
+        buf = self.pending + bytes(pcm)
+        frame_bytes = self.frame * 2 * self.channels
+        out = []
+        end = len(buf) - len(buf) % frame_bytes
+        for off in range(0, end, frame_bytes):
+            packet = self.enc.encode(buf[off:off + frame_bytes], self.frame)
+            out.append(OPUS_LEN.pack(len(packet)))
+            out.append(packet)
+        self.pending = buf[end:]
+        return b"".join(out)
+
+
+class OpusDecoder:
+    codec_id = CODEC_OPUS
+
+    def __init__(self, rate, channels=1):
+        import opuslib
+
+        self.rate = rate
+        self.frame = rate * OPUS_FRAME_MS // 1000
+        self.dec = opuslib.Decoder(rate, channels)
+
+    def decode(self, payload):
+        out = []
+        off = 0
+        while off + OPUS_LEN.size <= len(payload):
+            (n,) = OPUS_LEN.unpack_from(payload, off)
+            off += OPUS_LEN.size
+            out.append(self.dec.decode(bytes(payload[off:off + n]), self.frame))
+            off += n
+        return b"".join(out)
+
+
+# --- raw PCM ---
+
+class PcmEncoder:
+    codec_id = CODEC_PCM
+
+    def __init__(self, rate, channels=1):
+        self.rate = rate
+
+    def encode(self, pcm):
+        return bytes(pcm)
+
+
+class PassthroughDecoder:
+    codec_id = CODEC_NONE
+
+    def __init__(self, rate, channels=1):
+        self.rate = rate
+
+    def decode(self, payload):
+        return payload
+
+
+_ENCODERS = {"adpcm": AdpcmEncoder, "opus": OpusEncoder, "pcm": PcmEncoder}
+_DECODERS = {CODEC_NONE: PassthroughDecoder, CODEC_ADPCM: AdpcmDecoder, CODEC_OPUS: OpusDecoder,
+             CODEC_PCM: PassthroughDecoder}
+
+
+def make_encoder(name, rate, channels=1, accepted=None):
+    """
+    Encoder for codec `name`, falling back along ENCODER_FALLBACK when it
+    can't be used here (library missing, unsupported rate) or isn't among
+    the codec names `accepted` by the receiver. None for no codec.
+    """
+    if name and name not in _ENCODERS:
+        raise ValueError(f"unknown audio codec {name!r}")
+    while name:
+        if accepted is None or name in accepted:
+            try:
+                return _ENCODERS[name](rate, channels)
+            except (ImportError, OSError, ValueError):
+                pass
+        name = ENCODER_FALLBACK.get(name)
+    return None
+
+
+def make_decoder(codec, rate, channels=1):
+    """Decoder for a codec id or name. Raises ValueError if unknown, ImportError if unavailable."""
+    codec_id = CODEC_IDS.get(codec, codec)
+    if codec_id not in _DECODERS:
+        raise ValueError(f"unknown audio codec {codec!r}")
+    return _DECODERS[codec_id](rate, channels)
+
+
+def decodable_codecs():
+    """Names of the codecs this install can decode (opus only with opuslib), for a server's hello."""
+    names = []
+    for name, codec_id in CODEC_IDS.items():
+        try:
+            make_decoder(codec_id, 48000)
+        except (ImportError, OSError):
+            continue
+        names.append(name)
+    return names
+
+
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")  # the 44-byte header older pi.py put on every chunk
+
+
+def strip_wav(payload, rate=0):
+    """(s16le samples, rate) from a WAV chunk; anything else is taken as raw samples at `rate`."""
+    if len(payload) >= WAV_HEADER.size and bytes(payload[:4]) == b"RIFF":
+        rate = WAV_HEADER.unpack_from(payload)[7]
+        return memoryview(payload)[WAV_HEADER.size:], rate
+    return payload, rate
+
+
+def _speech_like(rate, seconds):
+    """Deterministic voiced-speech-ish test signal: harmonics with a wandering pitch, syllable envelope, noise."""
+    import math
+    import random
+
+    rng = random.Random(5)
+    out = array("h")
+    phase = 0.0
+    for i in range(int(rate * seconds)):
+        t = i / rate
+        f0 = 140 + 30 * math.sin(2 * math.pi * 0.7 * t)
+        phase += 2 * math.pi * f0 / rate
+        env = max(math.sin(2 * math.pi * 3 * t), 0) ** 0.5
+        v = sum(math.sin(k * phase) / k for k in range(1, 8))
+        out.append(int(max(min(7000 * env * v + rng.gauss(0, 200), 32767), -32768)))
+    return out.tobytes()
+
+
+def _bench(rate=48000, chunk_s=0.1, seconds=2.0):
+    import time
+
+    pcm = _speech_like(rate, seconds)
+    chunk = int(rate * chunk_s) * 2
+    chunks = [pcm[i:i + chunk] for i in range(0, len(pcm), chunk)]
+    print(f"{rate} Hz mono, {len(chunks)} chunks of {chunk_s * 1000:.0f} ms; PCM is {rate * 16 / 1000:.0f} kbit/s")
+    print(f"{'codec':>8}{'kbit/s':>9}{'ratio':>8}{'encode ms/chunk':>17}{'decode ms/chunk':>17}{'SNR dB':>8}")
+    for name in ("adpcm", "opus"):
+        enc = make_encoder(name, rate)
+        if enc is None or CODEC_NAMES[enc.codec_id] != name:
+            print(f"{name:>8}  not available here (pip install opuslib + libopus)")
+            continue
+        dec = make_decoder(enc.codec_id, rate)
+        t0 = time.process_time()
+        payloads = [enc.encode(c) for c in chunks]
+        enc_ms = (time.process_time() - t0) / len(chunks) * 1000
+        t0 = time.process_time()
+        decoded = b"".join(dec.decode(p) for p in payloads)
+        dec_ms = (time.process_time() - t0) / len(chunks) * 1000
+        size = sum(len(p) for p in payloads)
+        snr = _snr(pcm, decoded) if name == "adpcm" else float("nan")  # opus has codec delay
+        print(f"{name:>8}{size * 8 / seconds / 1000:>9.1f}{len(pcm) / size:>7.1f}x{enc_ms:>17.2f}{dec_ms:>17.2f}"
+              f"{snr:>8.1f}")
+
+
+def _snr(ref, got):
+    import math
+
+    a, b = array("h"), array("h")
+    a.frombytes(ref)
+    b.frombytes(got[:len(ref)])
+    signal = sum(x * x for x in a)
+    noise = sum((x - y) ** 2 for x, y in zip(a, b)) or 1
+    return 10 * math.log10(signal / noise)
+
+
+def _selftest():
+    import random
+
+    rng = random.Random(1)
+    enc, dec = AdpcmEncoder(16000), AdpcmDecoder(16000)
+    for n in (0, 1, 2, 3, 1601):
+        pcm = array("h", (rng.randint(-2000, 2000) for _ in range(n))).tobytes()
+        assert len(dec.decode(enc.encode(pcm))) == len(pcm)
+    # vectorized decode == reference loop, also on a clipping chunk and in silence
+    loud = array("h", (32767 if (i // 7) % 2 else -32768 for i in range(999))).tobytes()
+    for pcm in (_speech_like(16000, 0.2), loud, bytes(2000)):
+        payload = enc.encode(pcm)
+        first, index, pad = ADPCM_HEADER.unpack_from(payload)
+        import numpy as np
+        p = np.frombuffer(payload, np.uint8, offset=ADPCM_HEADER.size)
+        codes = np.empty(p.size * 2, np.uint8)
+        codes[0::2], codes[1::2] = p & 15, p >> 4
+        assert dec.decode(payload) == _adpcm_decode_loop(first, index, codes[:len(codes) - pad])
+    assert _snr(_speech_like(16000, 0.5), dec.decode(enc.encode(_speech_like(16000, 0.5)))) > 20
+    assert make_encoder(None, 48000) is None
+    assert make_encoder("opus", 44100).codec_id == CODEC_ADPCM  # no opus at 44.1 kHz (or no opuslib)
+    pcm = _speech_like(16000, 0.1)
+    wav = WAV_HEADER.pack(b"RIFF", 36 + len(pcm), b"WAVE", b"fmt ", 16, 1, 1, 16000, 32000, 2, 16, b"data", len(pcm))
+    assert strip_wav(wav + pcm) == (pcm, 16000) and strip_wav(pcm, 8000) == (pcm, 8000)
+    print("self-test ok")
+
+
+if __name__ == "__main__":
+    _selftest()
+    _bench()
+    _bench(rate=16000)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Server-side audio engine: every incoming stream resampled to one output
+rate, and all parties mixed into one stream.
+
+pi_streamer.py sends whatever rate pick_audio_rate() found (8-48 kHz),
+pi.py sends 48 kHz, and doctor pages send their AudioContext rate.
+Resampler converts one stream to OUTPUT_RATE with a polyphase windowed-sinc
+filter. It is rational: 44.1 -> 48 kHz is up 160 / down 147, and only the
+taps that land on real samples are computed. State carries across chunks,
+so chunk boundaries don't click. Mixer keeps one Resampler and a bounded
+queue per party (medic Pi, doctor page, ...) and sums them into blocks.
+MixBlock.without(key) is the mix-minus that party hears: everyone but
+themselves.
+
+Everything works on whole chunks as NumPy arrays: a strided window view of
+the chunk times the filter phases (one matrix product for integer ratios),
+with no Python loop per sample.
+
+    mixer = Mixer()
+    mixer.push("pi-1", pcm_s16le, 16000)
+    mixer.push("doctor", pcm_s16le, 44100)
+    block = mixer.mix()        # None until every talking party has a whole MIX_BLOCK_S queued
+    block.samples              # float32 at OUTPUT_RATE, clipped to [-1, 1]
+    block.without("doctor")    # what the doctor hears
+
+Run this file directly for a self-test and throughput in samples/s
+(resampling per input rate, and mixing 2-8 parties), against linear
+interpolation and a plain Python loop.
+"""
+
+import threading
+import time
+from math import gcd
+
+import numpy as np
+
+# === CONFIG ===
+OUTPUT_RATE = 48000
+TAPS_PER_PHASE = 32    # filter length per output sample (more: sharper cutoff, more CPU)
+CUTOFF = 0.9           # of the lower Nyquist frequency
+KAISER_BETA = 8.0      # ~80 dB stopband
+MIX_BLOCK_S = 0.02     # mix() hands out whole multiples of this
+MAX_QUEUE_S = 0.5      # per party; a party this far ahead of the mix loses its oldest audio
+MIX_STALL_S = 0.25     # a party with no push for this long stops holding the mix back
+# ==============
+
+
+def int16_to_float32(pcm):
+    """s16le bytes (or an int16 array) as float32 in [-1, 1)."""
+    x = np.frombuffer(pcm, "<i2", len(pcm) // 2) if not isinstance(pcm, np.ndarray) else pcm
+    out = x.astype(np.float32)
+    out *= 1 / 32768
+    return out
+
+
+def float32_to_int16(samples):
+    """float32 samples as s16le bytes, clipped."""
+    return np.clip(samples * 32768, -32768, 32767).astype("<i2").tobytes()
+
+
+class Resampler:
+    """One mono stream from in_rate to out_rate, chunk by chunk."""
+
+    def __init__(self, in_rate, out_rate=OUTPUT_RATE, taps=TAPS_PER_PHASE):
+        g = gcd(in_rate, out_rate)
+        self.in_rate, self.out_rate = in_rate, out_rate
+        self.up, self.down = out_rate // g, in_rate // g
+        if self.up == self.down:
+            return
+        # downsampling needs proportionally more input per output to reach the lower cutoff
+        taps *= max(1, -(-self.down // self.up))
+        length = taps * self.up
+        fc = 0.5 / max(self.up, self.down) * CUTOFF  # cycles per sample of the up-sampled signal
+        h = 2 * fc * np.sinc(2 * fc * (np.arange(length) - (length - 1) / 2)) * np.kaiser(length, KAISER_BETA)
+        h *= self.up / h.sum()  # each phase sums to ~1: unity gain
+        # phases[p] holds the taps output phase p applies to x[n - taps + 1] .. x[n]
+        self.phases = np.ascontiguousarray(h.reshape(taps, self.up).T[:, ::-1], dtype=np.float32)
+        self.taps = taps
+        self.history = np.zeros(taps - 1, np.float32)
+        self.pos = (taps - 1) * self.up  # next output, in up-sampled samples from the start of history
+
+    def process(self, samples):
+        """float32 samples at in_rate in, float32 at out_rate out."""
+        samples = np.asarray(samples, np.float32)
+        if self.up == self.down:
+            return samples
+        buf = np.concatenate((self.history, samples))
+        up, down, taps = self.up, self.down, self.taps
+        n_out = max(0, -(-(len(buf) * up - self.pos) // down))
+        windows = np.lib.stride_tricks.sliding_window_view(buf, taps)  # windows[i] = buf[i:i + taps], no copy
+        first, phase = divmod(self.pos, up)
+        first -= taps - 1
+        if down == 1:
+            # integer upsampling: every phase of every input sample, one matrix product
+            last = first + (phase + n_out - 1) // up + 1
+            out = (windows[first:last] @ self.phases.T).ravel()[phase:phase + n_out]
+        elif up == 1:
+            # integer downsampling: every down-th window through the one phase
+            out = windows[first::down][:n_out] @ self.phases[0]
+        else:
+            n, p = np.divmod(self.pos + np.arange(n_out) * down, up)
+            out = np.einsum("mk,mk->m", windows[n - (taps - 1)], self.phases[p])
+        self.pos += n_out * down - len(samples) * up
+        self.history = buf[len(samples):].copy()
+        return out
+
+
+class MixBlock:
+    """One mixed stretch of output: the sum, and each party's share of it."""
+
+    __slots__ = ("mixed", "parts")
+
+    def __init__(self, mixed, parts):
+        self.mixed = mixed  # float32 sum, not yet clipped
+        self.parts = parts  # key -> float32 (may be shorter than mixed: that party ran out)
+
+    def __len__(self):
+        return len(self.mixed)
+
+    @property
+    def samples(self):
+        return np.clip(self.mixed, -1, 1)
+
+    def without(self, key):
+        """The mix minus `key`'s own audio (what that party should hear)."""
+        part = self.parts.get(key)
+        if part is None:
+            return self.samples
+        out = self.mixed.copy()
+        out[:len(part)] -= part
+        return np.clip(out, -1, 1, out=out)
+
+
+class _Party:
+    def __init__(self, rate, out_rate, capacity):
+        self.resampler = Resampler(rate, out_rate)
+        self.buf = np.empty(capacity, np.float32)
+        self.fill = 0
+        self.last_push = 0.0
+
+    def append(self, samples):
+        """Queue resampled samples; returns how many old ones were dropped to fit."""
+        cap = len(self.buf)
+        dropped = max(self.fill + len(samples) - cap, 0)
+        if len(samples) >= cap:
+            samples = samples[-cap:]
+            self.fill = 0
+        elif dropped:
+            self.buf[:self.fill - dropped] = self.buf[dropped:self.fill]
+            self.fill -= dropped
+        self.buf[self.fill:self.fill + len(samples)] = samples
+        self.fill += len(samples)
+        return dropped
+
+    def take(self, n):
+        out = self.buf[:n].copy()
+        self.buf[:self.fill - n] = self.buf[n:self.fill]
+        self.fill -= n
+        return out
+
+
+class Mixer:
+    """
+    push() chunks from any number of parties from any thread; mix() sums
+    the whole blocks every talking party has queued, sample for sample.
+    A party that hasn't pushed for stall_s no longer holds the others back:
+    it contributes what it has left (then silence) until it talks again.
+    """
+
+    def __init__(self, out_rate=OUTPUT_RATE, block_s=MIX_BLOCK_S, max_queue_s=MAX_QUEUE_S,
+                 stall_s=MIX_STALL_S, clock=time.monotonic):
+        self.out_rate = out_rate
+        self.block = int(out_rate * block_s)
+        self.capacity = int(out_rate * max_queue_s)
+        self.stall_s = stall_s
+        self.clock = clock
+        self.parties = {}  # key -> _Party
+        self.lock = threading.Lock()
+        self.dropped = 0  # output-rate samples lost to full party queues
+
+    def push(self, key, pcm, rate):
+        """Queue a chunk from `key`: s16le bytes or float32 samples at `rate`."""
+        samples = pcm if isinstance(pcm, np.ndarray) and pcm.dtype == np.float32 else int16_to_float32(pcm)
+        with self.lock:
+            party = self.parties.get(key)
+            if party is None or party.resampler.in_rate != rate:
+                party = self.parties[key] = _Party(rate, self.out_rate, self.capacity)
+            party.last_push = self.clock()
+            self.dropped += party.append(party.resampler.process(samples))
+
+    def remove(self, key):
+        with self.lock:
+            self.parties.pop(key, None)
+
+    def mix(self):
+        """A MixBlock of the whole blocks every talking party has queued, or None."""
+        with self.lock:
+            now = self.clock()
+            talking = [p.fill for p in self.parties.values() if now - p.last_push < self.stall_s]
+            if talking:
+                n = min(talking)
+            else:
+                n = max((p.fill for p in self.parties.values()), default=0)  # everyone stalled: flush
+            n = n // self.block * self.block
+            if not n:
+                return None
+            mixed = np.zeros(n, np.float32)
+            parts = {}
+            for key, party in self.parties.items():
+                k = min(party.fill, n)
+                if k:
+                    parts[key] = part = party.take(k)
+                    mixed[:k] += part
+        return MixBlock(mixed, parts)
+
+    def __len__(self):
+        return len(self.parties)
+
+
+# --- self-test / benchmark ---
+
+def _tone(freq, rate, seconds, amp=0.5):
+    return (amp * np.sin(2 * np.pi * freq * np.arange(int(rate * seconds)) / rate)).astype(np.float32)
+
+
+def _chunked(resampler, x, chunk):
+    return np.concatenate([resampler.process(x[i:i + chunk]) for i in range(0, len(x), chunk)])
+
+
+def _rms(x):
+    return float(np.sqrt(np.mean(np.square(x, dtype=np.float64))))
+
+
+def _selftest():
+    # streaming == one shot, and lengths follow the rate ratio
+    for rate in (8000, 16000, 22050, 44100, 48000):
+        x = _tone(440, rate, 1.0)
+        whole = Resampler(rate).process(x)
+        parts = _chunked(Resampler(rate), x, 997)
+        assert abs(len(whole) - OUTPUT_RATE) <= 1 and len(parts) == len(whole), (rate, len(whole), len(parts))
+        assert np.allclose(whole, parts, atol=1e-5), rate
+        # passband tone keeps its level (skip the filter's start-up)
+        assert abs(_rms(whole[OUTPUT_RATE // 10:]) - _rms(x)) < 0.01 * _rms(x), (rate, _rms(whole), _rms(x))
+    # downsampling removes what the lower rate can't carry
+    alias = Resampler(48000, 16000).process(_tone(12000, 48000, 1.0))
+    assert np.allclose(alias, _chunked(Resampler(48000, 16000), _tone(12000, 48000, 1.0), 1001), atol=1e-5)
+    assert _rms(alias[1600:]) < 0.01 * 0.5 / np.sqrt(2), _rms(alias[1600:])
+    assert np.array_equal(Resampler(48000).process(_tone(1000, 48000, 0.1)), _tone(1000, 48000, 0.1))
+
+    # mixing: parties at different rates, mix-minus, no loss while the queues keep up
+    mixer = Mixer()
+    medic, doctor = _tone(300, 16000, 1.0, 0.3), _tone(700, 44100, 1.0, 0.3)
+    out = []
+    for i in range(10):
+        mixer.push("medic", (medic[i * 1600:(i + 1) * 1600] * 32768).astype("<i2").tobytes(), 16000)
+        mixer.push("doctor", doctor[i * 4410:(i + 1) * 4410], 44100)
+        block = mixer.mix()
+        if block is not None:
+            out.append(block)
+            assert np.allclose(block.without("doctor")[:len(block.parts["medic"])], block.parts["medic"], atol=1e-6)
+    total = sum(len(b) for b in out)
+    assert OUTPUT_RATE - mixer.block <= total <= OUTPUT_RATE and mixer.dropped == 0, total
+    assert abs(float(np.max(np.concatenate([b.samples for b in out]))) - 0.6) < 0.02
+    # parties pushing in turn are summed, not played one after the other
+    mixer = Mixer()
+    medic, doctor = _tone(300, 16000, 5.0, 0.3), _tone(700, 48000, 5.0, 0.3)
+    out = []
+    for i in range(50):
+        for key, x, rate in (("medic", medic, 16000), ("doctor", doctor, 48000)):
+            mixer.push(key, x[i * rate // 10:(i + 1) * rate // 10], rate)
+            block = mixer.mix()
+            if block is not None:
+                out.append(block)
+    total = sum(len(b) for b in out)
+    assert 4.8 * OUTPUT_RATE <= total <= 5 * OUTPUT_RATE, total / OUTPUT_RATE
+    # (the first block is from before the doctor joined)
+    assert all(len(b.parts) == 2 and all(len(p) == len(b) for p in b.parts.values()) for b in out[1:])
+    assert all(np.allclose(b.mixed, b.parts["medic"] + b.parts["doctor"]) for b in out[1:])
+    # a stalled party stops holding the mix back after stall_s
+    now = [0.0]
+    stall = Mixer(clock=lambda: now[0])
+    stall.push("medic", _tone(300, 48000, 0.1), 48000)
+    stall.push("doctor", _tone(700, 48000, 0.04), 48000)
+    assert len(stall.mix()) == 1920 and stall.mix() is None  # doctor's 40 ms, then wait for doctor
+    now[0] = MIX_STALL_S + 0.01
+    stall.push("medic", _tone(300, 48000, 0.1), 48000)
+    block = stall.mix()
+    assert len(block) == 9600 - 1920 and "doctor" not in block.parts
+    # one party only: the mix is that party's audio
+    solo = Mixer()
+    solo.push("pi", _tone(440, 48000, 0.1), 48000)
+    assert np.array_equal(solo.mix().samples, _tone(440, 48000, 0.1))
+    # a party far ahead loses its oldest audio, not the newest
+    fast = Mixer(max_queue_s=0.1)
+    fast.push("pi", np.arange(9600, dtype=np.float32) / 9600, 48000)
+    assert fast.dropped == 4800 and fast.mix().samples[0] == 0.5
+    print("self-test ok")
+
+
+def _python_loop_resample(x, in_rate, out_rate):
+    """Linear interpolation one sample at a time, the way it looks without NumPy."""
+    step = in_rate / out_rate
+    out = []
+    for m in range(int(len(x) / step)):
+        t = m * step
+        i = int(t)
+        f = t - i
+        out.append(x[i] * (1 - f) + x[min(i + 1, len(x) - 1)] * f)
+    return out
+
+
+def _bench(seconds=10.0, chunk_s=0.1):
+    import time
+
+    print(f"resample to {OUTPUT_RATE} Hz, {chunk_s * 1000:.0f} ms chunks, {TAPS_PER_PHASE} taps/phase")
+    print(f"{'input':>8}{'up/down':>10}{'Msamples/s in':>15}{'x realtime':>12}"
+          f"{'np.interp Ms/s':>16}{'py loop Ms/s':>14}")
+    for rate in (8000, 16000, 22050, 44100, 48000):
+        x = _tone(440, rate, seconds)
+        chunks = [x[i:i + int(rate * chunk_s)] for i in range(0, len(x), int(rate * chunk_s))]
+        r = Resampler(rate)
+        t0 = time.perf_counter()
+        for c in chunks:
+            r.process(c)
+        poly = len(x) / (time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        for c in chunks:
+            np.interp(np.arange(int(len(c) * OUTPUT_RATE / rate)) * (rate / OUTPUT_RATE), np.arange(len(c)), c)
+        lin = len(x) / (time.perf_counter() - t0)
+        sample = x[:rate // 4].tolist()
+        t0 = time.perf_counter()
+        _python_loop_resample(sample, rate, OUTPUT_RATE)
+        loop = len(sample) / (time.perf_counter() - t0)
+        print(f"{rate:>8}{f'{r.up}/{r.down}':>10}{poly / 1e6:>15.2f}{poly / rate:>12.0f}"
+              f"{lin / 1e6:>16.2f}{loop / 1e6:>14.2f}")
+
+    print(f"\nmix {seconds:.0f} s per party (16 kHz medics + 44.1 kHz doctor), {chunk_s * 1000:.0f} ms chunks")
+    print(f"{'parties':>8}{'Msamples/s out':>16}{'x realtime':>12}")
+    for n in (2, 4, 8):
+        rates = [16000] * (n - 1) + [44100]
+        streams = [(_tone(200 + 50 * i, r, seconds, 0.1) * 32768).astype("<i2").tobytes() for i, r in enumerate(rates)]
+        mixer = Mixer()
+        out = 0
+        t0 = time.perf_counter()
+        for step in range(int(seconds / chunk_s)):
+            for i, (r, pcm) in enumerate(zip(rates, streams)):
+                size = int(r * chunk_s) * 2
+                mixer.push(i, pcm[step * size:(step + 1) * size], r)
+            block = mixer.mix()
+            if block is not None:
+                out += len(block)
+                block.samples
+        elapsed = time.perf_counter() - t0
+        print(f"{n:>8}{out / elapsed / 1e6:>16.2f}{out / elapsed / OUTPUT_RATE:>12.0f}")
+
+
+if __name__ == "__main__":
+    _selftest()
+    _bench()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Bounded ring of sequenced audio chunks between pi.py's audio_worker and
+its sender.
+
+The worker put()s every chunk, which is numbered and timestamped. The
+sender drain()s whatever has accumulated and sends it on its own, not
+only when a frame happens to go out. Video pacing no longer decides which
+audio survives. Chunks are only lost when the ring overflows, i.e. the
+link has been down longer than the ring holds (oldest dropped first), or
+in flight on a broken connection. The receiver sees the latter as gaps in
+the seq and counts it (mac.py's audio_chunks_dropped_total{reason="lost"}).
+A failed POST puts its chunks back with requeue().
+
+Run this file directly for a self-test: 10 s of chunks pushed through the
+sender loop and stream_protocol to a ReorderBuffer, with video that
+stalls and bursts, must arrive complete and in order.
+"""
+
+import threading
+import time
+from collections import deque
+
+# === CONFIG ===
+AUDIO_RING_CHUNKS = 50  # ~5 s of 100 ms chunks held while the link is down
+# ==============
+
+
+class AudioRing:
+    def __init__(self, capacity=AUDIO_RING_CHUNKS):
+        self.capacity = capacity
+        self.chunks = deque()  # (seq, capture_ts, payload), oldest first
+        self.cond = threading.Condition()
+        self.next_seq = 1
+        self.pushed = 0
+        self.dropped = 0  # overflowed before they could be sent
+
+    def put(self, payload, capture_ts=None):
+        """Append a chunk; returns its seq."""
+        with self.cond:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.chunks.append((seq, capture_ts if capture_ts is not None else time.time(), payload))
+            self.pushed += 1
+            while len(self.chunks) > self.capacity:
+                self.chunks.popleft()
+                self.dropped += 1
+            self.cond.notify()
+            return seq
+
+    def drain(self, timeout=0.0):
+        """Every chunk waiting, oldest first; waits up to timeout for one if empty."""
+        with self.cond:
+            if not self.chunks and timeout:
+                self.cond.wait(timeout)
+            chunks = list(self.chunks)
+            self.chunks.clear()
+            return chunks
+
+    def requeue(self, chunks):
+        """Put unsent chunks back in front of newer ones (oldest dropped if that overflows)."""
+        with self.cond:
+            self.chunks.extendleft(reversed(chunks))
+            while len(self.chunks) > self.capacity:
+                self.chunks.popleft()
+                self.dropped += 1
+
+    def __len__(self):
+        return len(self.chunks)
+
+
+def _selftest(seconds=10.0, speedup=20.0):
+    """pi.py's sender pattern over a pipe: every chunk arrives once, in order."""
+    import os
+    import queue
+    import random
+
+    from jitter_buffer import ReorderBuffer
+    from stream_protocol import pack_media, read_media
+
+    chunk_s = 0.1 / speedup
+    n_chunks = int(seconds / 0.1)
+    ring = AudioRing()
+    frames = queue.Queue(maxsize=1)
+    r, w = os.pipe()
+    reader, writer = os.fdopen(r, "rb"), os.fdopen(w, "wb")
+    rng = random.Random(7)
+
+    def audio_worker():
+        t0 = time.monotonic()
+        for i in range(n_chunks):
+            time.sleep(max(t0 + (i + 1) * chunk_s - time.monotonic(), 0))
+            ring.put(b"\x00\x01" * 480, time.time())
+
+    def camera():
+        # 30 fps with stalls of up to 1 s and bursts: video pacing must not matter
+        seq = 0
+        end = time.monotonic() + seconds / speedup + 0.05
+        while time.monotonic() < end:
+            if rng.random() < 0.02:
+                time.sleep(1.0 / speedup)
+            seq += 1
+            try:
+                frames.put_nowait((b"\xff\xd8" + bytes(2000) + b"\xff\xd9", time.time(), seq))
+            except queue.Full:
+                pass
+            time.sleep(rng.choice((0.0, 1 / 30, 1 / 15)) / speedup)
+
+    def sender(stop):
+        # same shape as pi.py's frame_stream()
+        while not (stop.is_set() and not len(ring)):
+            for seq, ts, pcm in ring.drain():
+                writer.write(pack_media(seq, ts, None, pcm, 48000, audio_seq=seq, audio_ts=ts))
+            try:
+                jpg, ts, seq = frames.get(timeout=0.002)
+            except queue.Empty:
+                continue
+            writer.write(pack_media(seq, ts, jpg))
+        writer.close()
+
+    received, buf = [], ReorderBuffer()
+    stop = threading.Event()
+    threads = [threading.Thread(target=f) for f in (audio_worker, camera)]
+    send = threading.Thread(target=sender, args=(stop,))
+    for t in threads + [send]:
+        t.start()
+    t0 = time.monotonic()
+    while True:
+        pkt = read_media(reader)
+        if pkt is None:
+            break
+        if pkt.audio_seq is not None:
+            received += [s for s, _, p in buf.push(pkt.audio_seq, pkt.audio_ts, bytes(pkt.audio), time.time())
+                         if p is not None]
+        if not threads[0].is_alive() and not stop.is_set():
+            stop.set()
+    for t in threads + [send]:
+        t.join()
+    assert received == list(range(1, n_chunks + 1)), (len(received), n_chunks)
+    assert ring.dropped == 0 and buf.lost == 0 and buf.duplicates == 0
+
+    # link down: the ring keeps the newest AUDIO_RING_CHUNKS and counts the rest
+    ring = AudioRing(capacity=5)
+    for i in range(8):
+        ring.put(bytes([i]))
+    assert ring.dropped == 3
+    failed = ring.drain()  # [4..8], say the POST carrying them failed
+    ring.put(b"new")
+    ring.requeue(failed)
+    assert [s for s, _, _ in ring.drain()] == [5, 6, 7, 8, 9] and ring.dropped == 4
+    print(f"self-test ok: {n_chunks} chunks sent, {len(received)} received in order, "
+          f"0 dropped ({time.monotonic() - t0:.2f} s), overflow and requeue ok")
+
+
+if __name__ == "__main__":
+    _selftest()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Fan-out hub: one pre-serialized packet per frame, N subscribers.
+
+The publisher (Pi ingest) only appends a reference to each subscriber's
+bounded per-channel deque and notifies it; it never serializes per client
+and never waits on a slow one. Each subscriber is drained by its own sender
+thread. A full deque drops its oldest entry (latest-wins), so a slow client
+skips frames instead of building up latency or back-pressuring ingest.
+
+Channels have independent limits: video is typically latest-wins (1),
+audio gets a deeper queue so short stalls don't cut speech.
+
+Run this file directly for a load test: ingest rate with 1..50 subscribers,
+some deliberately slow, against serializing per client on the ingest thread.
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class Subscriber:
+    def __init__(self, key, limits):
+        self.key = key
+        self.queues = {channel: deque(maxlen=n) for channel, n in limits.items()}
+        self.dropped = dict.fromkeys(limits, 0)
+        self.delivered = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def offer(self, channel, packet):
+        """Called by the publisher. O(1), never blocks on the consumer."""
+        with self.cond:
+            q = self.queues[channel]
+            if len(q) == q.maxlen:
+                self.dropped[channel] += 1
+            q.append(packet)
+            self.cond.notify()
+
+    def drain(self, timeout=None):
+        """
+        Wait for packets and take everything queued, as [(channel, packet)].
+        Returns [] on timeout or once closed.
+        """
+        with self.cond:
+            if not self.closed and not any(self.queues.values()):
+                self.cond.wait(timeout)
+            items = []
+            for channel, q in self.queues.items():
+                while q:
+                    items.append((channel, q.popleft()))
+            self.delivered += len(items)
+            return items
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class BroadcastHub:
+    def __init__(self, limits=None):
+        self.limits = dict(limits or {"video": 1, "audio": 25})
+        self.lock = threading.Lock()
+        # copy-on-write tuple: publish() iterates without taking the lock
+        self.subscribers = ()
+        self.retired_dropped = dict.fromkeys(self.limits, 0)  # from unsubscribed clients
+
+    def subscribe(self, key):
+        sub = Subscriber(key, self.limits)
+        with self.lock:
+            self.subscribers = tuple(s for s in self.subscribers if s.key != key) + (sub,)
+        return sub
+
+    def unsubscribe(self, key):
+        with self.lock:
+            gone = [s for s in self.subscribers if s.key == key]
+            self.subscribers = tuple(s for s in self.subscribers if s.key != key)
+            for s in gone:
+                for ch, n in s.dropped.items():
+                    self.retired_dropped[ch] += n
+        for s in gone:
+            s.close()
+
+    def publish(self, channel, packet):
+        for sub in self.subscribers:
+            sub.offer(channel, packet)
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def dropped(self, channel):
+        """Packets dropped on `channel` since startup, current and past clients."""
+        return self.retired_dropped[channel] + sum(s.dropped[channel] for s in self.subscribers)
+
+    def stats(self):
+        subs = self.subscribers
+        return {
+            "subscribers": len(subs),
+            "dropped": {ch: self.dropped(ch) for ch in self.limits},
+            "delivered": sum(s.delivered for s in subs),
+        }
+
+
+# ---------------------------------------------------------------------------
+# Load test
+# ---------------------------------------------------------------------------
+
+def _load_test(duration=1.0, frame_size=60_000):
+    import base64
+    import json
+    import os
+
+    frame_b64 = base64.b64encode(os.urandom(frame_size)).decode("ascii")
+
+    def consumer(sub, delay):
+        while not sub.closed:
+            items = sub.drain(timeout=0.2)
+            for _, packet in items:
+                # stand-in for the socket write of an already-encoded packet
+                len(packet)
+                if delay:
+                    time.sleep(delay)
+
+    print(f"{'subs':>5}{'hub ingest/s':>15}{'per-client encode ingest/s':>29}{'video drops':>13}")
+    for n in (1, 5, 10, 25, 50):
+        hub = BroadcastHub()
+        threads = []
+        for i in range(n):
+            sub = hub.subscribe(i)
+            # every fifth client is on a bad link
+            t = threading.Thread(target=consumer, args=(sub, 0.1 if i % 5 == 4 else 0.0), daemon=True)
+            t.start()
+            threads.append(t)
+
+        published = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration:
+            packet = json.dumps(["video_frame", {"frame": frame_b64}])  # encode once
+            hub.publish("video", packet)
+            published += 1
+        hub_rate = published / (time.perf_counter() - t0)
+        drops = hub.stats()["dropped"]["video"]
+        for i in range(n):
+            hub.unsubscribe(i)
+
+        # baseline: encode per client on the ingest thread (what emit() did)
+        published = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration:
+            for _ in range(n):
+                json.dumps(["video_frame", {"frame": frame_b64}])
+            published += 1
+        legacy_rate = published / (time.perf_counter() - t0)
+
+        print(f"{n:>5}{hub_rate:>15.0f}{legacy_rate:>29.0f}{drops:>13}")
+
+
+if __name__ == "__main__":
+    _load_test()
@@ -5,6 +5,7 @@ This shows how a US doctor's system could grab the video/audio feed.
 """
 import requests
 import base64
+import json
 import cv2
 import numpy as np
 import time
@@ -12,6 +13,28 @@ import threading
 import queue
 from datetime import datetime
 
+def iter_sse(resp):
+    """Parse a text/event-stream response into (event, data, id) tuples."""
+    event, data, event_id = 'message', [], None
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, '\n'.join(data), event_id
+            event, data = 'message', []
+            continue
+        if line.startswith(':'):
+            continue  # keepalive comment
+        field, _, value = line.partition(':')
+        value = value[1:] if value.startswith(' ') else value
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+        elif field == 'id':
+            event_id = value
+
 class TelemedicineStreamClient:
     def __init__(self, server_url, session_id=None):
         self.server_url = server_url.rstrip('/')
@@ -19,6 +42,8 @@ class TelemedicineStreamClient:
         self.frame_queue = queue.Queue(maxsize=5)
         self.audio_queue = queue.Queue(maxsize=10)
         self.running = False
+        self.last_seq = 0  # last pushed event seen, for resuming /api/events
+        self.audio_format = None  # e.g. {'rate': 48000, 'channels': 1, 'encoding': 'f32le'}, sent once per stream
         
     def list_sessions(self):
         """Get list of active sessions"""
@@ -38,62 +63,115 @@ class TelemedicineStreamClient:
             print(f"Error getting session info: {e}")
             return None
     
-    def start_streaming(self, session_id=None):
-        """Start streaming from a session"""
+    def start_streaming(self, session_id=None, push=True):
+        """
+        Start streaming from a session. With push=True frames and audio come
+        from /api/events (each sent once); servers without it are polled.
+        """
         self.session_id = session_id or self.session_id
         if not self.session_id:
             print("No session ID provided!")
             return False
         
         self.running = True
-        threading.Thread(target=self._stream_worker, daemon=True).start()
+        worker = self._event_worker if push else self._stream_worker
+        threading.Thread(target=worker, daemon=True).start()
         return True
     
+    def _put_frame(self, img_b64):
+        try:
+            # Decode base64 to image
+            img_bytes = base64.b64decode(img_b64)
+            nparr = np.frombuffer(img_bytes, np.uint8)
+            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            
+            # Add to queue (drop old frames if full)
+            if self.frame_queue.full():
+                self.frame_queue.get_nowait()
+            self.frame_queue.put(img)
+        except Exception as e:
+            print(f"Error decoding frame: {e}")
+    
+    def _put_audio(self, audio_b64):
+        try:
+            audio_bytes = base64.b64decode(audio_b64)
+            if self.audio_queue.full():
+                self.audio_queue.get_nowait()
+            self.audio_queue.put(audio_bytes)
+        except Exception as e:
+            print(f"Error decoding audio: {e}")
+    
+    def _event_worker(self):
+        """Background worker reading the server-push stream (/api/events)"""
+        url = f"{self.server_url}/api/events/{self.session_id}"
+        
+        while self.running:
+            try:
+                headers = {'Accept': 'text/event-stream'}
+                if self.last_seq:
+                    headers['Last-Event-ID'] = str(self.last_seq)
+                # read timeout > server keepalive interval
+                with requests.get(url, headers=headers, stream=True, timeout=(5, 30)) as resp:
+                    if resp.status_code == 404 and self.running:
+                        print("Server has no push stream, falling back to polling")
+                        self._stream_worker()
+                        return
+                    resp.raise_for_status()
+                    for event, data, _ in iter_sse(resp):
+                        if not self.running:
+                            return
+                        payload = json.loads(data)
+                        # the server only sends what is newer than Last-Event-ID
+                        self.last_seq = payload.get('seq', self.last_seq)
+                        if event == 'frame':
+                            self._put_frame(payload['img'])
+                        elif event == 'audio':
+                            self._put_audio(payload['audio'])
+                        elif event == 'audio_format':
+                            self.audio_format = payload
+            except Exception as e:
+                print(f"Stream error: {e}")
+                time.sleep(1)
+    
     def _stream_worker(self):
-        """Background worker to fetch stream data"""
+        """Background worker polling /api/stream (servers without /api/events)"""
         last_img = None
         last_audio = None
+        etag = None
         
         while self.running:
             try:
+                # Conditional long-poll: 304 (no body) until a new frame arrives.
+                # Servers without ETag support just answer 200 every time.
+                headers = {'If-None-Match': etag} if etag else {}
                 resp = requests.get(
                     f"{self.server_url}/api/stream/{self.session_id}",
-                    timeout=0.5
+                    params={'wait': 5} if etag else None,
+                    headers=headers,
+                    timeout=(0.5, 10)
                 )
+                if resp.status_code == 304:
+                    continue
+                etag = resp.headers.get('ETag')
                 data = resp.json()
                 
                 # Handle video frame
                 if data.get('img') and data['img'] != last_img:
                     last_img = data['img']
-                    try:
-                        # Decode base64 to image
-                        img_bytes = base64.b64decode(data['img'])
-                        nparr = np.frombuffer(img_bytes, np.uint8)
-                        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                        
-                        # Add to queue (drop old frames if full)
-                        if self.frame_queue.full():
-                            self.frame_queue.get_nowait()
-                        self.frame_queue.put(img)
-                    except Exception as e:
-                        print(f"Error decoding frame: {e}")
+                    self._put_frame(last_img)
                 
                 # Handle audio
+                self.audio_format = data.get('audio_format', self.audio_format)
                 if data.get('audio') and data['audio'] != last_audio:
                     last_audio = data['audio']
-                    try:
-                        audio_bytes = base64.b64decode(data['audio'])
-                        if self.audio_queue.full():
-                            self.audio_queue.get_nowait()
-                        self.audio_queue.put(audio_bytes)
-                    except Exception as e:
-                        print(f"Error decoding audio: {e}")
+                    self._put_audio(last_audio)
                         
             except Exception as e:
                 print(f"Stream error: {e}")
                 time.sleep(0.1)
             
-            time.sleep(0.05)  # 20 FPS max
+            if not etag:
+                time.sleep(0.05)  # 20 FPS max
     
     def get_frame(self, timeout=0.1):
         """Get latest video frame"""
@@ -103,7 +181,7 @@ class TelemedicineStreamClient:
             return None
     
     def get_audio(self, timeout=0.1):
-        """Get latest audio chunk"""
+        """Get latest audio chunk: raw samples as described by self.audio_format"""
         try:
             return self.audio_queue.get(timeout=timeout)
         except queue.Empty:
@@ -3,7 +3,7 @@
 Doctor Data Server - Receives annotations and audio from doctor's UI
 and exposes them via API for ngrok forwarding to other systems.
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import json
 import time
@@ -11,8 +11,15 @@ from datetime import datetime
 import threading
 import queue
 
+import annotation_codec
+from annotation_store import AnnotationStore
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, instrument_flask
+from service_log import get_logger
+
 app = Flask(__name__)
 CORS(app)
+instrument_flask(app)
+log = get_logger('doctor_data')
 
 # Storage for doctor's data
 doctor_annotations = {}  # session_id -> list of annotations
@@ -21,35 +28,30 @@ session_data = {}  # session_id -> metadata
 
 class DoctorDataStore:
     def __init__(self):
-        self.annotations = {}
+        # Indexed by id with heap-ordered 15 s expiry, locked per session;
+        # kept in annotation_codec's binary form (simplified, quantized)
+        self.annotations = AnnotationStore(codec=annotation_codec)
         self.audio_chunks = {}
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # audio_chunks only
     
     def add_annotations(self, session_id, annotations):
-        with self.lock:
-            if session_id not in self.annotations:
-                self.annotations[session_id] = []
-            
-            # Update existing or add new annotations
-            for new_ann in annotations:
-                # Remove old annotation with same ID
-                self.annotations[session_id] = [
-                    ann for ann in self.annotations[session_id] 
-                    if ann.get('id') != new_ann.get('id')
-                ]
-                # Add new annotation
-                self.annotations[session_id].append(new_ann)
-            
-            # Clean up old annotations (older than 15 seconds)
-            now = time.time() * 1000  # Convert to milliseconds
-            self.annotations[session_id] = [
-                ann for ann in self.annotations[session_id]
-                if now - ann.get('timestamp', 0) < 15000
-            ]
+        return self.annotations.upsert(session_id, annotations)
+    
+    def apply_annotation_ops(self, session_id, ops):
+        return self.annotations.apply(session_id, ops)
     
     def get_annotations(self, session_id):
-        with self.lock:
-            return self.annotations.get(session_id, [])
+        return self.annotations.get(session_id)
+    
+    def annotation_changes(self, session_id, since_rev):
+        return self.annotations.changes_since(session_id, since_rev)
+    
+    def annotation_snapshot(self, session_id):
+        return self.annotations.snapshot(session_id)
+    
+    def packed_annotations(self, session_id):
+        rev, records = self.annotations.records(session_id)
+        return rev, annotation_codec.pack(records)
     
     def add_audio(self, session_id, audio_data, doctor_id):
         with self.lock:
@@ -76,6 +78,14 @@ class DoctorDataStore:
 # Global data store
 data_store = DoctorDataStore()
 
+# /metrics
+received = REGISTRY.counter('doctor_data_received_total', 'Annotation and audio posts from the doctor UI.',
+                            ('kind',))
+REGISTRY.gauge('doctor_audio_queue_depth', 'Chunks waiting in doctor_audio_queue.',
+               fn=doctor_audio_queue.qsize)
+REGISTRY.gauge('active_sessions', 'Sessions holding doctor annotations or audio.',
+               fn=lambda: len(set(data_store.annotations) | set(data_store.audio_chunks)))
+
 @app.route('/')
 def index():
     return '''
@@ -88,9 +98,9 @@ def index():
         
         <h2>Available Endpoints:</h2>
         <ul>
-            <li><code>POST /doctor_annotations</code> - Receive annotations from doctor</li>
+            <li><code>POST /doctor_annotations</code> - Receive annotation ops (add/update/delete/clear) from doctor</li>
             <li><code>POST /doctor_audio</code> - Receive audio from doctor</li>
-            <li><code>GET /annotations/{session_id}</code> - Get current annotations for session</li>
+            <li><code>GET /annotations/{session_id}?since_rev=N</code> - Get current annotations for session (only changes after rev N)</li>
             <li><code>GET /doctor_audio/{session_id}</code> - Get latest doctor audio for session</li>
             <li><code>GET /sessions</code> - List sessions with doctor data</li>
         </ul>
@@ -119,22 +129,36 @@ def index():
 
 @app.route('/doctor_annotations', methods=['POST'])
 def receive_annotations():
-    """Receive annotations from doctor's UI"""
+    """
+    Receive annotations from doctor's UI: either deltas
+    {"ops": [{"op": "add"|"update"|"delete"|"clear", ...}]} or (older UIs)
+    the full {"annotations": [...]} list, merged by id. Answers with the new rev.
+    """
     try:
         data = request.json
         session_id = data.get('session_id')
-        annotations = data.get('annotations', [])
         
         if not session_id:
             return jsonify({'error': 'Missing session_id'}), 400
         
-        data_store.add_annotations(session_id, annotations)
+        if 'ops' in data:
+            count = len(data['ops'])
+            try:
+                rev = data_store.apply_annotation_ops(session_id, data['ops'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            annotations = data.get('annotations', [])
+            count = len(annotations)
+            rev = data_store.add_annotations(session_id, annotations)
+        received.labels('annotations').inc()
         
-        print(f"Received {len(annotations)} annotations for session {session_id}")
-        return jsonify({'status': 'received', 'count': len(annotations)})
+        log.info("annotations received", extra={'key': 'annotations', 'session': session_id,
+                                                'count': count, 'rev': rev})
+        return jsonify({'status': 'received', 'count': count, 'rev': rev})
         
     except Exception as e:
-        print(f"Error receiving annotations: {e}")
+        log.error("error receiving annotations: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/doctor_audio', methods=['POST'])
@@ -150,22 +174,41 @@ def receive_doctor_audio():
             return jsonify({'error': 'Missing session_id or audio data'}), 400
         
         data_store.add_audio(session_id, audio_b64, doctor_id)
+        received.labels('audio').inc()
         
-        print(f"Received audio from Dr. {doctor_id} for session {session_id}")
+        log.info("doctor audio received", extra={'key': 'audio', 'session': session_id,
+                                                 'doctor': doctor_id})
         return jsonify({'status': 'received'})
         
     except Exception as e:
-        print(f"Error receiving doctor audio: {e}")
+        log.error("error receiving doctor audio: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/annotations/<session_id>')
 def get_annotations(session_id):
-    """Get current annotations for a session"""
+    """
+    Current annotations for a session. With ?since_rev=N only the ops after
+    revision N come back ({"rev", "ops"}); if the op log no longer reaches
+    back that far the answer is a snapshot ({"rev", "annotations",
+    "snapshot": true}) to apply ops on top of. ?format=packed returns the
+    snapshot as annotation_codec.pack() bytes, rev in X-Annotation-Rev.
+    """
     try:
-        annotations = data_store.get_annotations(session_id)
+        if request.args.get('format') == 'packed':
+            rev, blob = data_store.packed_annotations(session_id)
+            return Response(blob, mimetype='application/octet-stream',
+                            headers={'X-Annotation-Rev': str(rev)})
+        since_rev = request.args.get('since_rev', type=int)
+        if since_rev is not None:
+            rev, ops = data_store.annotation_changes(session_id, since_rev)
+            if ops is not None:
+                return jsonify({'session_id': session_id, 'rev': rev, 'ops': ops})
+        rev, annotations = data_store.annotation_snapshot(session_id)
         return jsonify({
             'session_id': session_id,
+            'rev': rev,
             'annotations': annotations,
+            'snapshot': True,
             'timestamp': time.time() * 1000
         })
     except Exception as e:
@@ -198,9 +241,7 @@ def list_sessions():
     try:
         with data_store.lock:
             return jsonify({
-                'annotations': {
-                    sid: len(anns) for sid, anns in data_store.annotations.items()
-                },
+                'annotations': data_store.annotations.counts(),
                 'audio': {
                     sid: len(chunks) for sid, chunks in data_store.audio_chunks.items()
                 },
@@ -225,6 +266,11 @@ def get_combined_data(session_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus text: posts received, queue depth, request latency"""
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 # Cleanup old data periodically
 def cleanup_old_data():
     """Remove old annotations and audio chunks"""
@@ -233,17 +279,10 @@ def cleanup_old_data():
             time.sleep(30)  # Run every 30 seconds
             now = time.time() * 1000
             
+            # Clean annotations older than 15 seconds (drops empty sessions)
+            data_store.annotations.expire(now)
+            
             with data_store.lock:
-                # Clean annotations older than 15 seconds
-                for session_id in list(data_store.annotations.keys()):
-                    data_store.annotations[session_id] = [
-                        ann for ann in data_store.annotations[session_id]
-                        if now - ann.get('timestamp', 0) < 15000
-                    ]
-                    # Remove empty sessions
-                    if not data_store.annotations[session_id]:
-                        del data_store.annotations[session_id]
-                
                 # Clean audio older than 2 minutes
                 for session_id in list(data_store.audio_chunks.keys()):
                     data_store.audio_chunks[session_id] = [
@@ -255,7 +294,7 @@ def cleanup_old_data():
                         del data_store.audio_chunks[session_id]
                         
         except Exception as e:
-            print(f"Cleanup error: {e}")
+            log.error("cleanup error: %s", e)
 
 # Start cleanup thread
 threading.Thread(target=cleanup_old_data, daemon=True).start()
@@ -268,8 +307,9 @@ if __name__ == '__main__':
     print("\nEndpoints:")
     print("  POST /doctor_annotations - Receive annotations")
     print("  POST /doctor_audio - Receive doctor audio")
-    print("  GET  /annotations/{session_id} - Get annotations")
+    print("  GET  /annotations/{session_id}?since_rev=N - Get annotations (or changes since rev N)")
     print("  GET  /doctor_audio/{session_id} - Get doctor audio")
     print("  GET  /combined/{session_id} - Get both")
+    print("  GET  /metrics - Request and queue metrics (Prometheus text)")
     
     app.run(host='0.0.0.0', port=5001, debug=False) 
\ No newline at end of file
@@ -3,7 +3,7 @@
 Doctor's UI for telemedicine system - handles login, patient data display,
 live video streaming with annotations, and bidirectional audio.
 """
-from flask import Flask, render_template_string, request, jsonify, session as flask_session
+from flask import Flask, Response, render_template_string, request, jsonify, session as flask_session
 from flask_cors import CORS
 import requests
 import base64
@@ -23,10 +23,14 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from doctor import TelemedicineStreamClient
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, instrument_flask, latency
+from service_log import get_logger
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 CORS(app)
+instrument_flask(app)
+log = get_logger('doctor_ui')
 
 # Global state
 current_client = None
@@ -34,9 +38,16 @@ active_sessions = {}
 doctor_audio_queue = queue.Queue(maxsize=10)
 annotation_queue = queue.Queue(maxsize=50)
 
+# /metrics
+REGISTRY.gauge('annotation_queue_depth', 'Items waiting in annotation_queue.', fn=annotation_queue.qsize)
+REGISTRY.gauge('doctor_audio_queue_depth', 'Items waiting in doctor_audio_queue.', fn=doctor_audio_queue.qsize)
+forward_failures = REGISTRY.counter('forward_failures_total', 'Posts to the doctor data server that failed.',
+                                    ('kind',))
+
 # Configuration
 NGROK_URL = ""  # Will be set after login
 LOCALHOST_URL = "http://localhost:5001"  # For sending doctor's data
+FORWARD_RETRY_S = (0.1, 2.0)  # annotation_forwarder backoff after a failed POST: first, max
 
 class DoctorSession:
     def __init__(self, doctor_id, ngrok_url):
@@ -515,12 +526,12 @@ DOCTOR_UI_TEMPLATE = '''
                     const data = await response.json();
                     
                     if (data.img) {
-                        displayFrame(data.img);
+                        displayFrame(data.img, data.capture_ts);
                         updateFPS();
                     }
                     
                     if (data.audio) {
-                        playAudio(data.audio);
+                        playAudio(data.audio, data.audio_format);
                     }
                 } catch (err) {
                     console.error('Stream error:', err);
@@ -528,12 +539,22 @@ DOCTOR_UI_TEMPLATE = '''
             }, 50); // 20 FPS
         }
         
-        function displayFrame(base64Image) {
+        // capture->render ages, sent to /api/metrics/latency every 5 s
+        let renderAges = [];
+        setInterval(() => {
+            if (!renderAges.length) return;
+            navigator.sendBeacon('/api/metrics/latency',
+                JSON.stringify({hop: 'browser_render', ages: renderAges}));
+            renderAges = [];
+        }, 5000);
+        
+        function displayFrame(base64Image, captureTs) {
             const img = new Image();
             img.onload = function() {
                 canvas.width = img.width;
                 canvas.height = img.height;
                 ctx.drawImage(img, 0, 0);
+                if (captureTs && renderAges.length < 500) renderAges.push(Date.now() / 1000 - captureTs);
                 
                 // Draw annotations
                 drawAnnotations();
@@ -597,6 +618,7 @@ DOCTOR_UI_TEMPLATE = '''
                 const rect = canvas.getBoundingClientRect();
                 const endX = e.clientX - rect.left;
                 const endY = e.clientY - rect.top;
+                const countBefore = annotations.length;
                 
                 if (currentTool === 'circle') {
                     const radius = Math.sqrt(Math.pow(endX - startX, 2) + Math.pow(endY - startY, 2));
@@ -621,7 +643,12 @@ DOCTOR_UI_TEMPLATE = '''
                 }
                 
                 isDrawing = false;
-                sendAnnotations();
+                // Only the shape just finished goes over the wire, not the whole list
+                const finished = (currentTool === 'free' || annotations.length > countBefore)
+                    ? annotations[annotations.length - 1] : null;
+                if (finished) {
+                    sendAnnotationOps([{op: 'add', annotation: finished}]);
+                }
             });
         }
         
@@ -681,17 +708,17 @@ DOCTOR_UI_TEMPLATE = '''
         
         function clearAnnotations() {
             annotations = [];
-            sendAnnotations();
+            sendAnnotationOps([{op: 'clear'}]);
         }
         
-        async function sendAnnotations() {
+        async function sendAnnotationOps(ops) {
             try {
                 await fetch('/api/annotations', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
                     body: JSON.stringify({
                         session_id: currentSessionId,
-                        annotations: annotations
+                        ops: ops
                     })
                 });
             } catch (err) {
@@ -711,7 +738,7 @@ DOCTOR_UI_TEMPLATE = '''
             }
         }
         
-        function playAudio(base64Data) {
+        function playAudio(base64Data, format) {
             if (!audioContext || !base64Data) return;
             
             try {
@@ -720,18 +747,26 @@ DOCTOR_UI_TEMPLATE = '''
                 const bytes = new Uint8Array(len);
                 for (let i = 0; i < len; i++) bytes[i] = binaryString.charCodeAt(i);
                 
-                const pcmData = bytes.slice(44);
-                const int16Array = new Int16Array(
-                    pcmData.buffer,
-                    pcmData.byteOffset,
-                    Math.floor(pcmData.byteLength / 2)
-                );
-                const float32Array = new Float32Array(int16Array.length);
-                for (let i = 0; i < int16Array.length; i++) {
-                    float32Array[i] = int16Array[i] / 32768.0;
+                let float32Array, rate = 48000;
+                if (format && format.encoding === 'f32le') {
+                    // mac.py sends float32 samples at format.rate, no per-chunk header
+                    float32Array = new Float32Array(bytes.buffer, 0, len >> 2);
+                    rate = format.rate;
+                } else {
+                    // older servers: a WAV file per chunk
+                    const pcmData = bytes.slice(44);
+                    const int16Array = new Int16Array(
+                        pcmData.buffer,
+                        pcmData.byteOffset,
+                        Math.floor(pcmData.byteLength / 2)
+                    );
+                    float32Array = new Float32Array(int16Array.length);
+                    for (let i = 0; i < int16Array.length; i++) {
+                        float32Array[i] = int16Array[i] / 32768.0;
+                    }
                 }
                 
-                const buffer = audioContext.createBuffer(1, float32Array.length, 48000);
+                const buffer = audioContext.createBuffer(1, float32Array.length, rate);
                 buffer.copyToChannel(float32Array, 0);
                 
                 const source = audioContext.createBufferSource();
@@ -871,24 +906,98 @@ def get_stream_data(session_id):
     try:
         # Get stream data from ngrok server
         response = requests.get(f"{NGROK_URL}/api/stream/{session_id}", timeout=1)
-        return response.json()
+        data = response.json()
+        latency.observe('proxy', data.get('capture_ts'), data.get('frame_seq'))
+        return data
     except Exception as e:
         return jsonify({'img': '', 'audio': '', 'error': str(e)})
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus text: queue depths, request and frame latency"""
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/api/metrics/latency', methods=['POST'])
+def report_latency():
+    """Capture->render ages measured by the page (sendBeacon)"""
+    try:
+        data = json.loads(request.get_data() or b'{}')
+    except ValueError:
+        return jsonify({'error': 'bad report'}), 400
+    for age in data.get('ages', [])[:500]:
+        latency.observe_age('browser_render', age)
+    return '', 204
+
 @app.route('/api/annotations', methods=['POST'])
 def send_annotations():
-    """Send annotations to localhost for ngrok forwarding"""
-    data = request.json
+    """Queue annotation ops for forwarding to localhost (see annotation_forwarder)"""
+    data = request.json or {}
+    session_id = data.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
     
+    if 'ops' in data:
+        ops = data['ops']
+    else:
+        # older page: full list; the data server skips unchanged ones
+        ops = [{'op': 'update', 'annotation': a} for a in data.get('annotations', [])]
     try:
-        # Send to localhost server (which will be exposed via ngrok)
-        requests.post(f"{LOCALHOST_URL}/doctor_annotations", 
-                     json=data, 
-                     timeout=0.5)
-    except Exception as e:
-        print(f"Failed to send annotations: {e}")
+        annotation_queue.put((session_id, ops), timeout=1.0)
+    except queue.Full:
+        forward_failures.labels('annotations').inc()
+        return jsonify({'error': 'annotation forwarder is behind'}), 503
     
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'queued'})
+
+def annotation_forwarder():
+    """
+    Background sender for annotation_queue: the request thread never waits
+    on localhost, and ops queued for a session while a POST was in flight
+    go out together in the next one (order preserved). Ops from a failed
+    POST (and everything after them) are retried first, with backoff; the
+    queue is not drained meanwhile, so a long outage surfaces as 503s from
+    /api/annotations rather than unbounded memory.
+    """
+    http = requests.Session()
+    retry, backoff = [], FORWARD_RETRY_S[0]
+    while True:
+        if retry:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, FORWARD_RETRY_S[1])
+            batches, retry = retry, []
+        else:
+            batches = [annotation_queue.get()]
+            while True:
+                try:
+                    batches.append(annotation_queue.get_nowait())
+                except queue.Empty:
+                    break
+        
+        # merge consecutive items for the same session
+        merged = []
+        for session_id, ops in batches:
+            if merged and merged[-1][0] == session_id:
+                merged[-1][1].extend(ops)
+            else:
+                merged.append((session_id, list(ops)))
+        
+        for i, (session_id, ops) in enumerate(merged):
+            try:
+                # Send to localhost server (which will be exposed via ngrok)
+                http.post(f"{LOCALHOST_URL}/doctor_annotations",
+                          json={'session_id': session_id, 'ops': ops},
+                          timeout=0.5)
+            except Exception as e:
+                # ops are idempotent upserts/deletes, so resending after a timeout is safe
+                forward_failures.labels('annotations').inc()
+                log.warning("failed to send annotations, retrying in %.1fs: %s", backoff, e,
+                            extra={'key': 'forward_annotations', 'session': session_id, 'ops': len(ops)})
+                retry = merged[i:]
+                break
+        else:
+            backoff = FORWARD_RETRY_S[0]
+
+threading.Thread(target=annotation_forwarder, daemon=True).start()
 
 @app.route('/api/doctor_audio', methods=['POST'])
 def send_doctor_audio():
@@ -912,7 +1021,8 @@ def send_doctor_audio():
         
         return jsonify({'status': 'ok'})
     except Exception as e:
-        print(f"Failed to send doctor audio: {e}")
+        forward_failures.labels('audio').inc()
+        log.warning("failed to send doctor audio: %s", e, extra={'key': 'forward_audio'})
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
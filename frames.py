@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Immutable JPEG frame with lazily cached derived representations.
+
+Servers keep one Frame per upload and hand the same object to every
+consumer. The JPEG bytes never change, so each representation (base64 text
+for the JSON APIs, a multipart/x-mixed-replace chunk for MJPEG viewers, a
+small thumbnail for session lists) is built on first use and then shared:
+computed at most once per frame however many viewers read it.
+
+Run this file directly for a benchmark of N viewers reading one frame
+against re-deriving it per viewer.
+"""
+
+import base64
+import threading
+import time
+
+THUMB_WIDTH = 160
+THUMB_QUALITY = 60
+MJPEG_BOUNDARY = b"frame"
+
+
+class Frame:
+    __slots__ = ("jpeg", "capture_ts", "seq", "_lock", "_b64", "_mjpeg", "_thumb")
+
+    def __init__(self, jpeg, capture_ts=None, b64=None, seq=None):
+        self.jpeg = bytes(jpeg)
+        self.capture_ts = capture_ts  # Pi capture time, None if the sender didn't say
+        self.seq = seq
+        self._lock = threading.Lock()
+        self._b64 = b64
+        self._mjpeg = None
+        self._thumb = None
+
+    @classmethod
+    def from_b64(cls, text, capture_ts=None, seq=None):
+        """From the base64 a JSON upload carried; that text is reused as .b64."""
+        return cls(base64.b64decode(text), capture_ts, b64=text, seq=seq)
+
+    def __len__(self):
+        return len(self.jpeg)
+
+    def __bytes__(self):
+        return self.jpeg
+
+    @property
+    def b64(self):
+        """Base64 text for the JSON / data-URI consumers."""
+        if self._b64 is None:
+            with self._lock:
+                if self._b64 is None:
+                    self._b64 = base64.b64encode(self.jpeg).decode("ascii")
+        return self._b64
+
+    @property
+    def mjpeg_chunk(self):
+        """One part of a multipart/x-mixed-replace; boundary=frame response."""
+        if self._mjpeg is None:
+            with self._lock:
+                if self._mjpeg is None:
+                    self._mjpeg = b"".join((
+                        b"--", MJPEG_BOUNDARY, b"\r\n",
+                        b"Content-Type: image/jpeg\r\n",
+                        b"Content-Length: ", str(len(self.jpeg)).encode(), b"\r\n\r\n",
+                        self.jpeg, b"\r\n",
+                    ))
+        return self._mjpeg
+
+    @property
+    def thumbnail(self):
+        """JPEG about THUMB_WIDTH px wide (the original if it can't be decoded)."""
+        if self._thumb is None:
+            with self._lock:
+                if self._thumb is None:
+                    self._thumb = _make_thumbnail(self.jpeg)
+        return self._thumb
+
+
+def _make_thumbnail(jpeg):
+    import cv2
+    import numpy as np
+
+    # libjpeg scales by 1/8 during decode, much cheaper than a full decode
+    img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_REDUCED_COLOR_8)
+    if img is None:
+        return jpeg
+    h, w = img.shape[:2]
+    if w > THUMB_WIDTH:
+        img = cv2.resize(img, (THUMB_WIDTH, max(1, h * THUMB_WIDTH // w)), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, THUMB_QUALITY])
+    return buf.tobytes() if ok else jpeg
+
+
+def _bench(viewers=50, reads=30, size=60_000):
+    import os
+
+    jpeg = os.urandom(size)
+    text = base64.b64encode(jpeg).decode("ascii")
+
+    t0 = time.perf_counter()
+    for _ in range(reads):
+        for _ in range(viewers):
+            # old mac_simple.generate(): decode the stored base64 per viewer per tick
+            base64.b64decode(text)
+    legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(reads):
+        frame = Frame.from_b64(text)
+        for _ in range(viewers):
+            frame.mjpeg_chunk
+            frame.b64
+    cached = time.perf_counter() - t0
+
+    print(f"{viewers} viewers x {reads} frames of {size} B")
+    print(f"  per-viewer decode: {legacy * 1000:8.1f} ms")
+    print(f"  cached Frame:      {cached * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    _bench()
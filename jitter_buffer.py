@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+"""
+Jitter buffering for the Pi's audio, keyed on (sequence number, capture
+timestamp), plus video pacing against the audio clock.
+
+Both ends use it:
+
+  ReorderBuffer   mac.py, per session. Releases each audio chunk once, in
+                  seq order. A gap is held until the chunks behind it have
+                  waited the jitter-derived delay, then declared lost.
+                  Duplicates (pi.py used to attach one chunk to several
+                  frames) and chunks behind the release point are dropped.
+                  This runs at arrival time and needs no timers.
+
+  PlayoutBuffer   the playout side: chunks played back to back in fixed
+                  slots. A missing chunk is concealed. If later chunks are
+                  buffered, it is counted as lost and skipped. If nothing
+                  later has arrived yet, the slot is stretched and playout
+                  waits, which grows the delay under a stall. When the
+                  delay runs above target, chunks are skipped to catch up,
+                  which also absorbs sender/receiver clock drift. mac.py's
+                  page runs the same algorithm in JavaScript.
+
+  VideoPacer      shows the newest frame captured at or before the audio
+                  being heard (PlayoutBuffer.clock), instead of each frame
+                  on arrival.
+
+Target delay comes from JitterEstimator: a quantile of each chunk's
+transit time (arrival minus capture) over a window, measured against the
+window's fastest transit. The clock offset between Pi and server cancels
+out. The RFC 3550 interarrival jitter is kept alongside for /metrics.
+
+Times are seconds. Capture timestamps come from the Pi (time.time()) and
+arrival/now from the receiver; only differences are used.
+
+ArrivalTrace records real arrivals as JSON lines (mac.py, with
+ARRIVAL_TRACE_DIR set), and the harness replays them deterministically:
+
+    python3 jitter_buffer.py                   # synthetic lan/wifi/lossy/drift traces
+    python3 jitter_buffer.py traces/*.jsonl    # recorded ones
+
+Each trace is played through the old browser scheduling and through these
+buffers; the harness reports gaps, duplicates, out-of-order playback,
+latency and A/V offset.
+"""
+
+import json
+import threading
+from collections import deque
+
+# === CONFIG ===
+CHUNK_S = 0.1            # pi.py audio chunk duration
+MIN_DELAY_S = 0.06       # playout delay bounds
+MAX_DELAY_S = 0.6
+DELAY_QUANTILE = 0.98    # transit quantile the delay covers
+DELAY_WINDOW = 100       # arrivals the estimate looks back over (~10 s of audio)
+MAX_STRETCH_S = 1.0      # stalled this long: stop and re-buffer on the next arrival
+MAX_VIDEO_HOLD_S = 0.5   # never hold a frame back longer than this behind the newest
+# ==============
+
+
+class JitterEstimator:
+    def __init__(self, window=DELAY_WINDOW, quantile=DELAY_QUANTILE):
+        self.quantile = quantile
+        self.transits = deque(maxlen=window)
+        self.last_transit = None
+        self.jitter = 0.0  # RFC 3550 interarrival jitter
+
+    def observe(self, capture_ts, arrival):
+        transit = arrival - capture_ts
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+        self.transits.append(transit)
+
+    @property
+    def base_transit(self):
+        """Fastest transit in the window (includes the clock offset)."""
+        return min(self.transits) if self.transits else 0.0
+
+    def spread(self):
+        """How far behind the fastest chunk the slow ones run (the quantile)."""
+        if not self.transits:
+            return 0.0
+        ordered = sorted(self.transits)
+        return ordered[int(self.quantile * (len(ordered) - 1))] - ordered[0]
+
+    def target_delay(self, chunk_s=CHUNK_S, min_delay=MIN_DELAY_S, max_delay=MAX_DELAY_S):
+        return min(max(self.spread() + chunk_s / 2, min_delay), max_delay)
+
+
+class ReorderBuffer:
+    """
+    push() returns the chunks now releasable, in seq order, as
+    (seq, capture_ts, payload) with payload None for a chunk given up on.
+    """
+
+    def __init__(self, min_delay=MIN_DELAY_S, max_delay=MAX_DELAY_S):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.estimator = JitterEstimator()
+        self.pending = {}  # seq -> (capture_ts, payload, arrival)
+        self.next_seq = None
+        self.released = self.lost = self.duplicates = self.late = 0
+        self.lock = threading.Lock()
+
+    def push(self, seq, capture_ts, payload, now):
+        with self.lock:
+            self.estimator.observe(capture_ts, now)
+            if self.next_seq is None:
+                self.next_seq = seq
+            if seq < self.next_seq:
+                if seq >= self.next_seq - DELAY_WINDOW:
+                    self.late += 1
+                    return []
+                self.next_seq = seq  # far behind: the sender restarted its count
+                self.pending.clear()
+            if seq in self.pending:
+                self.duplicates += 1
+                return []
+            self.pending[seq] = (capture_ts, payload, now)
+            return self._release(now)
+
+    def _release(self, now):
+        out = []
+        hold = self.estimator.target_delay(0.0, self.min_delay, self.max_delay)
+        while self.pending:
+            entry = self.pending.pop(self.next_seq, None)
+            if entry is not None:
+                out.append((self.next_seq, entry[0], entry[1]))
+                self.released += 1
+                self.next_seq += 1
+                continue
+            oldest = min(self.pending)
+            if now - self.pending[oldest][2] < hold:
+                break  # the gap might still fill
+            for seq in range(self.next_seq, oldest):
+                out.append((seq, None, None))
+            self.lost += oldest - self.next_seq
+            self.next_seq = oldest
+        return out
+
+    @property
+    def jitter(self):
+        return self.estimator.jitter
+
+
+class PlayoutBuffer:
+    """
+    push() chunks as they arrive, pull(now) whatever slots have started:
+    [(seq, capture_ts, payload)], payload None for a concealed slot.
+    """
+
+    def __init__(self, chunk_s=CHUNK_S, min_delay=MIN_DELAY_S, max_delay=MAX_DELAY_S):
+        self.chunk_s = chunk_s
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.estimator = JitterEstimator()
+        self.chunks = {}  # seq -> (capture_ts, payload)
+        self.next_seq = None
+        self.play_at = None  # receiver time the next slot starts
+        self.stretched = 0  # consecutive slots waiting for next_seq
+        self.playing = None  # (play_at, capture_ts) of the newest chunk played
+        self.stats = dict(played=0, concealed=0, lost=0, late=0, duplicates=0, skipped=0, rebuffers=0)
+
+    def target_delay(self):
+        return self.estimator.target_delay(self.chunk_s, self.min_delay, self.max_delay)
+
+    def push(self, seq, capture_ts, payload, now):
+        self.estimator.observe(capture_ts, now)
+        if self.next_seq is not None and seq < self.next_seq:
+            self.stats["late"] += 1
+            return
+        if seq in self.chunks:
+            self.stats["duplicates"] += 1
+            return
+        self.chunks[seq] = (capture_ts, payload)
+        if self.play_at is None:
+            if self.next_seq is None or seq > self.next_seq:
+                self.next_seq = min(self.chunks)
+            self.play_at = now + self.target_delay()
+
+    def _delay(self, capture_ts):
+        """How long after its earliest possible arrival a chunk would play now."""
+        return self.play_at - (capture_ts + self.estimator.base_transit)
+
+    def pull(self, now):
+        out = []
+        while self.play_at is not None and self.play_at <= now:
+            seq = self.next_seq
+            entry = self.chunks.pop(seq, None)
+            if entry is None:
+                if self.chunks:
+                    # later chunks are here, so this one is lost (or hopelessly late)
+                    self.stats["lost"] += 1
+                    self.next_seq += 1
+                else:
+                    # nothing newer either: a stall, wait for it
+                    self.stretched += 1
+                    if self.stretched * self.chunk_s >= MAX_STRETCH_S:
+                        self.play_at = None
+                        self.stretched = 0
+                        self.stats["rebuffers"] += 1
+                        break
+                self.stats["concealed"] += 1
+                out.append((seq, None, None))
+                self.play_at += self.chunk_s
+                continue
+            self.stretched = 0
+            capture_ts, payload = entry
+            if self._delay(capture_ts) > self.target_delay() + self.chunk_s and seq + 1 in self.chunks:
+                # running behind target with the next chunk ready: drop this one to catch up
+                self.stats["skipped"] += 1
+                self.next_seq += 1
+                continue
+            out.append((seq, capture_ts, payload))
+            self.playing = (self.play_at, capture_ts)
+            self.stats["played"] += 1
+            self.next_seq += 1
+            self.play_at += self.chunk_s
+        return out
+
+    def clock(self, now):
+        """Capture time of the audio being heard at `now` (None before playback)."""
+        if self.playing is None:
+            return None
+        started, capture_ts = self.playing
+        return capture_ts + min(max(now - started, 0.0), self.chunk_s)
+
+
+class VideoPacer:
+    def __init__(self, max_hold=MAX_VIDEO_HOLD_S):
+        self.max_hold = max_hold
+        self.frames = deque()  # (capture_ts, frame), arrival order
+        self.shown = self.dropped = 0
+
+    def push(self, capture_ts, frame):
+        self.frames.append((capture_ts, frame))
+
+    def present(self, clock_ts):
+        """The (capture_ts, frame) to show now, or None to keep the current one."""
+        if not self.frames:
+            return None
+        newest_ts = self.frames[-1][0]
+        if clock_ts is None:
+            limit = newest_ts  # no audio clock: show frames as they come
+        else:
+            limit = max(clock_ts, newest_ts - self.max_hold)
+        chosen = None
+        while self.frames and self.frames[0][0] <= limit:
+            if chosen is not None:
+                self.dropped += 1
+            chosen = self.frames.popleft()
+        if chosen is not None:
+            self.shown += 1
+        return chosen
+
+
+class ArrivalTrace:
+    """Appends {"kind", "seq", "capture_ts", "arrival"} JSON lines for the harness."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", buffering=64 * 1024)
+        self.lock = threading.Lock()
+
+    def record(self, kind, seq, capture_ts, arrival):
+        line = json.dumps({"kind": kind, "seq": seq, "capture_ts": capture_ts, "arrival": arrival})
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_trace(path):
+    """[(kind, seq, capture_ts, arrival)] from an ArrivalTrace file, in arrival order."""
+    events = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                e = json.loads(line)
+                events.append((e.get("kind", "audio"), e["seq"], e["capture_ts"], e["arrival"]))
+    events.sort(key=lambda e: e[3])
+    return events
+
+
+def synthetic_trace(profile, seconds=60.0, seed=1):
+    """
+    Audio chunks every CHUNK_S and 30 fps video, with network behaviour:
+    lan (2 ms jitter), wifi (exponential jitter, a 300 ms stall every ~6 s),
+    lossy (wifi plus 3% loss, reordering, and chunks sent twice the way
+    pi.py used to), drift (lan with the Pi's clock 0.5% fast).
+    """
+    import random
+
+    rng = random.Random(seed)
+    clock_rate = 1.005 if profile == "drift" else 1.0
+    stalls = []
+    if profile in ("wifi", "lossy"):
+        t = rng.uniform(2, 6)
+        while t < seconds:
+            stalls.append((t, t + 0.3))
+            t += rng.uniform(4, 8)
+
+    def deliver(send_at, extra=0.0):
+        if profile in ("lan", "drift"):
+            arrival = send_at + 0.02 + abs(rng.gauss(0, 0.002))
+        else:
+            arrival = send_at + 0.02 + rng.expovariate(1 / 0.015)
+        arrival += extra
+        for start, end in stalls:
+            if start <= arrival < end:
+                arrival = end + rng.uniform(0, 0.01)  # queued behind the stall, then a burst
+        return arrival
+
+    events = []
+    for seq in range(int(seconds / CHUNK_S)):
+        capture = seq * CHUNK_S * clock_rate
+        send_at = (seq + 1) * CHUNK_S  # receiver's clock, once the chunk is complete
+        if profile == "lossy" and rng.random() < 0.03:
+            continue
+        extra = 0.12 if profile == "lossy" and rng.random() < 0.02 else 0.0  # overtaken by the next one
+        events.append(("audio", seq, capture, deliver(send_at, extra)))
+        if profile == "lossy" and rng.random() < 0.3:
+            events.append(("audio", seq, capture, deliver(send_at + 1 / 30)))
+    for seq in range(int(seconds * 30)):
+        capture = seq / 30 * clock_rate
+        # bigger payloads than audio: a little more transit
+        events.append(("video", seq, capture, deliver(seq / 30, 0.015)))
+    events.sort(key=lambda e: e[3])
+    return events
+
+
+def _quantile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def simulate_naive(trace, chunk_s=CHUNK_S):
+    """
+    mac.py's page before this module: schedule each chunk on arrival at
+    max(nextTime, now + 50 ms) with at most 250 ms queued ahead, and show
+    each frame as it arrives.
+    """
+    queued = deque()
+    next_time = 0.0
+    played, gaps, latencies, av = [], 0.0, [], []
+    state = {"frame": None}
+
+    def flush(now):
+        nonlocal next_time, gaps
+        while queued and next_time - now < 0.25:
+            seq, capture = queued.popleft()
+            if next_time < now + 0.05:
+                if played:
+                    gaps += now + 0.05 - next_time
+                next_time = now + 0.05
+            played.append(seq)
+            latencies.append(next_time - capture)
+            next_time += chunk_s
+
+    for kind, seq, capture, arrival in trace:
+        if kind == "audio":
+            queued.append((seq, capture))
+            flush(arrival)
+        else:
+            state["frame"] = capture
+            # audio heard now: the chunk scheduled to be playing
+            heard = _naive_clock(played, latencies, next_time, arrival, chunk_s)
+            if heard is not None:
+                av.append(capture - heard)
+        # the page also flushed on a 50 ms timer; arrivals come far more often here
+
+    return _report(played, gaps, latencies, av, dict(duplicates=len(played) - len(set(played))))
+
+
+def _naive_clock(played, latencies, next_time, now, chunk_s):
+    # walk back from the last scheduled chunk to the one covering `now`
+    t = next_time
+    for i in range(len(played) - 1, -1, -1):
+        t -= chunk_s
+        if t <= now:
+            start = t
+            capture = start - latencies[i]
+            return capture + min(now - start, chunk_s)
+    return None
+
+
+def simulate_buffered(trace, chunk_s=CHUNK_S, tick=0.01):
+    """ReorderBuffer on the server, PlayoutBuffer + VideoPacer in the page."""
+    server = ReorderBuffer()
+    player = PlayoutBuffer(chunk_s)
+    pacer = VideoPacer()
+    played, latencies, av = [], [], []
+    gaps = pending_gap = 0.0
+
+    def advance(now):
+        nonlocal gaps, pending_gap
+        for seq, capture, payload in player.pull(now):
+            if payload is None:
+                pending_gap += chunk_s  # a gap once something plays after it (not the end of the trace)
+                continue
+            if played:
+                gaps += pending_gap
+            pending_gap = 0.0
+            played.append(seq)
+            latencies.append(player.playing[0] - capture)
+        shown = pacer.present(player.clock(now))
+        if shown is not None:
+            heard = player.clock(now)
+            if heard is not None:
+                av.append(shown[0] - heard)
+
+    if not trace:
+        return _report(played, gaps, latencies, av, {})
+    now = trace[0][3]
+    for kind, seq, capture, arrival in trace:
+        while now + tick <= arrival:
+            now += tick
+            advance(now)
+        if kind == "audio":
+            for rseq, rcapture, payload in server.push(seq, capture, seq, arrival):
+                if payload is not None:
+                    player.push(rseq, rcapture, payload, arrival)
+        else:
+            pacer.push(capture, seq)
+        advance(arrival)
+    end = now + 2 * MAX_DELAY_S
+    while now < end:
+        now += tick
+        advance(now)
+    extra = {"lost": server.lost + player.stats["lost"], "server_dups": server.duplicates,
+             "skipped": player.stats["skipped"], "video_dropped": pacer.dropped}
+    return _report(played, gaps, latencies, av, extra)
+
+
+def _report(played, gaps, latencies, av, extra):
+    out_of_order = sum(1 for a, b in zip(played, played[1:]) if b <= a)
+    return dict(played=len(played), gap_s=gaps, out_of_order=out_of_order,
+                latency_ms=1000 * (sum(latencies) / len(latencies) if latencies else float("nan")),
+                latency_p95_ms=1000 * _quantile(latencies, 0.95),
+                av_ms=1000 * (sum(abs(x) for x in av) / len(av) if av else float("nan")),
+                av_p95_ms=1000 * _quantile([abs(x) for x in av], 0.95), **extra)
+
+
+def _run(traces):
+    print(f"{'trace':>16} {'player':>8}{'played':>8}{'gap s':>8}{'dup':>6}{'ooo':>6}"
+          f"{'lat ms':>8}{'p95':>7}{'|A-V| ms':>10}{'p95':>7}")
+    for name, trace in traces:
+        for label, fn in (("naive", simulate_naive), ("buffer", simulate_buffered)):
+            r = fn(trace)
+            dups = r.get("duplicates", 0)
+            print(f"{name:>16} {label:>8}{r['played']:>8}{r['gap_s']:>8.2f}{dups:>6}{r['out_of_order']:>6}"
+                  f"{r['latency_ms']:>8.0f}{r['latency_p95_ms']:>7.0f}{r['av_ms']:>10.0f}{r['av_p95_ms']:>7.0f}")
+            if label == "buffer":
+                print(f"{'':>25}lost {r['lost']}, duplicates dropped {r['server_dups']}, "
+                      f"skipped to catch up {r['skipped']}, video frames not shown {r['video_dropped']}")
+
+
+def _selftest():
+    # same trace, same numbers: the harness is deterministic
+    t = synthetic_trace("lossy", 20)
+    assert simulate_buffered(t) == simulate_buffered(list(t))
+    # in order and once, whatever the network did
+    r = simulate_buffered(t)
+    assert r["out_of_order"] == 0, r
+    clean = simulate_buffered(synthetic_trace("lan", 20))
+    assert clean["lost"] == 0 and clean["gap_s"] == 0 and clean["played"] == 200, clean
+    # reorder buffer: dup, reorder, gap given up after the hold
+    rb = ReorderBuffer(min_delay=0.05, max_delay=0.05)
+    assert [s for s, _, _ in rb.push(0, 0.0, b"a", 0.0)] == [0]
+    assert rb.push(2, 0.2, b"c", 0.21) == []
+    assert rb.push(2, 0.2, b"c", 0.22) == [] and rb.duplicates == 1
+    assert [(s, p) for s, _, p in rb.push(1, 0.1, b"b", 0.23)] == [(1, b"b"), (2, b"c")]
+    rb.push(4, 0.4, b"e", 0.41)
+    assert [(s, p) for s, _, p in rb.push(5, 0.5, b"f", 0.51)] == [(3, None), (4, b"e"), (5, b"f")]
+    assert rb.lost == 1
+    print("self-test ok")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _selftest()
+    if len(sys.argv) > 1:
+        _run([(p.rsplit("/", 1)[-1], load_trace(p)) for p in sys.argv[1:]])
+    else:
+        _run([(p, synthetic_trace(p)) for p in ("lan", "wifi", "lossy", "drift")])
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Incremental MJPEG splitter for libcamera-vid / UVC byte streams.
+
+Bytes are read straight into a preallocated buffer (readinto, no per-chunk
+bytes objects) and carved into JPEGs by walking the marker structure instead
+of searching for the first FF D9:
+
+- marker segments (APPn, DQT, DHT, SOF, ...) are skipped by their length
+  field, so an EXIF thumbnail's own SOI/EOI inside APP1 can't end the frame
+- inside entropy-coded data only FF followed by something other than 00
+  (byte stuffing) or D0-D7 (restart markers) is a real marker
+- scanning resumes from the last offset; nothing is rescanned
+
+Frames are handed out as memoryviews into the buffer. A view is only valid
+until the next fill_from()/feed() call, which may compact the buffer in
+place — copy (bytes(view)) or encode it before reading more.
+
+Record a stream on the Pi and benchmark against the old carver:
+
+    libcamera-vid -t 10000 -n --codec mjpeg -o capture.mjpeg
+    python3 jpeg_splitter.py capture.mjpeg
+
+Without an argument a synthetic stream (with embedded thumbnails, stuffed
+bytes and restart markers) is generated.
+"""
+
+import time
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+
+_SEEK_SOI, _MARKER, _ENTROPY = range(3)
+
+
+class JpegSplitter:
+    def __init__(self, capacity=1 << 20, max_frame=8 << 20):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.max_frame = max_frame
+        self.frames_out = 0
+        self.dropped_bytes = 0
+        self.reset()
+
+    def reset(self):
+        """Forget any partial frame (e.g. after the camera process restarts)."""
+        self.write_pos = 0
+        self.pos = 0            # next byte to examine
+        self.frame_start = -1   # offset of the current frame's SOI
+        self.state = _SEEK_SOI
+
+    # ---- filling ----
+    def _make_room(self, need):
+        """Ensure `need` free bytes after write_pos, compacting or growing."""
+        keep = self.frame_start if self.frame_start >= 0 else max(self.pos - 1, 0)
+        keep = min(keep, self.write_pos)
+        if len(self.buf) - self.write_pos >= need:
+            return
+        pending = self.write_pos - keep
+        if pending + need > len(self.buf):
+            # Frame bigger than the buffer: move to a larger one. Old views
+            # keep pointing at the old buffer, so this is always safe.
+            new_buf = bytearray(max(len(self.buf) * 2, pending + need))
+            new_buf[:pending] = self.view[keep:self.write_pos]
+            self.buf = new_buf
+            self.view = memoryview(new_buf)
+        elif keep:
+            # memoryview slice assignment is a memmove; size never changes
+            self.view[:pending] = self.view[keep:self.write_pos]
+        self.write_pos = pending
+        self.pos -= keep
+        if self.frame_start >= 0:
+            self.frame_start -= keep
+
+    def fill_from(self, stream, size=65536):
+        """readinto() up to `size` bytes from a raw stream. Returns bytes read (0 = EOF)."""
+        self._make_room(size)
+        n = stream.readinto(self.view[self.write_pos:self.write_pos + size]) or 0
+        self.write_pos += n
+        return n
+
+    def feed(self, data):
+        """Append bytes from any other source."""
+        n = len(data)
+        self._make_room(n)
+        self.view[self.write_pos:self.write_pos + n] = data
+        self.write_pos += n
+
+    # ---- carving ----
+    def _resync(self, at):
+        self.state = _SEEK_SOI
+        self.frame_start = -1
+        self.pos = at
+
+    def frames(self):
+        """Yield every complete JPEG currently buffered, as a memoryview."""
+        buf = self.buf
+        end = self.write_pos
+        while True:
+            if self.state == _SEEK_SOI:
+                i = buf.find(SOI, self.pos, end)
+                if i < 0:
+                    # keep a trailing FF in case SOI straddles the next read
+                    new_pos = max(end - 1, self.pos)
+                    self.dropped_bytes += new_pos - self.pos
+                    self.pos = new_pos
+                    return
+                self.dropped_bytes += i - self.pos
+                self.frame_start = i
+                self.pos = i + 2
+                self.state = _MARKER
+
+            elif self.state == _MARKER:
+                p = self.pos
+                # skip fill bytes (FF FF ...)
+                while p + 1 < end and buf[p] == 0xFF and buf[p + 1] == 0xFF:
+                    p += 1
+                if p + 2 > end:
+                    self.pos = p
+                    return
+                if buf[p] != 0xFF:
+                    self.dropped_bytes += p - self.frame_start
+                    self._resync(p)
+                    continue
+                marker = buf[p + 1]
+                if marker == 0xD9:
+                    start, stop = self.frame_start, p + 2
+                    self.pos = stop
+                    self.frame_start = -1
+                    self.state = _SEEK_SOI
+                    self.frames_out += 1
+                    yield self.view[start:stop]
+                    continue
+                if marker == 0xD8:
+                    # new SOI before EOI: the previous frame was truncated
+                    self.dropped_bytes += p - self.frame_start
+                    self.frame_start = p
+                    self.pos = p + 2
+                    continue
+                if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                    self.pos = p + 2
+                    continue
+                if p + 4 > end:
+                    self.pos = p
+                    return
+                seg_end = p + 2 + ((buf[p + 2] << 8) | buf[p + 3])
+                if seg_end > end:
+                    self.pos = p
+                    if end - self.frame_start > self.max_frame:
+                        self.dropped_bytes += end - self.frame_start
+                        self._resync(end)
+                    return
+                self.pos = seg_end
+                if marker == 0xDA:
+                    self.state = _ENTROPY
+
+            else:  # _ENTROPY
+                p = self.pos
+                while True:
+                    i = buf.find(b"\xff", p, end)
+                    if i < 0 or i + 1 >= end:
+                        self.pos = end - 1 if i >= 0 else end
+                        if end - self.frame_start > self.max_frame:
+                            self.dropped_bytes += end - self.frame_start
+                            self._resync(end)
+                        return
+                    nxt = buf[i + 1]
+                    if nxt == 0x00 or 0xD0 <= nxt <= 0xD7:
+                        p = i + 2
+                        continue
+                    if nxt == 0xFF:
+                        p = i + 1
+                        continue
+                    self.pos = i
+                    self.state = _MARKER
+                    break
+
+
+# ---------------------------------------------------------------------------
+# Benchmark / correctness check
+# ---------------------------------------------------------------------------
+
+def _legacy_carve(chunks):
+    """The original mjpeg_reader_proc loop, kept for comparison."""
+    buf = bytearray()
+    out = []
+    for chunk in chunks:
+        buf.extend(chunk)
+        while True:
+            start = buf.find(SOI)
+            if start < 0:
+                if len(buf) > 2 * 65536:
+                    del buf[:-2]
+                break
+            end = buf.find(EOI, start + 2)
+            if end < 0:
+                if start > 0:
+                    del buf[:start]
+                break
+            out.append(bytes(buf[start:end + 2]))
+            del buf[:end + 2]
+    return out
+
+
+def _synthetic_jpeg(rng, size):
+    """A structurally valid JPEG: APP1 with an embedded thumbnail, stuffed scan data, RSTs."""
+    def segment(marker, payload):
+        return bytes((0xFF, marker)) + (len(payload) + 2).to_bytes(2, "big") + payload
+
+    thumb = SOI + bytes(rng.getrandbits(8) for _ in range(64)) + EOI
+    scan = bytearray()
+    for n in range(size):
+        b = rng.getrandbits(8)
+        scan.append(b)
+        if b == 0xFF:
+            scan.append(0x00)
+        if n and n % 4096 == 0:
+            scan += bytes((0xFF, 0xD0 + (n // 4096) % 8))
+    return b"".join((
+        SOI,
+        segment(0xE1, b"Exif\x00\x00" + thumb),
+        segment(0xDB, bytes(65)),
+        segment(0xC0, bytes(15)),
+        segment(0xDA, bytes(10)),
+        bytes(scan),
+        EOI,
+    ))
+
+
+def _main(argv):
+    import random
+
+    rng = random.Random(1234)
+    if len(argv) > 1:
+        with open(argv[1], "rb") as f:
+            stream = f.read()
+        expected = None
+        source = argv[1]
+    else:
+        frames = [_synthetic_jpeg(rng, rng.randint(20_000, 60_000)) for _ in range(60)]
+        stream = b"".join(frames)
+        expected = frames
+        source = "synthetic (60 frames with EXIF thumbnails)"
+
+    # chunk like a pipe read would
+    chunks, off = [], 0
+    while off < len(stream):
+        n = rng.randint(1, 65536)
+        chunks.append(stream[off:off + n])
+        off += n
+
+    class _Reader:
+        def __init__(self, chunks):
+            self.it = iter(chunks)
+
+        def readinto(self, mv):
+            try:
+                c = next(self.it)
+            except StopIteration:
+                return 0
+            mv[:len(c)] = c
+            return len(c)
+
+    def run_new():
+        sp = JpegSplitter()
+        out = []
+        reader = _Reader(chunks)
+        while sp.fill_from(reader):
+            for view in sp.frames():
+                out.append(len(view))
+        return sp, out
+
+    sp, sizes = run_new()
+    legacy = _legacy_carve(chunks)
+
+    # correctness: compare full frames once (copying views)
+    sp_check = JpegSplitter()
+    got = []
+    reader = _Reader(chunks)
+    while sp_check.fill_from(reader):
+        got.extend(bytes(v) for v in sp_check.frames())
+    print(f"source: {source}, {len(stream)} bytes")
+    print(f"splitter frames: {len(got)}, legacy frames: {len(legacy)}")
+    if expected is not None:
+        assert got == expected, "splitter output differs from the source frames"
+        print(f"splitter matches source frames; legacy matches: {legacy == expected}")
+
+    reps = 20
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        run_new()
+    t_new = (time.perf_counter() - t0) / reps
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        _legacy_carve(chunks)
+    t_old = (time.perf_counter() - t0) / reps
+    mb = len(stream) / 1e6
+    print(f"splitter: {mb / t_new:8.1f} MB/s  {len(sizes) / t_new:8.0f} frames/s")
+    print(f"legacy:   {mb / t_old:8.1f} MB/s  {len(legacy) / t_old:8.0f} frames/s")
+
+
+if __name__ == "__main__":
+    import sys
+    _main(sys.argv)
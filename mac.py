@@ -1,49 +1,346 @@
 #!/usr/bin/env python3
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
 import base64
 import logging
 import json
+import os
+from collections import deque
 from datetime import datetime
 import threading
 import time
 
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
+import numpy as np
+
+from audio_codec import CODEC_NONE, CODEC_PCM, decodable_codecs, make_decoder, strip_wav
+from audio_engine import Resampler, float32_to_int16, int16_to_float32
+from frames import Frame
+from jitter_buffer import ArrivalTrace, ReorderBuffer
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, instrument_flask, latency
+from service_log import get_logger
+from session_recorder import RecordingReader, SessionRecorder
+from stream_protocol import PROTO_BINARY, ProtocolError, pack_media, read_media
+
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+log = get_logger('mac')
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for external access
+instrument_flask(app)
+
+SSE_KEEPALIVE_S = 15  # comment line on idle /api/events streams so proxies keep them open
+LONG_POLL_MAX_S = 25  # cap for ?wait= on /api/stream and /current
+RECORD_SESSIONS = False  # record every session to disk (or per session: "record": true)
+ARRIVAL_TRACE_DIR = None  # write <session>.jsonl arrival traces here for jitter_buffer.py's harness
+PLAYOUT_RATE = 48000  # Hz; all audio goes to viewers as float32 mono at this rate
+DECODABLE_CODECS = decodable_codecs()  # told to Pis probing /frame_stream; opus only with opuslib
+INGEST_IDLE_S = 600  # sessions created by an upload are dropped after this long without one
+
+# Sent to viewers once per stream (SSE audio_format event, /api/session info);
+# audio chunks after that are bare base64 samples tagged with their seq
+AUDIO_FORMAT = {'rate': PLAYOUT_RATE, 'channels': 1, 'encoding': 'f32le'}
 
 # Session data
 sessions = {}
 current_session_id = None
+# (uploader address, ?session_id) -> audio_format from its last /frame body that had one;
+# pi.py sends it once per stream, not with every POST
+ingest_audio_formats = {}
+
+# /metrics
+frames_ingested = REGISTRY.counter('ingest_frames_total', 'Frames received from Pis.')
+bytes_ingested = REGISTRY.counter('ingest_bytes_total', 'JPEG and audio bytes received from Pis.')
+REGISTRY.rate('ingest_fps', 'Frames received per second (last 10 s).', frames_ingested)
+REGISTRY.rate('ingest_bytes_per_second', 'Bytes received per second (last 10 s).', bytes_ingested)
+viewers = REGISTRY.gauge('stream_viewers', 'Open push streams by kind.', ('kind',))
+REGISTRY.gauge('active_sessions', 'Sessions held in memory.', fn=lambda: len(sessions))
+REGISTRY.gauge('recording_dropped_records', 'Records dropped because the disk fell behind.',
+               fn=lambda: sum(s.recorder.dropped for s in list(sessions.values()) if s.recorder))
+audio_chunks_dropped = REGISTRY.counter('audio_chunks_dropped_total',
+                                        'Audio chunks not passed on (reorder buffer, decode errors).', ('reason',))
+REGISTRY.gauge('audio_jitter_seconds', 'Worst RFC 3550 audio interarrival jitter across sessions.',
+               fn=lambda: max((s.audio_buffer.jitter for s in list(sessions.values())), default=0.0))
 
 class Session:
     def __init__(self, session_id, patient_info):
         self.id = session_id
         self.patient_info = patient_info
         self.start_time = datetime.now()
-        self.img = ''
-        self.audio_chunks = []
+        self.frame = None  # frames.Frame: raw JPEG, derived forms cached per frame
         self.annotations = []  # For future drawing overlay
         self.active = True
+        self.auto = False  # created by an upload rather than /api/start_session
+        self.last_ingest = time.time()
+        # Push streaming: every upload gets a sequence number; listeners
+        # wait on `changed` instead of polling
+        self.seq = 0
+        self.img_seq = 0
+        self.audio_log = deque(maxlen=10)  # (seq, audio, audio_seq, audio_ts), ~1 s, for /api/events
+        self.audio_buffer = ReorderBuffer()  # audio in order and once, keyed on the Pi's audio seq
+        self.audio_lock = threading.Lock()  # reorder + decode, so stateful decoders see chunks in order
+        self.audio_decoders = {}  # (codec, rate) -> audio_codec decoder; opus keeps state across chunks
+        self.resamplers = {}  # source rate -> audio_engine.Resampler to PLAYOUT_RATE (filter state across chunks)
+        self.changed = threading.Condition()
+        self.recorder = None  # SessionRecorder while recording
+        self.trace = ArrivalTrace(os.path.join(ARRIVAL_TRACE_DIR, f'{session_id}.jsonl')) if ARRIVAL_TRACE_DIR else None
         
-    def add_frame(self, img, audio=None):
-        self.img = img
-        if audio:
-            self.audio_chunks.append(audio)
-            # Keep last 10 chunks (~1 second)
-            if len(self.audio_chunks) > 10:
-                self.audio_chunks.pop(0)
+    @property
+    def img(self):
+        """Current frame as base64 text ('' before the first upload)."""
+        frame = self.frame
+        return frame.b64 if frame else ''
+    
+    def add_frame(self, frame, audio=None, audio_seq=None, audio_ts=None):
+        self.add_media(frame, [(audio, audio_seq, audio_ts)] if audio else [])
+    
+    def add_media(self, frame, audio_chunks=()):
+        """
+        A frame (or None) and any number of (audio, audio_seq, audio_ts)
+        chunks, audio being an encoded (codec, rate, payload). With
+        audio_seq (pi.py), audio goes through the reorder buffer: each chunk
+        is passed on once, in order. Without it, as it comes. Chunks are
+        decoded and resampled only once released, since both keep state
+        from one chunk to the next.
+        """
+        now = self.last_ingest = time.time()
+        if frame is not None:
+            latency.observe('server_ingest', frame.capture_ts, frame.seq)
+            frames_ingested.inc()
+            bytes_ingested.inc(len(frame))
+            if self.trace:
+                self.trace.record('video', frame.seq, frame.capture_ts, now)
+        chunks = []
+        with self.audio_lock:
+            for audio, audio_seq, audio_ts in audio_chunks:
+                bytes_ingested.inc(len(audio[2]))
+                if audio_seq is None:
+                    released = [(audio, None, None)]
+                else:
+                    if audio_ts is None:
+                        audio_ts = now
+                    if self.trace:
+                        self.trace.record('audio', audio_seq, audio_ts, now)
+                    released = self.reorder_audio(audio_seq, audio_ts, audio, now)
+                for chunk, chunk_seq, chunk_ts in released:
+                    try:
+                        chunks.append((self.decode_audio(*chunk), chunk_seq, chunk_ts))
+                    except Exception as e:
+                        # e.g. opus without opuslib: lose this chunk, not the upload
+                        audio_chunks_dropped.labels('undecodable').inc()
+                        log.warning("dropping undecodable audio: %s", e,
+                                    extra={'key': 'bad_audio', 'session': self.id, 'codec': chunk[0]})
+        with self.changed:
+            self.seq += 1
+            if frame is not None:
+                self.frame = frame
+                self.img_seq = self.seq
+            for chunk, chunk_seq, chunk_ts in chunks:
+                self.audio_log.append((self.seq, chunk, chunk_seq, chunk_ts))
+            self.changed.notify_all()
+        
+        recorder = self.recorder
+        if recorder and (frame is not None or chunks):
+            # the frame with the first chunk, any further chunks as audio-only records
+            # (s16le at PLAYOUT_RATE, with the Pi's audio seq and capture time)
+            first, first_seq, first_ts = chunks[0] if chunks else (None, None, None)
+            recorder.record((frame.capture_ts if frame is not None else None) or now,
+                            frame.jpeg if frame is not None else None,
+                            recorded_pcm(first) if first else None, PLAYOUT_RATE,
+                            audio_seq=first_seq, audio_ts=first_ts, audio_codec=CODEC_PCM)
+            for chunk, chunk_seq, chunk_ts in chunks[1:]:
+                recorder.record(chunk_ts or now, None, recorded_pcm(chunk), PLAYOUT_RATE,
+                                audio_seq=chunk_seq, audio_ts=chunk_ts, audio_codec=CODEC_PCM)
+    
+    def reorder_audio(self, audio_seq, audio_ts, audio, now):
+        """[(audio, audio_seq, audio_ts)] released by the reorder buffer"""
+        buf = self.audio_buffer
+        duplicates, late = buf.duplicates, buf.late
+        released = buf.push(audio_seq, audio_ts, audio, now)
+        audio_chunks_dropped.labels('duplicate').inc(buf.duplicates - duplicates)
+        audio_chunks_dropped.labels('late').inc(buf.late - late)
+        lost = sum(1 for _, _, chunk in released if chunk is None)
+        if lost:
+            audio_chunks_dropped.labels('lost').inc(lost)
+        return [(chunk, seq, ts) for seq, ts, chunk in released if chunk is not None]
+    
+    def decode_audio(self, codec, rate, payload):
+        """
+        Base64 float32 samples at PLAYOUT_RATE (AUDIO_FORMAT) from an
+        audio_codec payload. Done once per chunk here, not in every viewer,
+        and in audio_seq order (see add_media).
+        """
+        dec = self.audio_decoders.get((codec, rate))
+        if dec is None:
+            dec = self.audio_decoders[(codec, rate)] = make_decoder(codec, rate)
+        pcm, rate = strip_wav(dec.decode(payload), rate)  # older pi.py: a WAV file per chunk
+        rate = rate or PLAYOUT_RATE
+        resampler = self.resamplers.get(rate)
+        if resampler is None:
+            resampler = self.resamplers[rate] = Resampler(rate, PLAYOUT_RATE)
+        return base64.b64encode(resampler.process(int16_to_float32(pcm))).decode()
+
+    def start_recording(self):
+        if self.recorder is None:
+            self.recorder = SessionRecorder(self.id)
+            log.info("recording session", extra={'session': self.id, 'dir': self.recorder.dir})
+    
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder:
+            recorder.close()
+        trace, self.trace = self.trace, None
+        if trace:
+            trace.close()
+    
+    def wait_for_update(self, last_seq, timeout=None):
+        """Block until an upload newer than last_seq arrives. Returns the current seq."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq > last_seq, timeout)
+            return self.seq
+    
+    def wait_for_frame(self, last_img_seq, timeout=None):
+        """Block until a frame newer than last_img_seq arrives. Returns (img_seq, frame)."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.img_seq > last_img_seq, timeout)
+            return self.img_seq, self.frame
+    
+    def events_since(self, last_seq, with_img=True):
+        """
+        What a push client that has seen last_seq still needs: the newest frame
+        (intermediate frames are skipped) and every buffered audio chunk.
+        Without with_img, frame events carry only the seq (the client gets the
+        pixels from /api/mjpeg). Returns (seq, [(event, payload)]).
+        """
+        with self.changed:
+            seq, frame, img_seq = self.seq, self.frame, self.img_seq
+            audio_log = list(self.audio_log)
+        events = []
+        if frame and img_seq > last_seq:
+            event = {'seq': img_seq, 'capture_ts': frame.capture_ts, 'frame_seq': frame.seq}
+            if with_img:
+                event['img'] = frame.b64
+            events.append(('frame', event))
+        for seq, audio, audio_seq, audio_ts in audio_log:
+            if seq > last_seq:
+                events.append(('audio', {'seq': seq, 'audio': audio, 'audio_seq': audio_seq, 'audio_ts': audio_ts}))
+        events.sort(key=lambda e: e[1]['seq'])  # ids stay monotonic for Last-Event-ID
+        return seq, events
     
     def get_latest(self):
+        with self.changed:
+            seq, frame = self.seq, self.frame
+            _, audio, audio_seq, audio_ts = self.audio_log[-1] if self.audio_log else (0, '', None, None)
         return {
-            'img': self.img,
-            'audio': self.audio_chunks[-1] if self.audio_chunks else '',
+            'seq': seq,
+            'img': frame.b64 if frame else '',
+            'capture_ts': frame.capture_ts if frame else None,
+            'frame_seq': frame.seq if frame else None,
+            'audio': audio,
+            'audio_seq': audio_seq,
+            'audio_ts': audio_ts,
+            'audio_format': AUDIO_FORMAT,
             'annotations': self.annotations,
             'session_id': self.id,
             'patient_info': self.patient_info
         }
+    
+    def etag(self):
+        return f'"{self.id}-{self.seq}"'
+    
+    def info(self):
+        return {
+            'session_id': self.id,
+            'patient_info': self.patient_info,
+            'start_time': self.start_time.isoformat(),
+            'active': self.active,
+            'recording': self.recorder is not None,
+            'audio_format': AUDIO_FORMAT
+        }
+    
+    def summary(self):
+        return {
+            'session_id': self.id,
+            'patient_name': self.patient_info.get('name'),
+            'severity': self.patient_info.get('severity'),
+            'start_time': self.start_time.isoformat(),
+            'active': self.active
+        }
+
+def create_session(patient_info, record=None):
+    """Start a new session and make it the one Pi uploads go to."""
+    global current_session_id
+    session_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+    
+    session = Session(session_id, patient_info)
+    if RECORD_SESSIONS if record is None else record:
+        session.start_recording()
+    sessions[session_id] = session
+    current_session_id = session_id
+    return session
+
+def get_ingest_session(session_id=None):
+    """
+    Session that Pi uploads go to. A Pi may name its session (several Pis per
+    server); otherwise the current one is used. Auto-created if missing, and
+    then dropped by cleanup_sessions after INGEST_IDLE_S without uploads.
+    """
+    global current_session_id
+    
+    if session_id:
+        if session_id not in sessions:
+            sessions[session_id] = auto_session(session_id)
+        return sessions[session_id]
+    
+    if not current_session_id or current_session_id not in sessions:
+        # Auto-create session if none exists
+        current_session_id = 'auto_' + datetime.now().strftime('%Y%m%d_%H%M%S')
+        sessions[current_session_id] = auto_session(current_session_id)
+    return sessions[current_session_id]
+
+def auto_session(session_id):
+    session = Session(session_id, {
+        'name': 'Auto Session',
+        'severity': 'unknown'
+    })
+    session.auto = True
+    return session
+
+def sse_event(event, payload):
+    """One Server-Sent Events record; the id lets EventSource resume."""
+    return f"id: {payload['seq']}\nevent: {event}\ndata: {json.dumps(payload)}\n\n"
+
+def client_seq(session, headers, args):
+    """
+    Sequence number the client already has, from ?since= or an If-None-Match
+    ETag issued for this session. None means "send the full state", as does
+    a seq ahead of the session's (a token from before a restart): waiting
+    for the session to catch up would only end in a long-poll 304.
+    """
+    since = args.get('since')
+    if since is None:
+        for tag in headers.get('If-None-Match', '').split(','):
+            tag = tag.strip().removeprefix('W/').strip('"')
+            sid, _, seq = tag.rpartition('-')
+            if sid == session.id and seq.isdigit():
+                since = seq
+                break
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return None
+    return since if since is not None and since <= session.seq else None
+
+def long_poll_timeout(args):
+    """?wait=<seconds>: hold a not-modified request open for the next frame."""
+    try:
+        return min(max(float(args.get('wait', 0)), 0.0), LONG_POLL_MAX_S)
+    except ValueError:
+        return 0.0
+
+def get_current_session():
+    if current_session_id and current_session_id in sessions:
+        return sessions[current_session_id]
+    return None
 
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
@@ -334,6 +631,8 @@ HTML_TEMPLATE = '''
         <div class="api-info" id="api-info">
             <strong>API Endpoints:</strong><br>
             Stream: <code id="stream-endpoint">/api/stream/{session_id}</code><br>
+            Push: <code id="events-endpoint">/api/events/{session_id}</code><br>
+            MJPEG: <code id="mjpeg-endpoint">/api/mjpeg/{session_id}</code><br>
             Info: <code id="info-endpoint">/api/session/{session_id}</code>
         </div>
     </div>
@@ -345,9 +644,23 @@ HTML_TEMPLATE = '''
         latencyHint: 'playback',
         sampleRate: 48000
     });
-    let nextTime = 0;
-    let lastAudioB64 = null;
-    const audioQueue = [];
+    // Playout jitter buffer: jitter_buffer.py's PlayoutBuffer (same constants),
+    // keyed on the Pi's audio seq and capture time. Times are audioContext time.
+    const MIN_DELAY_S = 0.06, MAX_DELAY_S = 0.6, DELAY_QUANTILE = 0.98, DELAY_WINDOW = 100;
+    const MAX_STRETCH_S = 1.0, MAX_VIDEO_HOLD_S = 0.5;
+    const LOOKAHEAD_S = 0.1;  // Web Audio needs chunks scheduled a little ahead
+    // Opt-in (?av_sync=1): frames as base64 over /api/events, shown in step with the
+    // audio. The default is native MJPEG from /api/mjpeg, which costs far less to decode.
+    const AV_SYNC = new URLSearchParams(location.search).get('av_sync') === '1';
+    const player = {
+        chunks: new Map(),  // seq -> {capture, samples}
+        nextSeq: null, playAt: null, stretched: 0, chunkS: 0.1,
+        transits: [], last: null, concealed: 0,
+        heard: [],  // {at, capture} of scheduled chunks, for audioClock()
+    };
+    let legacySeq = 0, lastAudioB64 = null;  // chunks without audio_seq (older Pis)
+    // Sent once per stream (audio_format event / session info); chunks are bare samples
+    let audioFormat = {rate: 48000, channels: 1, encoding: 'f32le'};
     
     // Severity selection
     document.querySelectorAll('.severity-option').forEach(opt => {
@@ -397,9 +710,11 @@ HTML_TEMPLATE = '''
             // Show API info
             document.getElementById('api-info').style.display = 'block';
             document.getElementById('stream-endpoint').textContent = '/api/stream/' + sessionId;
+            document.getElementById('events-endpoint').textContent = '/api/events/' + sessionId;
+            document.getElementById('mjpeg-endpoint').textContent = '/api/mjpeg/' + sessionId;
             document.getElementById('info-endpoint').textContent = '/api/session/' + sessionId;
             
-            // Start polling
+            // Start streaming
             startStreaming();
         } catch (err) {
             alert('Failed to start session: ' + err.message);
@@ -416,81 +731,215 @@ HTML_TEMPLATE = '''
     }, {once: true});
     
     function base64ToFloat32(base64Data) {
+        // the server already decoded, converted and resampled: the bytes are the samples
         const binaryString = atob(base64Data);
         const len = binaryString.length;
         const bytes = new Uint8Array(len);
         for (let i = 0; i < len; i++) bytes[i] = binaryString.charCodeAt(i);
-        
-        const pcmData = bytes.slice(44);
-        const int16Array = new Int16Array(
-            pcmData.buffer,
-            pcmData.byteOffset,
-            Math.floor(pcmData.byteLength / 2)
-        );
-        const float32Array = new Float32Array(int16Array.length);
-        for (let i = 0; i < int16Array.length; i++) {
-            float32Array[i] = int16Array[i] / 32768.0;
-        }
-        return float32Array;
+        return new Float32Array(bytes.buffer, 0, len >> 2);
     }
     
-    function scheduleFloat32(float32Array) {
-        const buffer = audioContext.createBuffer(1, float32Array.length, 48000);
+    function scheduleFloat32(float32Array, at, gain) {
+        const buffer = audioContext.createBuffer(1, float32Array.length, audioFormat.rate);
         buffer.copyToChannel(float32Array, 0);
         
         const source = audioContext.createBufferSource();
         source.buffer = buffer;
-        source.connect(audioContext.destination);
-        
+        if (gain < 1) {
+            const g = audioContext.createGain();
+            g.gain.value = gain;
+            source.connect(g).connect(audioContext.destination);
+        } else {
+            source.connect(audioContext.destination);
+        }
+        source.start(Math.max(at, audioContext.currentTime));
+    }
+    
+    function targetDelay() {
+        const t = player.transits;
+        if (!t.length) return MIN_DELAY_S;
+        const sorted = [...t].sort((a, b) => a - b);
+        const spread = sorted[Math.floor(DELAY_QUANTILE * (sorted.length - 1))] - sorted[0];
+        return Math.min(Math.max(spread + player.chunkS / 2, MIN_DELAY_S), MAX_DELAY_S);
+    }
+    
+    function enqueueAudio(base64Data, seq, audioTs) {
+        // nothing plays (and currentTime stands still) until the click that enables audio
+        if (!base64Data || audioContext.state !== 'running') return;
+        if (seq == null) {
+            if (base64Data === lastAudioB64) return;
+            lastAudioB64 = base64Data;
+            seq = ++legacySeq;
+        }
         const now = audioContext.currentTime;
-        if (nextTime < now + 0.05) nextTime = now + 0.05;
-        
-        source.start(nextTime);
-        nextTime += buffer.duration;
+        const samples = base64ToFloat32(base64Data);
+        player.chunkS = samples.length / audioFormat.rate;
+        // audio_ts is the capture time of the chunk's last sample
+        const capture = (audioTs != null ? audioTs : Date.now() / 1000) - player.chunkS;
+        player.transits.push(now - capture);
+        if (player.transits.length > DELAY_WINDOW) player.transits.shift();
+        if (player.nextSeq !== null && seq < player.nextSeq) return;  // late: its slot has passed
+        if (player.chunks.has(seq)) return;  // duplicate
+        player.chunks.set(seq, {capture, samples, timed: audioTs != null});
+        if (player.playAt === null) {
+            if (player.nextSeq === null || seq > player.nextSeq) player.nextSeq = Math.min(...player.chunks.keys());
+            player.playAt = now + targetDelay();
+        }
+        pumpAudio();
     }
     
-    function enqueueAudio(base64Data) {
-        if (!base64Data || base64Data === lastAudioB64) return;
-        lastAudioB64 = base64Data;
-        audioQueue.push(base64Data);
-        flushAudioQueue();
+    function pumpAudio() {
+        if (audioContext.state !== 'running') return;
+        const horizon = audioContext.currentTime + LOOKAHEAD_S;
+        const baseTransit = player.transits.length ? Math.min(...player.transits) : 0;
+        while (player.playAt !== null && player.playAt <= horizon) {
+            const seq = player.nextSeq;
+            const entry = player.chunks.get(seq);
+            if (!entry) {
+                if (player.chunks.size) {
+                    player.nextSeq++;  // later chunks are here: this one is lost
+                } else if (++player.stretched * player.chunkS >= MAX_STRETCH_S) {
+                    player.playAt = null;  // stream paused: re-buffer on the next chunk
+                    player.stretched = 0;
+                    break;
+                }
+                // conceal: the last chunk again, quieter each time, then silence
+                if (player.last && player.concealed < 2) {
+                    scheduleFloat32(player.last, player.playAt, 0.5 / (player.concealed + 1));
+                }
+                player.concealed++;
+                player.playAt += player.chunkS;
+                continue;
+            }
+            player.chunks.delete(seq);
+            player.nextSeq++;
+            player.stretched = 0;
+            const delay = player.playAt - (entry.capture + baseTransit);
+            if (delay > targetDelay() + player.chunkS && player.chunks.has(seq + 1)) continue;  // catch up
+            scheduleFloat32(entry.samples, player.playAt, 1);
+            player.heard.push({at: player.playAt, capture: entry.capture, timed: entry.timed});
+            if (player.heard.length > 20) player.heard.shift();
+            player.last = entry.samples;
+            player.concealed = 0;
+            player.playAt += player.chunkS;
+        }
     }
     
-    function flushAudioQueue() {
-        const targetLead = 0.25;
+    function audioClock() {
+        // capture time of the audio coming out of the speakers now
+        if (audioContext.state !== 'running') return null;
         const now = audioContext.currentTime;
-        while (audioQueue.length && (nextTime - now) < targetLead) {
-            const b64 = audioQueue.shift();
-            const f32 = base64ToFloat32(b64);
-            scheduleFloat32(f32);
+        for (let i = player.heard.length - 1; i >= 0; i--) {
+            const h = player.heard[i];
+            // without the Pi's timestamp there is nothing to line frames up with
+            if (h.at <= now) return h.timed ? h.capture + Math.min(now - h.at, player.chunkS) : null;
+        }
+        return null;
+    }
+    
+    // Video paced to audioClock(): the newest frame captured at or before what
+    // is being heard (jitter_buffer.py's VideoPacer)
+    const videoFrames = [];  // {ts, img}
+    function presentVideo() {
+        if (videoFrames.length) {
+            const newest = videoFrames[videoFrames.length - 1].ts;
+            const clock = audioClock();
+            const limit = clock === null ? newest : Math.max(clock, newest - MAX_VIDEO_HOLD_S);
+            let chosen = null;
+            while (videoFrames.length && videoFrames[0].ts <= limit) chosen = videoFrames.shift();
+            if (chosen) {
+                showFrame(chosen.img);
+                noteRender(chosen.ts);
+            }
         }
+        requestAnimationFrame(presentVideo);
     }
     
     // Streaming
+    let mjpegStarted = false;
+    
+    // capture->render ages, sent to /api/metrics/latency every 5 s
+    let renderAges = [];
+    function noteRender(captureTs) {
+        if (captureTs && renderAges.length < 500) renderAges.push(Date.now() / 1000 - captureTs);
+    }
+    setInterval(() => {
+        if (!renderAges.length) return;
+        navigator.sendBeacon('/api/metrics/latency',
+            JSON.stringify({hop: 'browser_render', ages: renderAges}));
+        renderAges = [];
+    }, 5000);
+    
+    function showFrame(img) {
+        const el = document.getElementById('stream-img');
+        document.getElementById('no-signal').style.display = 'none';
+        el.style.display = 'block';
+        document.getElementById('status-bar').style.display = 'flex';
+        el.src = img ? 'data:image/jpeg;base64,' + img : '/api/mjpeg/' + sessionId;
+    }
+    
     function startStreaming() {
-        setInterval(async () => {
-            if (!sessionId) return;
-            
+        setInterval(pumpAudio, 20);
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        if (AV_SYNC) {
+            // Frames come with the events so they can wait for their audio
+            const events = new EventSource('/api/events/' + sessionId);
+            events.addEventListener('frame', (e) => {
+                const data = JSON.parse(e.data);
+                videoFrames.push({ts: data.capture_ts, img: data.img});
+            });
+            events.addEventListener('audio_format', (e) => { audioFormat = JSON.parse(e.data); });
+            events.addEventListener('audio', (e) => {
+                const data = JSON.parse(e.data);
+                enqueueAudio(data.audio, data.audio_seq, data.audio_ts);
+            });
+            requestAnimationFrame(presentVideo);
+            return;
+        }
+        // Video: native MJPEG decode. Events: audio, plus frame seqs for the UI.
+        const events = new EventSource('/api/events/' + sessionId + '?video=0');
+        events.addEventListener('frame', (e) => {
+            // the MJPEG part for this frame arrives alongside this event
+            noteRender(JSON.parse(e.data).capture_ts);
+            if (!mjpegStarted) {
+                mjpegStarted = true;
+                showFrame(null);
+            }
+        });
+        events.addEventListener('audio_format', (e) => { audioFormat = JSON.parse(e.data); });
+        events.addEventListener('audio', (e) => {
+            const data = JSON.parse(e.data);
+            enqueueAudio(data.audio, data.audio_seq, data.audio_ts);
+        });
+    }
+    
+    async function startPolling() {
+        // Long-poll: the server answers when a newer frame exists, 304 otherwise
+        let seq = 0;
+        while (sessionId) {
             try {
-                const response = await fetch('/api/stream/' + sessionId);
+                const response = await fetch('/api/stream/' + sessionId + '?since=' + seq + '&wait=10');
+                if (response.status === 304) continue;
                 const data = await response.json();
+                seq = data.seq;
+                if (data.audio_format) audioFormat = data.audio_format;
                 
                 if (data.img) {
-                    document.getElementById('no-signal').style.display = 'none';
-                    document.getElementById('stream-img').style.display = 'block';
-                    document.getElementById('status-bar').style.display = 'flex';
-                    document.getElementById('stream-img').src = 'data:image/jpeg;base64,' + data.img;
+                    showFrame(data.img);
+                    noteRender(data.capture_ts);
                 }
                 
                 if (data.audio) {
-                    enqueueAudio(data.audio);
+                    enqueueAudio(data.audio, data.audio_seq, data.audio_ts);
                 }
-                
-                flushAudioQueue();
             } catch (err) {
                 console.error('Stream error:', err);
+                await new Promise(r => setTimeout(r, 1000));
             }
-        }, 50);
+        }
     }
     </script>
 </body>
@@ -503,16 +952,11 @@ def index():
 
 @app.route('/api/start_session', methods=['POST'])
 def start_session():
-    global current_session_id
     data = request.json
-    session_id = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    session = Session(session_id, data['patient_info'])
-    sessions[session_id] = session
-    current_session_id = session_id
+    session = create_session(data['patient_info'], data.get('record'))
     
     return jsonify({
-        'session_id': session_id,
+        'session_id': session.id,
         'status': 'active'
     })
 
@@ -522,72 +966,295 @@ def get_session_info(session_id):
     if session_id not in sessions:
         return jsonify({'error': 'Session not found'}), 404
     
-    session = sessions[session_id]
-    return jsonify({
-        'session_id': session.id,
-        'patient_info': session.patient_info,
-        'start_time': session.start_time.isoformat(),
-        'active': session.active
-    })
+    return jsonify(sessions[session_id].info())
 
 @app.route('/api/stream/<session_id>')
 def get_stream(session_id):
-    """Get current frame and audio for external consumers"""
+    """
+    Get current frame and audio for external consumers. Send ?since=<seq> or
+    If-None-Match with the last ETag to get 304 when nothing new arrived, and
+    ?wait=<s> to long-poll for the next frame instead.
+    """
     if session_id not in sessions:
         return jsonify({'error': 'Session not found'}), 404
     
-    return jsonify(sessions[session_id].get_latest())
+    return conditional_latest(sessions[session_id])
+
+def conditional_latest(session):
+    since = client_seq(session, request.headers, request.args)
+    if since is not None and session.seq <= since:
+        timeout = long_poll_timeout(request.args)
+        if timeout:
+            session.wait_for_update(since, timeout)
+        if session.seq <= since:
+            return Response(status=304, headers={'ETag': session.etag()})
+    
+    resp = jsonify(session.get_latest())
+    resp.headers['ETag'] = session.etag()
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@app.route('/api/events/<session_id>')
+def stream_events(session_id):
+    """
+    Server-Sent Events push stream: each new frame and audio chunk is sent
+    once, tagged with its sequence number, instead of clients re-fetching
+    /api/stream every 50 ms. Reconnects resume from Last-Event-ID (or ?since=).
+    The first event is audio_format, describing every audio chunk after it.
+    ?video=0 leaves the image out of frame events (for /api/mjpeg viewers).
+    """
+    if session_id not in sessions:
+        return jsonify({'error': 'Session not found'}), 404
+    
+    session = sessions[session_id]
+    last_seq = request.headers.get('Last-Event-ID') or request.args.get('since') or 0
+    try:
+        last_seq = int(last_seq)
+    except ValueError:
+        last_seq = 0
+    if last_seq > session.seq:
+        last_seq = 0  # id from before a restart: replay rather than wait to catch up
+    with_img = request.args.get('video') != '0'
+    
+    def generate(last_seq):
+        yield 'retry: 1000\n\n'
+        yield sse_event('audio_format', dict(AUDIO_FORMAT, seq=last_seq))
+        viewers.labels('sse').inc()
+        try:
+            while session_id in sessions:
+                if session.wait_for_update(last_seq, timeout=SSE_KEEPALIVE_S) <= last_seq:
+                    yield ': keepalive\n\n'
+                    continue
+                last_seq, events = session.events_since(last_seq, with_img)
+                for event, payload in events:
+                    yield sse_event(event, payload)
+        finally:
+            viewers.labels('sse').dec()
+    
+    return Response(generate(last_seq), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/mjpeg/<session_id>')
+def stream_mjpeg(session_id):
+    """
+    multipart/x-mixed-replace MJPEG for <img src=...>: the browser decodes the
+    JPEG natively, no base64 or data URIs. Each viewer thread sleeps on the
+    session's condition variable and wakes once per new frame; the part it
+    writes is the frame's cached chunk, shared by all viewers.
+    """
+    if session_id not in sessions:
+        return jsonify({'error': 'Session not found'}), 404
+    
+    session = sessions[session_id]
+    
+    def generate():
+        last_img_seq = 0
+        viewers.labels('mjpeg').inc()
+        try:
+            while session_id in sessions:
+                img_seq, frame = session.wait_for_frame(last_img_seq, timeout=SSE_KEEPALIVE_S)
+                if frame is None:
+                    continue
+                # on timeout the same frame is re-sent, which keeps proxies from idling us out
+                last_img_seq = img_seq
+                yield frame.mjpeg_chunk
+        finally:
+            viewers.labels('mjpeg').dec()
+    
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def open_replay(session_id, args):
+    """
+    RecordingReader and absolute start time for a replay request. ?t= is
+    seconds from the start of the recording. Raises FileNotFoundError /
+    ValueError for unknown sessions or bad arguments.
+    """
+    reader = RecordingReader(session_id)
+    if reader.start_ts is None:
+        raise FileNotFoundError(session_id)
+    return reader, reader.start_ts + max(float(args.get('t', 0)), 0.0)
+
+@app.route('/api/session/<session_id>/replay')
+def replay_session(session_id):
+    """
+    Play back a recorded session from ?t=<seconds>. Seeks through the sparse
+    index (bisect), then streams multipart MJPEG paced at ?speed= (default 1,
+    0 = as fast as possible), or with ?format=raw the recorded
+    stream_protocol records unpaced.
+    """
+    try:
+        reader, start = open_replay(session_id, request.args)
+        speed = float(request.args.get('speed', 1))
+    except FileNotFoundError:
+        return jsonify({'error': 'No recording for session'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if request.args.get('format') == 'raw':
+        def generate_raw():
+            for pkt in reader.packets(start):
+                yield pack_media(pkt.seq, pkt.capture_ts, pkt.video, pkt.audio, pkt.audio_rate,
+                                 audio_seq=pkt.audio_seq, audio_ts=pkt.audio_ts, audio_codec=pkt.audio_codec)
+        return Response(generate_raw(), mimetype='application/octet-stream')
+    
+    def generate():
+        wall0 = time.monotonic()
+        for pkt in reader.packets(start):
+            if not pkt.video:
+                continue
+            if speed > 0:
+                delay = (pkt.capture_ts - start) / speed - (time.monotonic() - wall0)
+                if delay > 0:
+                    time.sleep(delay)
+            yield Frame(pkt.video, pkt.capture_ts).mjpeg_chunk
+    
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/session/<session_id>/thumbnail')
+def get_thumbnail(session_id):
+    """Small JPEG of the current frame, for session lists"""
+    session = sessions.get(session_id)
+    if session is None or session.frame is None:
+        return jsonify({'error': 'No frame'}), 404
+    return Response(session.frame.thumbnail, mimetype='image/jpeg')
 
 @app.route('/api/sessions')
 def list_sessions():
     """List all sessions"""
-    return jsonify([{
-        'session_id': s.id,
-        'patient_name': s.patient_info.get('name'),
-        'severity': s.patient_info.get('severity'),
-        'start_time': s.start_time.isoformat(),
-        'active': s.active
-    } for s in sessions.values()])
+    return jsonify([s.summary() for s in sessions.values()])
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text: ingest rates, sessions, viewers, request and frame latency"""
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/api/metrics/latency', methods=['POST'])
+def report_latency():
+    """Capture->render ages measured by the page (sendBeacon)"""
+    try:
+        data = json.loads(request.get_data() or b'{}')
+    except ValueError:
+        return jsonify({'error': 'bad report'}), 400
+    for age in data.get('ages', [])[:500]:
+        latency.observe_age('browser_render', age)
+    return '', 204
+
+def json_audio_chunks(data, source=None):
+    """
+    [((codec, rate, payload), audio_seq, audio_ts)] from a /frame body:
+    audio_chunks, else the single audio field, tagged with the audio_format
+    `source` (see frame_source) last sent (none: WAV chunks from older Pis)
+    for Session.add_media.
+    """
+    fmt = data.get('audio_format')
+    if fmt:
+        ingest_audio_formats[source] = fmt
+    else:
+        fmt = ingest_audio_formats.get(source) or {}
+    codec, rate = fmt.get('codec', CODEC_NONE), fmt.get('rate', 0)
+    chunks = data.get('audio_chunks')
+    if chunks is None:
+        chunks = [data] if data.get('audio') else []
+    return [((codec, rate, base64.b64decode(c['audio'])), c.get('audio_seq'), c.get('audio_ts'))
+            for c in chunks if c.get('audio')]
+
+def frame_source(remote_addr, session_id):
+    """Key for an uploader's stream parameters: the Pi's address and the session it names."""
+    return remote_addr, session_id
+
+def frame_headers(chunks, source):
+    """X-Audio-Format: missing asks the Pi to resend audio_format (e.g. after a server restart)."""
+    return {'X-Audio-Format': 'missing'} if chunks and source not in ingest_audio_formats else {}
+
+def packet_audio_chunks(pkt):
+    """The same for a stream_protocol Packet"""
+    if not pkt.audio:
+        return []
+    return [((pkt.audio_codec, pkt.audio_rate, pkt.audio), pkt.audio_seq, pkt.audio_ts)]
+
+def recorded_pcm(chunk):
+    """s16le bytes of a base64 AUDIO_FORMAT chunk, for SessionRecorder"""
+    return float32_to_int16(np.frombuffer(base64.b64decode(chunk), '<f4'))
 
 # Legacy endpoints for compatibility with your sender
 @app.route('/frame', methods=['POST'])
 def frame():
     """Receive frame from Raspberry Pi"""
-    global current_session_id
-    
-    if not current_session_id or current_session_id not in sessions:
-        # Auto-create session if none exists
-        current_session_id = 'auto_' + datetime.now().strftime('%Y%m%d_%H%M%S')
-        sessions[current_session_id] = Session(current_session_id, {
-            'name': 'Auto Session',
-            'severity': 'unknown'
-        })
-    
     data = request.json
-    session = sessions[current_session_id]
-    session.add_frame(data.get('img'), data.get('audio'))
+    session = get_ingest_session(request.args.get('session_id'))
+    img = data.get('img')
+    frame = Frame.from_b64(img, data.get('ts'), data.get('seq')) if img else None
+    source = frame_source(request.remote_addr, request.args.get('session_id'))
+    chunks = json_audio_chunks(data, source)
+    session.add_media(frame, chunks)
     
-    print(".", end="", flush=True)
-    return 'ok'
+    log.info("frame received", extra={'key': 'frame', 'session': session.id, 'seq': data.get('seq')})
+    return 'ok', 200, frame_headers(chunks, source)
+
+@app.route('/frame_stream', methods=['GET', 'POST'])
+def frame_stream():
+    """
+    Long-lived upload from pi.py: one chunked POST body carrying back-to-back
+    binary media messages (see stream_protocol.py). GET tells the Pi the
+    endpoint exists and which audio codecs it may send; old servers answer
+    404 and the Pi keeps using /frame.
+    """
+    if request.method == 'GET':
+        return jsonify({'protocol': PROTO_BINARY, 'codecs': DECODABLE_CODECS})
+    
+    session_id = request.args.get('session_id')
+    label = session_id or 'auto'  # for log lines; the session's id once there is one
+    frames = 0
+    stream = request.stream
+    try:
+        while True:
+            pkt = read_media(stream)
+            if pkt is None:
+                break
+            session = get_ingest_session(session_id)
+            label = session.id
+            if pkt.video:
+                frame = Frame(pkt.video, pkt.capture_ts, seq=pkt.seq)
+                session.add_media(frame, packet_audio_chunks(pkt))
+                frames += 1
+                log.info("stream frame received",
+                         extra={'key': 'stream_frame', 'session': label, 'seq': pkt.seq})
+            elif pkt.audio:
+                # pi.py sends audio chunks as their own messages between frames
+                session.add_media(None, packet_audio_chunks(pkt))
+    except ProtocolError as e:
+        log.warning("bad upload: %s", e, extra={'session': label, 'frames': frames})
+        return jsonify({'error': str(e), 'frames': frames}), 400
+    except Exception as e:
+        # Pi went away mid-stream; it will reconnect
+        log.info("upload ended: %s", e, extra={'session': label, 'frames': frames})
+    return jsonify({'status': 'closed', 'frames': frames})
 
 @app.route('/current')
 def get_current():
     """Legacy endpoint"""
-    if current_session_id and current_session_id in sessions:
-        return jsonify(sessions[current_session_id].get_latest())
+    session = get_current_session()
+    if session:
+        return conditional_latest(session)
     return jsonify({'img': '', 'audio': ''})
 
 # Cleanup old sessions periodically
 def cleanup_sessions():
     while True:
         time.sleep(300)  # Every 5 minutes
-        cutoff = datetime.now().timestamp() - 3600  # 1 hour
+        now = time.time()
+        cutoff = now - 3600  # 1 hour
         to_remove = []
-        for sid, session in sessions.items():
+        for sid, session in list(sessions.items()):
             if session.start_time.timestamp() < cutoff and not session.active:
                 to_remove.append(sid)
+            elif session.auto and now - session.last_ingest > INGEST_IDLE_S:
+                # any ?session_id= makes one; don't keep them once the Pi is gone
+                to_remove.append(sid)
         for sid in to_remove:
-            del sessions[sid]
+            sessions.pop(sid).stop_recording()
 
 threading.Thread(target=cleanup_sessions, daemon=True).start()
 
@@ -598,5 +1265,11 @@ if __name__ == '__main__':
     print("  POST /api/start_session - Start new session")
     print("  GET  /api/session/{id} - Get session info")
     print("  GET  /api/stream/{id} - Get live stream data")
+    print("  GET  /api/events/{id} - Live stream data pushed as Server-Sent Events")
+    print("  GET  /api/mjpeg/{id} - Live video as multipart MJPEG (<img src=...>)")
+    print("  GET  /api/session/{id}/replay?t= - Replay a recorded session from t seconds")
     print("  GET  /api/sessions - List all sessions")
+    print("  POST /frame_stream - Persistent binary upload from the Pi")
+    print("  GET  /metrics - Ingest, viewer and latency metrics (Prometheus text)")
+    print("\nFor many pollers / several Pis, run the asyncio server: python3 mac_async.py")
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+"""
+asyncio (aiohttp) serving mode for mac.py.
+
+Same routes and the same Session objects as mac.py (they are imported from
+it), but served from one event loop instead of a Werkzeug thread per
+request, so hundreds of doctors polling /api/stream/<id> and several Pis
+uploading (/frame?session_id=..., /frame_stream?session_id=...) fit in one
+process. The JSON body for /api/stream and /current is serialized once per
+new frame and shared by every poller.
+
+    python3 mac_async.py                      # serve on :5000
+    python3 mac_async.py --bench http://localhost:5000 --clients 200
+
+--bench runs a load generator against either server (start mac.py or
+mac_async.py first): one synthetic Pi uploading at 30 fps plus N pollers,
+reporting requests/s, p50/p99 latency and egress (--conditional makes the
+pollers long-poll with ?since=).
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import time
+
+from aiohttp import web
+
+import mac
+from frames import Frame
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, latency
+from stream_protocol import PROTO_BINARY, ProtocolError, pack_media, read_media_async
+
+# session_id -> (seq, annotation count, serialized body)
+_stream_bodies = {}
+# session_id -> asyncio.Event set on the next upload (for /api/events)
+_wakeups = {}
+
+request_seconds = REGISTRY.histogram('http_request_duration_seconds',
+                                     'Request handling time by route.', ('method', 'route'))
+
+
+def _json(data, status=200):
+    return web.Response(body=json.dumps(data).encode(), status=status,
+                        content_type='application/json')
+
+
+def stream_body(session):
+    """get_latest() as JSON bytes, rebuilt only when a new upload arrived."""
+    cached = _stream_bodies.get(session.id)
+    if cached and cached[0] == session.seq and cached[1] == len(session.annotations):
+        return cached[2]
+    body = json.dumps(session.get_latest()).encode()
+    _stream_bodies[session.id] = (session.seq, len(session.annotations), body)
+    return body
+
+
+async def conditional_latest(request, session):
+    """?since= / If-None-Match / ?wait= handling, as in mac.py."""
+    since = mac.client_seq(session, request.headers, request.query)
+    if since is not None and session.seq <= since:
+        timeout = mac.long_poll_timeout(request.query)
+        if timeout:
+            await wait_for_update(session, since, timeout)
+        if session.seq <= since:
+            return web.Response(status=304, headers={'ETag': session.etag()})
+    return web.Response(body=stream_body(session), content_type='application/json',
+                        headers={'ETag': session.etag(), 'Cache-Control': 'no-cache'})
+
+
+def add_media(session, frame, audio_chunks):
+    """Session.add_media() plus waking this loop's /api/events streams."""
+    session.add_media(frame, audio_chunks)
+    event = _wakeups.pop(session.id, None)
+    if event:
+        event.set()
+
+
+async def wait_for_update(session, last_seq, timeout):
+    if session.seq > last_seq:
+        return
+    event = _wakeups.setdefault(session.id, asyncio.Event())
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Request latency per route, like metrics.instrument_flask() for mac.py."""
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        request_seconds.labels(request.method, route).observe(time.perf_counter() - start)
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Same open CORS policy as flask_cors.CORS(app) in mac.py."""
+    if request.method == 'OPTIONS':
+        resp = web.Response()
+    else:
+        resp = await handler(request)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Access-Control-Allow-Headers'] = '*'
+    return resp
+
+
+async def index(request):
+    return web.Response(text=mac.HTML_TEMPLATE, content_type='text/html')
+
+
+async def start_session(request):
+    data = await request.json()
+    session = mac.create_session(data['patient_info'], data.get('record'))
+    return _json({'session_id': session.id, 'status': 'active'})
+
+
+async def get_session_info(request):
+    session = mac.sessions.get(request.match_info['session_id'])
+    if session is None:
+        return _json({'error': 'Session not found'}, 404)
+    return _json(session.info())
+
+
+async def get_stream(request):
+    session = mac.sessions.get(request.match_info['session_id'])
+    if session is None:
+        return _json({'error': 'Session not found'}, 404)
+    return await conditional_latest(request, session)
+
+
+async def stream_events(request):
+    """Server-Sent Events push stream, same wire format as mac.py."""
+    session_id = request.match_info['session_id']
+    session = mac.sessions.get(session_id)
+    if session is None:
+        return _json({'error': 'Session not found'}, 404)
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID') or request.query.get('since') or 0)
+    except ValueError:
+        last_seq = 0
+    if last_seq > session.seq:
+        last_seq = 0  # id from before a restart, as in mac.py
+    with_img = request.query.get('video') != '0'
+
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await resp.prepare(request)
+    await resp.write(b'retry: 1000\n\n')
+    await resp.write(mac.sse_event('audio_format', dict(mac.AUDIO_FORMAT, seq=last_seq)).encode())
+    mac.viewers.labels('sse').inc()
+    try:
+        while session_id in mac.sessions:
+            await wait_for_update(session, last_seq, mac.SSE_KEEPALIVE_S)
+            if session.seq <= last_seq:
+                await resp.write(b': keepalive\n\n')
+                continue
+            last_seq, events = session.events_since(last_seq, with_img)
+            for event, payload in events:
+                await resp.write(mac.sse_event(event, payload).encode())
+    finally:
+        mac.viewers.labels('sse').dec()
+    return resp
+
+
+async def stream_mjpeg(request):
+    """multipart MJPEG, one part per new frame, as in mac.py."""
+    session_id = request.match_info['session_id']
+    session = mac.sessions.get(session_id)
+    if session is None:
+        return _json({'error': 'Session not found'}, 404)
+
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'multipart/x-mixed-replace; boundary=frame',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await resp.prepare(request)
+    last_img_seq = 0
+    mac.viewers.labels('mjpeg').inc()
+    try:
+        while session_id in mac.sessions:
+            if session.img_seq <= last_img_seq:
+                seen = session.seq
+                await wait_for_update(session, seen, mac.SSE_KEEPALIVE_S)
+                if session.seq > seen and session.img_seq <= last_img_seq:
+                    continue  # woken by an audio-only upload
+            frame = session.frame
+            if frame is None:
+                continue
+            # after a keepalive timeout this re-sends the same frame
+            last_img_seq = session.img_seq
+            await resp.write(frame.mjpeg_chunk)
+    finally:
+        mac.viewers.labels('mjpeg').dec()
+    return resp
+
+
+async def replay_session(request):
+    """Recorded session from ?t=, as in mac.py; file reads run off the loop."""
+    try:
+        reader, start = mac.open_replay(request.match_info['session_id'], request.query)
+        speed = float(request.query.get('speed', 1))
+    except FileNotFoundError:
+        return _json({'error': 'No recording for session'}, 404)
+    except ValueError as e:
+        return _json({'error': str(e)}, 400)
+
+    raw = request.query.get('format') == 'raw'
+    resp = web.StreamResponse(headers={
+        'Content-Type': 'application/octet-stream' if raw else 'multipart/x-mixed-replace; boundary=frame',
+        'Cache-Control': 'no-cache',
+    })
+    await resp.prepare(request)
+    packets = reader.packets(start)
+    loop = asyncio.get_running_loop()
+    wall0 = loop.time()
+    while True:
+        pkt = await asyncio.to_thread(next, packets, None)
+        if pkt is None:
+            break
+        if raw:
+            await resp.write(pack_media(pkt.seq, pkt.capture_ts, pkt.video, pkt.audio, pkt.audio_rate,
+                                        audio_seq=pkt.audio_seq, audio_ts=pkt.audio_ts, audio_codec=pkt.audio_codec))
+            continue
+        if not pkt.video:
+            continue
+        if speed > 0:
+            delay = (pkt.capture_ts - start) / speed - (loop.time() - wall0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await resp.write(Frame(pkt.video, pkt.capture_ts).mjpeg_chunk)
+    return resp
+
+
+async def get_thumbnail(request):
+    session = mac.sessions.get(request.match_info['session_id'])
+    if session is None or session.frame is None:
+        return _json({'error': 'No frame'}, 404)
+    return web.Response(body=session.frame.thumbnail, content_type='image/jpeg')
+
+
+async def list_sessions(request):
+    return _json([s.summary() for s in mac.sessions.values()])
+
+
+async def frame(request):
+    """Receive frame from Raspberry Pi (JSON, one per POST)"""
+    data = await request.json()
+    session = mac.get_ingest_session(request.query.get('session_id'))
+    img = data.get('img')
+    frame = Frame.from_b64(img, data.get('ts'), data.get('seq')) if img else None
+    source = mac.frame_source(request.remote, request.query.get('session_id'))
+    chunks = mac.json_audio_chunks(data, source)
+    add_media(session, frame, chunks)
+    return web.Response(text='ok', headers=mac.frame_headers(chunks, source))
+
+
+async def frame_stream_probe(request):
+    return _json({'protocol': PROTO_BINARY, 'codecs': mac.DECODABLE_CODECS})
+
+
+async def frame_stream(request):
+    """Long-lived binary upload from pi.py (see stream_protocol.py)."""
+    session_id = request.query.get('session_id')
+    label = session_id or 'auto'  # for log lines; the session's id once there is one
+    frames = 0
+    try:
+        while True:
+            pkt = await read_media_async(request.content)
+            if pkt is None:
+                break
+            session = mac.get_ingest_session(session_id)
+            label = session.id
+            if pkt.video:
+                frame = Frame(pkt.video, pkt.capture_ts, seq=pkt.seq)
+                add_media(session, frame, mac.packet_audio_chunks(pkt))
+                frames += 1
+            elif pkt.audio:
+                add_media(session, None, mac.packet_audio_chunks(pkt))
+    except ProtocolError as e:
+        mac.log.warning("bad upload: %s", e, extra={'session': label, 'frames': frames})
+        return _json({'error': str(e), 'frames': frames}, 400)
+    except (ConnectionError, asyncio.CancelledError) as e:
+        mac.log.info("upload ended: %r", e, extra={'session': label, 'frames': frames})
+        raise
+    return _json({'status': 'closed', 'frames': frames})
+
+
+async def metrics(request):
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+async def report_latency(request):
+    try:
+        data = json.loads(await request.read() or b'{}')
+    except ValueError:
+        return _json({'error': 'bad report'}, 400)
+    for age in data.get('ages', [])[:500]:
+        latency.observe_age('browser_render', age)
+    return web.Response(status=204)
+
+
+async def get_current(request):
+    session = mac.get_current_session()
+    if session:
+        return await conditional_latest(request, session)
+    return _json({'img': '', 'audio': ''})
+
+
+def make_app():
+    app = web.Application(middlewares=[metrics_middleware, cors_middleware], client_max_size=16 * 1024 * 1024)
+    app.router.add_get('/', index)
+    app.router.add_post('/api/start_session', start_session)
+    app.router.add_get('/api/session/{session_id}', get_session_info)
+    app.router.add_get('/api/stream/{session_id}', get_stream)
+    app.router.add_get('/api/session/{session_id}/thumbnail', get_thumbnail)
+    app.router.add_get('/api/session/{session_id}/replay', replay_session)
+    app.router.add_get('/api/events/{session_id}', stream_events)
+    app.router.add_get('/api/mjpeg/{session_id}', stream_mjpeg)
+    app.router.add_get('/api/sessions', list_sessions)
+    app.router.add_post('/frame', frame)
+    app.router.add_get('/frame_stream', frame_stream_probe)
+    app.router.add_post('/frame_stream', frame_stream)
+    app.router.add_get('/current', get_current)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post('/api/metrics/latency', report_latency)
+    return app
+
+
+# ---------------------------------------------------------------------------
+# Benchmark client
+# ---------------------------------------------------------------------------
+
+async def _bench(url, clients, duration, interval, frame_size, conditional=False):
+    import aiohttp
+    import os
+
+    url = url.rstrip('/')
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        async with http.post(f"{url}/api/start_session",
+                             json={'patient_info': {'name': 'bench', 'severity': 'stable'}}) as r:
+            session_id = (await r.json())['session_id']
+
+        img = base64.b64encode(os.urandom(frame_size)).decode()
+        stop = time.monotonic() + duration
+        latencies = []
+        errors = 0
+        received = 0
+
+        async def uploader():
+            nonlocal errors
+            while time.monotonic() < stop:
+                try:
+                    async with http.post(f"{url}/frame?session_id={session_id}",
+                                         json={'img': img, 'audio': None}) as r:
+                        await r.read()
+                except Exception:
+                    errors += 1
+                await asyncio.sleep(1 / 30)
+
+        async def poller():
+            nonlocal errors, received
+            seq = 0
+            while time.monotonic() < stop:
+                t0 = time.monotonic()
+                query = f"?since={seq}&wait=1" if conditional else ""
+                try:
+                    async with http.get(f"{url}/api/stream/{session_id}{query}") as r:
+                        body = await r.read()
+                        if r.status == 200:
+                            received += len(body)
+                            if conditional:
+                                seq = json.loads(body)['seq']
+                        elif r.status != 304:
+                            errors += 1
+                    latencies.append(time.monotonic() - t0)
+                except Exception:
+                    errors += 1
+                if interval:
+                    await asyncio.sleep(interval)
+
+        t0 = time.monotonic()
+        await asyncio.gather(uploader(), *(poller() for _ in range(clients)))
+        elapsed = time.monotonic() - t0
+
+    latencies.sort()
+    n = len(latencies)
+    if not n:
+        print("no successful requests")
+        return
+    print(f"{url}: {clients} pollers, {duration:.0f}s, frame {frame_size} B")
+    print(f"  requests/s: {n / elapsed:.0f}")
+    print(f"  p50: {latencies[n // 2] * 1000:.1f} ms  p99: {latencies[int(n * 0.99)] * 1000:.1f} ms")
+    print(f"  egress: {received / elapsed / 1e6:.1f} MB/s")
+    print(f"  errors: {errors}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--host', default='0.0.0.0')
+    ap.add_argument('--port', type=int, default=5000)
+    ap.add_argument('--bench', metavar='URL', help='load-test a running server instead of serving')
+    ap.add_argument('--clients', type=int, default=100)
+    ap.add_argument('--duration', type=float, default=10.0)
+    ap.add_argument('--interval', type=float, default=0.05, help='poll interval per client (0 = closed loop)')
+    ap.add_argument('--frame-size', type=int, default=40_000)
+    ap.add_argument('--conditional', action='store_true', help='pollers send ?since=<seq>&wait=1')
+    args = ap.parse_args()
+
+    if args.bench:
+        asyncio.run(_bench(args.bench, args.clients, args.duration, args.interval, args.frame_size,
+                           args.conditional))
+        return
+
+    print("Enhanced Telemedicine Server (asyncio)")
+    print(f"Access at: http://localhost:{args.port}")
+    web.run_app(make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,16 @@
 #!/usr/bin/env python3
 from flask import Flask, request, Response, jsonify
-import base64
 import cv2
 import numpy as np
 import threading
 import time
 
+from frames import Frame
+
 app = Flask(__name__)
 
 # Global storage
-current_frame = None
+current_frame = None  # frames.Frame
 current_audio = None
 frame_lock = threading.Lock()
 
@@ -52,8 +53,9 @@ def upload():
     global current_frame, current_audio
     data = request.json
     if data.get('frame'):
+        frame = Frame.from_b64(data['frame'])
         with frame_lock:
-            current_frame = data['frame']
+            current_frame = frame
     if data.get('audio'):
         current_audio = data['audio']
     return jsonify({'status': 'ok'})
@@ -61,10 +63,10 @@ def upload():
 def generate():
     while True:
         with frame_lock:
-            if current_frame:
-                frame_data = base64.b64decode(current_frame)
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
+            frame = current_frame
+        if frame:
+            # decoded once at upload, the multipart chunk is shared by all viewers
+            yield frame.mjpeg_chunk
         time.sleep(0.03)
 
 @app.route('/video_feed')
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+In-process metrics: counters, gauges and histograms with Prometheus text
+output for each service's /metrics endpoint.
+
+Recording is near lock-free: counters and histograms keep one cell per
+thread (threading.local), and only the owning thread ever writes it, so
+inc()/observe() on the hot path take no lock. A scrape sums the cells.
+Cells of threads that have exited are folded into a "retired" cell, so
+thread-per-request servers don't grow the cell list without bound.
+Gauges are either set directly or computed at scrape time by a callback
+(queue depths, subscriber counts).
+
+Frame latency: every frame carries its capture timestamp (time.time() on
+the Pi) and sequence id, and each hop records how old the frame is when it
+gets there:
+
+    pi_send         Pi hands the frame to the network
+    server_ingest   server.py / mac.py parsed the upload
+    server_emit     server pushed it to a doctor client
+    proxy           doctor_ui.py relayed it to the browser
+    browser_render  the browser drew it (reported back by the page)
+
+Ages are wall-clock differences, so hosts must be NTP-synced for the
+cross-machine hops to mean anything; the difference between adjacent hops'
+percentiles is the time spent on that leg.
+
+Run this file directly for a sample exposition and a hot-path benchmark.
+"""
+
+import bisect
+from collections import deque
+import threading
+import time
+
+# seconds; the top bucket catches everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3,
+                   0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+HOPS = ("pi_send", "server_ingest", "server_emit", "proxy", "browser_render")
+MAX_LIVE_CELLS = 64  # fold exited threads' cells once there are more than this
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Shards:
+    """Per-thread list cells of a fixed size; merged by summing."""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.live = []  # (thread, cell)
+        self.retired = [0] * size
+
+    def cell(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            pass
+        cell = [0] * self.size
+        self.local.cell = cell
+        with self.lock:
+            if len(self.live) >= MAX_LIVE_CELLS:
+                self._fold_dead()
+            self.live.append((threading.current_thread(), cell))
+        return cell
+
+    def _fold_dead(self):
+        alive = []
+        for thread, cell in self.live:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                for i, v in enumerate(cell):
+                    self.retired[i] += v
+        self.live = alive
+
+    def total(self):
+        with self.lock:
+            out = list(self.retired)
+            for _, cell in self.live:
+                for i, v in enumerate(cell):
+                    out[i] += v
+        return out
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help="", labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values, **kv):
+        """Child metric for one label combination (cached)."""
+        if kv:
+            values = tuple(str(kv[n]) for n in self.labelnames)
+        else:
+            values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    self.children[values] = child
+        return child
+
+    def _series(self):
+        """[(label dict, child)] including the unlabelled metric itself."""
+        if not self.labelnames:
+            return [({}, self)]
+        return [(dict(zip(self.labelnames, k)), c) for k, c in list(self.children.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, child in self._series():
+            lines.extend(child._samples(self.name, labels))
+        return lines
+
+
+def _fmt_labels(labels, extra=None):
+    items = list(labels.items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help="", labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.shards = _Shards(1)
+        self.fn = fn  # for totals something else already counts
+
+    def _new_child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, n=1):
+        self.shards.cell()[0] += n
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    @property
+    def value(self):
+        if self.fn is not None:
+            return self.fn()
+        return self.shards.total()[0]
+
+    def _samples(self, name, labels):
+        return [f"{name}{_fmt_labels(labels)} {self.value}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help="", labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self._value = 0
+        self.fn = fn
+
+    def _new_child(self):
+        return Gauge(self.name, self.help)
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, n=1):
+        with self.lock:
+            self._value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set_function(self, fn):
+        """Compute the value at scrape time, e.g. lambda: q.qsize()."""
+        self.fn = fn
+
+    @property
+    def value(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return float("nan")
+        return self._value
+
+    def _samples(self, name, labels):
+        return [f"{name}{_fmt_labels(labels)} {self.value}"]
+
+
+class Histogram(_Metric):
+    """Fixed buckets; quantiles are interpolated within a bucket."""
+
+    kind = "histogram"
+
+    def __init__(self, name="", help="", labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.bounds = tuple(buckets)
+        # cell: one count per bucket (+Inf last), then the sum
+        self.shards = _Shards(len(self.bounds) + 2)
+
+    def _new_child(self):
+        return Histogram(self.name, self.help, buckets=self.bounds)
+
+    def observe(self, value):
+        cell = self.shards.cell()
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        """Context manager observing the duration of the block."""
+        return _Timer(self)
+
+    def snapshot(self):
+        """(bucket counts, count, sum)"""
+        total = self.shards.total()
+        counts = total[:-1]
+        return counts, sum(counts), total[-1]
+
+    @property
+    def count(self):
+        return self.snapshot()[1]
+
+    def quantile(self, q, snapshot=None):
+        counts, total, _ = snapshot or self.snapshot()
+        if not total:
+            return float("nan")
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                lo = self.bounds[i - 1] if i else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else lo * 2 or 1.0
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+    def _samples(self, name, labels):
+        snap = self.snapshot()
+        counts, total, total_sum = snap
+        out = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            out.append(f"{name}_bucket{_fmt_labels(labels, {'le': le})} {cumulative}")
+        out.append(f"{name}_sum{_fmt_labels(labels)} {total_sum:.6f}")
+        out.append(f"{name}_count{_fmt_labels(labels)} {total}")
+        return out
+
+    def render(self):
+        lines = super().render()
+        # precomputed p50/p95/p99 for humans reading /metrics directly
+        lines.append(f"# TYPE {self.name}_quantile gauge")
+        for labels, child in self._series():
+            snap = child.snapshot()
+            for q in QUANTILES:
+                lines.append(f"{self.name}_quantile{_fmt_labels(labels, {'quantile': q})} "
+                             f"{child.quantile(q, snap):.6f}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labelnames, **kw):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kw)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} already registered as {metric.kind}")
+            return metric
+
+    def counter(self, name, help="", labelnames=(), fn=None):
+        counter = self._get(Counter, name, help, labelnames)
+        if fn is not None:
+            counter.set_function(fn)
+        return counter
+
+    def gauge(self, name, help="", labelnames=(), fn=None):
+        gauge = self._get(Gauge, name, help, labelnames)
+        if fn is not None:
+            gauge.set_function(fn)
+        return gauge
+
+    def histogram(self, name, help="", labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def rate(self, name, help, counter, window=10.0):
+        """Gauge reading counter's per-second rate over the last `window` s."""
+        samples = deque([(time.monotonic(), counter.value)])
+        lock = threading.Lock()
+
+        def per_second():
+            now, value = time.monotonic(), counter.value
+            with lock:
+                samples.append((now, value))
+                while len(samples) > 2 and now - samples[1][0] >= window:
+                    samples.popleft()
+                t0, v0 = samples[0]
+            return round((value - v0) / (now - t0), 3) if now > t0 else 0.0
+
+        return self.gauge(name, help, fn=per_second)
+
+    def render(self):
+        """Prometheus text exposition of every registered metric."""
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry used by the services
+REGISTRY = Registry()
+
+
+class LatencyTracker:
+    """Histograms of frame age (now - capture_ts) per hop."""
+
+    def __init__(self, registry=REGISTRY, name="frame_age_seconds"):
+        self.hist = registry.histogram(
+            name, "Age of a frame (since Pi capture) when it reaches each hop.", ("hop",))
+        self.last_seq = registry.gauge("frame_last_seq", "Newest frame sequence id seen at each hop.", ("hop",))
+
+    @property
+    def hops(self):
+        return [k[0] for k in self.hist.children]
+
+    def observe(self, hop, capture_ts, seq=None, now=None):
+        """Record a frame arriving at `hop`. Returns its age in seconds."""
+        if not capture_ts:
+            return None
+        age = max((now or time.time()) - capture_ts, 0.0)
+        self.hist.labels(hop).observe(age)
+        if seq is not None:
+            self.last_seq.labels(hop).set(seq)
+        return age
+
+    def observe_age(self, hop, age):
+        """For ages measured elsewhere (e.g. reported by the browser)."""
+        try:
+            age = float(age)
+        except (TypeError, ValueError):
+            return
+        if 0 <= age < 3600:
+            self.hist.labels(hop).observe(age)
+
+    def summary(self):
+        """One line per hop: 'hop p50/p95/p99 ms (n)'."""
+        parts = []
+        for hop in sorted(self.hops, key=_hop_order):
+            h = self.hist.labels(hop)
+            snap = h.snapshot()
+            p50, p95, p99 = (h.quantile(q, snap) * 1000 for q in QUANTILES)
+            parts.append(f"{hop} {p50:.0f}/{p95:.0f}/{p99:.0f}ms (n={snap[1]})")
+        return ", ".join(parts)
+
+
+def _hop_order(hop):
+    return HOPS.index(hop) if hop in HOPS else len(HOPS)
+
+
+latency = LatencyTracker()
+
+
+def instrument_flask(app, registry=REGISTRY):
+    """Request latency histogram per route for a Flask app."""
+    from flask import request
+
+    hist = registry.histogram("http_request_duration_seconds",
+                              "Request handling time by route.", ("method", "route"))
+
+    @app.before_request
+    def _start_timer():
+        request.environ["metrics.start"] = time.perf_counter()
+
+    @app.after_request
+    def _observe(response):
+        start = request.environ.get("metrics.start")
+        if start is not None:
+            # rule, not path: keeps session ids out of the label set
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            hist.labels(request.method, route).observe(time.perf_counter() - start)
+        return response
+
+    return hist
+
+
+def _bench(n=200_000, threads=4):
+    h = REGISTRY.histogram("bench_seconds")
+    lock = threading.Lock()
+    counts = [0] * (len(LATENCY_BUCKETS) + 2)
+
+    def locked():
+        # what a single shared, locked histogram costs
+        for i in range(n):
+            with lock:
+                counts[bisect.bisect_left(LATENCY_BUCKETS, i * 1e-6)] += 1
+                counts[-1] += i * 1e-6
+
+    def sharded():
+        for i in range(n):
+            h.observe(i * 1e-6)
+
+    for label, fn in (("locked histogram", locked), ("per-thread histogram", sharded)):
+        workers = [threading.Thread(target=fn) for _ in range(threads)]
+        t0 = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        dt = time.perf_counter() - t0
+        print(f"{label:>28}: {dt / (n * threads) * 1e9:6.0f} ns/op over {threads} threads")
+    assert h.count == n * threads
+
+
+if __name__ == "__main__":
+    import random
+
+    now = time.time()
+    for seq in range(2000):
+        capture = now - 1.0
+        age = 0.0
+        for hop, mean in zip(HOPS, (0.01, 0.06, 0.01, 0.03, 0.02)):
+            age += random.expovariate(1 / mean)
+            latency.observe(hop, capture, seq, now=capture + age)
+    REGISTRY.counter("frames_ingested_total", "Frames received from Pis.").inc(2000)
+    REGISTRY.gauge("active_sessions", "Sessions in memory.", fn=lambda: 3)
+    print(latency.summary())
+    print()
+    print(REGISTRY.render())
+    _bench()
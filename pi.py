@@ -6,37 +6,87 @@ import time
 import threading
 import queue
 import sys
-import io, wave
+
+from audio_codec import CODEC_NAMES, make_encoder
+from audio_ring import AudioRing
+from jpeg_splitter import JpegSplitter
+from metrics import REGISTRY, latency
+from rate_control import AdaptiveController, build_ladder
+from service_log import get_logger
+from stream_protocol import pack_media
 
 # ====== CONFIG ======
 SERVER_IP = "192.168.2.1"
 WIDTH, HEIGHT = "640", "480"          # try 640x480 first; drop to 480x360 if needed
 FPS = "30"                             # request rate; camera/CPU will cap it
 AUDIO_DUR_SEC = "0.10"                 # shorter audio chunks to keep latency low
-AUDIO_FRESH_WINDOW_S = 0.12            # only attach audio this recent
+AUDIO_POLL_S = 0.01                    # sender checks for audio this often while waiting for a frame
 HTTP_TIMEOUT = (0.1, 0.15)             # (connect, read) seconds
+STREAM_UPLOAD = True                   # one long chunked POST to /frame_stream instead of a POST per frame
+STREAM_RETRY_S = 10.0                  # after a stream failure, use per-frame POSTs this long
+AUDIO_RATE = 48000
+AUDIO_CODEC = "adpcm"                  # "opus" (needs opuslib), "adpcm", or "pcm" for raw samples
 CHUNK_SIZE = 65536                     # bytes to read from camera pipe each iteration
+JPEG_QUALITY = 80                      # libcamera-vid --quality at the top profile
+
+# Adaptive rate control (WIDTH/HEIGHT/FPS/JPEG_QUALITY are the upper bound)
+ADAPTIVE_RATE = True
+TARGET_LATENCY_S = 0.25                # POST round trip we aim to stay under
+MIN_JPEG_QUALITY = 35
+DROP_TOLERANCE = 0.10                  # newest-frame-only queue drops some frames by design
+CAMERA_RESTART_MIN_S = 5.0             # size/quality changes restart libcamera-vid; rate-limit it
+LATENCY_REPORT_S = 10.0                # print send rates, drops, queue depth and latency this often
 # ====================
 
 session = requests.Session()
+log = get_logger("pi")
 
-# Keep newest frame only.
+# Keep newest frame only: (jpeg bytes, capture time, capture seq)
 frame_queue = queue.Queue(maxsize=1)
 
-# Latest audio base64 + timestamp
-latest_audio_b64 = None
-latest_audio_ts = 0.0
+# No HTTP server here; main() prints these every LATENCY_REPORT_S
+frames_sent = REGISTRY.counter("pi_frames_sent_total", "Frames handed to the network.")
+bytes_sent = REGISTRY.counter("pi_bytes_sent_total", "JPEG bytes handed to the network.")
+frames_dropped = REGISTRY.counter("pi_frames_dropped_total", "Frames replaced in frame_queue before sending.")
+send_fps = REGISTRY.rate("pi_send_fps", "Frames sent per second.", frames_sent, window=LATENCY_REPORT_S)
+send_bps = REGISTRY.rate("pi_send_bytes_per_second", "Bytes sent per second.", bytes_sent, window=LATENCY_REPORT_S)
+
+controller = None
+if ADAPTIVE_RATE:
+    controller = AdaptiveController(
+        target_latency=TARGET_LATENCY_S,
+        drop_tolerance=DROP_TOLERANCE,
+        ladder=build_ladder(top_resolution=(int(WIDTH), int(HEIGHT)), top_fps=int(FPS),
+                            quality_max=JPEG_QUALITY, quality_min=MIN_JPEG_QUALITY),
+    )
+
+# Every audio chunk, numbered, until the sender takes it (encoded bytes, capture time of its last sample)
+audio_ring = AudioRing()
+audio_encoder = make_encoder(AUDIO_CODEC, AUDIO_RATE)
+# Stream parameters for JSON POSTs (the binary header has rate and codec); chunks are bare samples.
+# Sent once, then again only if it changes, after a failed POST, or when the server asks.
+AUDIO_FORMAT = {"codec": audio_encoder.codec_id, "rate": AUDIO_RATE, "channels": 1}
+audio_format_sent = False
+audio_encode_seconds = REGISTRY.histogram("pi_audio_encode_seconds", "CPU time to encode one audio chunk.",
+                                          buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05))
+audio_sent = REGISTRY.counter("pi_audio_chunks_sent_total", "Audio chunks handed to the network.")
+REGISTRY.counter("pi_audio_chunks_captured_total", "Audio chunks read from arecord.", fn=lambda: audio_ring.pushed)
+REGISTRY.counter("pi_audio_chunks_dropped_total", "Audio chunks lost to a full ring or a failed POST.",
+                 fn=lambda: audio_ring.dropped)
 
-def put_latest(q: queue.Queue, item):
-    """Keep only the most recent item in the queue."""
+def put_latest(q: queue.Queue, item) -> int:
+    """Keep only the most recent item in the queue. Returns how many were dropped."""
+    dropped = 0
     try:
         while q.full():
             q.get_nowait()
+            dropped += 1
     except queue.Empty:
         pass
     q.put_nowait(item)
+    return dropped
 
-def start_camera():
+def start_camera(width=WIDTH, height=HEIGHT, quality=JPEG_QUALITY):
     """
     Start a continuous MJPEG stream to stdout.
     This avoids spawning a process per frame (your old bottleneck).
@@ -46,9 +96,10 @@ def start_camera():
         "-t", "0",                  # run forever
         "-n",                       # no preview
         "--codec", "mjpeg",         # MJPEG = individual JPEGs
-        "--width", WIDTH,
-        "--height", HEIGHT,
+        "--width", str(width),
+        "--height", str(height),
         "--framerate", FPS,
+        "--quality", str(quality),
         "-o", "-"                   # write to stdout
     ]
     # Use Popen so we can read stdout as the stream flows
@@ -61,75 +112,78 @@ def start_camera():
 
 def mjpeg_reader_proc():
     """
-    Read bytes from libcamera-vid stdout, carve out JPEGs by SOI/EOI markers,
-    and push the newest frame (base64) to frame_queue.
+    Read bytes from libcamera-vid stdout straight into a JpegSplitter buffer,
+    carve out JPEGs by marker structure, and push the newest frame to
+    frame_queue. Follows the rate controller's profile: frame rate by
+    skipping, size/quality by restarting the camera (rate-limited).
     """
-    proc = start_camera()
-    buf = bytearray()
-    SOI = b"\xff\xd8"  # Start Of Image
-    EOI = b"\xff\xd9"  # End Of Image
+    camera_args = (WIDTH, HEIGHT, JPEG_QUALITY)
+    proc = start_camera(*camera_args)
+    started_at = time.monotonic()
+    splitter = JpegSplitter()
+    last_push = 0.0
+    frame_seq = 0
 
     while True:
-        chunk = proc.stdout.read(CHUNK_SIZE)
-        if not chunk:
+        if controller is not None:
+            p = controller.update()
+            wanted = (str(p.width), str(p.height), p.quality)
+            if wanted != camera_args and time.monotonic() - started_at >= CAMERA_RESTART_MIN_S:
+                log.info("camera profile", extra={"size": f"{p.width}x{p.height}",
+                                                  "quality": p.quality, "fps": p.fps})
+                try:
+                    proc.kill()
+                except Exception:
+                    pass
+                camera_args = wanted
+                proc = start_camera(*camera_args)
+                started_at = time.monotonic()
+                splitter.reset()
+
+        if not splitter.fill_from(proc.stdout, CHUNK_SIZE):
             # camera process died; restart
             try:
                 proc.kill()
             except Exception:
                 pass
-            proc = start_camera()
+            proc = start_camera(*camera_args)
+            started_at = time.monotonic()
+            splitter.reset()
             continue
 
-        buf.extend(chunk)
-
-        # Find complete JPEGs in the buffer
-        while True:
-            start = buf.find(SOI)
-            if start < 0:
-                # No JPEG start yet; keep reading
-                if len(buf) > 2 * CHUNK_SIZE:
-                    # Trim pathological garbage
-                    del buf[:-2]
-                break
-
-            end = buf.find(EOI, start + 2)
-            if end < 0:
-                # Incomplete JPEG; need more bytes
-                # Discard bytes before SOI to keep buffer bounded
-                if start > 0:
-                    del buf[:start]
-                break
-
-            # Got a full JPEG [start : end+2)
-            jpg = bytes(buf[start:end + 2])
-            # Drop everything up to the end of this JPEG
-            del buf[:end + 2]
-
-            # Push newest frame only
-            try:
-                img_b64 = base64.b64encode(jpg).decode()
-                put_latest(frame_queue, img_b64)
-            except Exception:
-                # ignore bad frame and continue
-                pass
+        # Only the newest complete frame matters; older ones would be
+        # replaced in frame_queue anyway, so don't bother encoding them.
+        newest = None
+        for jpg in splitter.frames():
+            newest = jpg
+        if newest is None:
+            continue
+
+        now = time.monotonic()
+        if controller is not None and now - last_push < 1.0 / controller.profile.fps:
+            newest.release()
+            continue
+        last_push = now
 
-def pcm_to_wav(pcm_bytes: bytes, sample_rate=48000, channels=1, sampwidth_bytes=2) -> bytes:
-    """Wrap raw PCM bytes in a minimal WAV header."""
-    with io.BytesIO() as bio:
-        with wave.open(bio, 'wb') as wf:
-            wf.setnchannels(channels)
-            wf.setsampwidth(sampwidth_bytes)
-            wf.setframerate(sample_rate)
-            wf.writeframes(pcm_bytes)
-        return bio.getvalue()
+        # Push newest frame only (copy before the view is invalidated)
+        frame_seq += 1
+        try:
+            dropped = put_latest(frame_queue, (bytes(newest), time.time(), frame_seq))
+            frames_dropped.inc(dropped)
+            if dropped and controller is not None:
+                # sender still busy with the previous frame
+                controller.on_drop(dropped)
+        except Exception:
+            # ignore bad frame and continue
+            pass
+        finally:
+            newest.release()
 
 def audio_worker():
     """
-    Stream mono 16-bit PCM from arecord and emit ~100ms WAV chunks continuously.
+    Stream mono 16-bit PCM from arecord and emit ~100ms encoded chunks continuously.
     """
-    global latest_audio_b64, latest_audio_ts
-
-    SR = 48000
+    SR = AUDIO_RATE
     CH = 1
     BYTES_PER_SAMPLE = 2  # S16_LE
     CHUNK_MS = 100
@@ -168,56 +222,178 @@ def audio_worker():
                 pcm = bytes(buf[:CHUNK_BYTES])
                 del buf[:CHUNK_BYTES]
 
-                wav_bytes = pcm_to_wav(pcm, sample_rate=SR, channels=CH, sampwidth_bytes=BYTES_PER_SAMPLE)
-                try:
-                    latest_audio_b64 = base64.b64encode(wav_bytes).decode()
-                    latest_audio_ts = time.time()
-                except Exception:
-                    pass
+                t0 = time.process_time()
+                payload = audio_encoder.encode(pcm)
+                audio_encode_seconds.observe(time.process_time() - t0)
+                audio_ring.put(payload, time.time())
         except Exception:
             # restart on any read error
             try: proc.kill()
             except Exception: pass
             proc = start_proc()
 
-def sender():
+def probe_frame_stream():
+    """The server's GET /frame_stream answer ({"protocol", "codecs"}), or None if it has none."""
+    try:
+        resp = session.get(f"http://{SERVER_IP}:5000/frame_stream", timeout=1.0)
+        return resp.json() if resp.status_code == 200 else None
+    except Exception:
+        return None
+
+def stream_supported():
+    """Ask the server whether it has the /frame_stream upload endpoint."""
+    return probe_frame_stream() is not None
+
+def use_server_codecs():
+    """Before audio starts: fall back from AUDIO_CODEC if the server says it can't decode it."""
+    global audio_encoder, audio_format_sent
+    codecs = (probe_frame_stream() or {}).get("codecs")
+    if codecs is None or CODEC_NAMES[audio_encoder.codec_id] in codecs:
+        return
+    audio_encoder = make_encoder(AUDIO_CODEC, AUDIO_RATE, accepted=codecs) or make_encoder("pcm", AUDIO_RATE)
+    AUDIO_FORMAT["codec"] = audio_encoder.codec_id
+    audio_format_sent = False
+    log.warning("server can't decode %s, sending %s", AUDIO_CODEC, CODEC_NAMES[audio_encoder.codec_id])
+
+def frame_stream():
     """
-    Send frames as fast as they’re available.
-    Attach audio only if it’s fresh.
+    Body generator for the streaming upload: back-to-back binary media
+    messages, no per-frame round trip. requests sends each item as one
+    HTTP chunk, so resuming here means the previous frame hit the socket.
+    Audio chunks go out as their own audio-only messages as soon as they're
+    captured, between frames. If the upload breaks, chunks not yet sent go
+    back to audio_ring, as post_frame does.
     """
-    dots = 0
     while True:
+        chunks = audio_ring.drain()
+        try:
+            while chunks:
+                audio_seq, audio_ts, audio = chunks[0]
+                yield pack_media(audio_seq, audio_ts, None, audio, AUDIO_RATE, audio_seq=audio_seq,
+                                 audio_ts=audio_ts, audio_codec=audio_encoder.codec_id)
+                del chunks[0]
+                audio_sent.inc()
+        finally:
+            # includes the chunk in flight when the body was closed; the server drops duplicates
+            audio_ring.requeue(chunks)
         try:
-            img_b64 = frame_queue.get(timeout=0.5)
+            jpg, capture_ts, seq = frame_queue.get(timeout=AUDIO_POLL_S)
         except queue.Empty:
             continue
+        sent_at = time.monotonic()
+        latency.observe("pi_send", capture_ts, seq)
+        yield pack_media(seq, capture_ts, jpg)
+        frames_sent.inc()
+        bytes_sent.inc(len(jpg))
+        if controller is not None:
+            # Socket write time grows as soon as the uplink backs up
+            controller.note_sent()
+            controller.on_latency(time.monotonic() - sent_at)
+        log.info("frame sent", extra={"key": "frame_sent", "seq": seq, "bytes": len(jpg)})
+
+def stream_sender():
+    """Run one streaming upload until it breaks. Returns when it's over."""
+    body = frame_stream()
+    try:
+        session.post(
+            f"http://{SERVER_IP}:5000/frame_stream",
+            data=body,
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=(HTTP_TIMEOUT[0] * 10, None),
+        )
+    except Exception as e:
+        log.warning("upload stream ended: %s", e)
+    finally:
+        body.close()  # hands unsent audio back to audio_ring now, not at garbage collection
+
+def post_frame(jpg, capture_ts=None, seq=None):
+    """
+    Send one frame (or none: jpg=None) as its own JSON POST (fallback / old
+    servers), with every audio chunk waiting in audio_ring.
+    """
+    global audio_format_sent
+    chunks = audio_ring.drain()
+    body = {
+        "img": base64.b64encode(jpg).decode() if jpg else None,
+        "ts": capture_ts,
+        "seq": seq,
+        "audio_chunks": [{"audio": base64.b64encode(audio).decode(), "audio_seq": audio_seq, "audio_ts": audio_ts}
+                         for audio_seq, audio_ts, audio in chunks],
+    }
+    if chunks and not audio_format_sent:
+        body["audio_format"] = AUDIO_FORMAT
+    sent_at = time.monotonic()
+    if jpg:
+        latency.observe("pi_send", capture_ts, seq)
+    try:
+        resp = session.post(f"http://{SERVER_IP}:5000/frame", json=body, timeout=HTTP_TIMEOUT)
+        audio_sent.inc(len(chunks))
+        if "audio_format" in body:
+            audio_format_sent = True
+        if resp.headers.get("X-Audio-Format") == "missing":
+            audio_format_sent = False
+        if jpg:
+            frames_sent.inc()
+            bytes_sent.inc(len(jpg))
+            if controller is not None:
+                # The HTTP response is the server's acknowledgement
+                controller.note_sent()
+                controller.on_latency(time.monotonic() - sent_at)
+        return True
+    except Exception:
+        # Drop the frame on network issues to avoid blocking the camera; keep the audio for the next try
+        audio_ring.requeue(chunks)
+        audio_format_sent = False  # the server may have restarted
+        if jpg and controller is not None:
+            controller.note_sent()
+            controller.on_loss()
+        return False
 
-        audio_b64 = None
-        now = time.time()
-        if latest_audio_b64 and (now - latest_audio_ts) <= AUDIO_FRESH_WINDOW_S:
-            audio_b64 = latest_audio_b64
+def sender():
+    """
+    Send frames as fast as they’re available.
+    Prefer the persistent streaming upload; fall back to a POST per frame.
+    Audio waiting in audio_ring rides along, or goes on its own when no
+    frame comes.
+    """
+    retry_stream_at = 0.0
+    while True:
+        if STREAM_UPLOAD and time.monotonic() >= retry_stream_at:
+            retry_stream_at = time.monotonic() + STREAM_RETRY_S
+            if stream_supported():
+                log.info("using persistent upload to /frame_stream")
+                stream_sender()
+                continue
 
         try:
-            session.post(
-                f"http://{SERVER_IP}:5000/frame",
-                json={"img": img_b64, "audio": audio_b64},
-                timeout=HTTP_TIMEOUT,
-            )
-            dots += 1
-            if dots % 50 == 0:
-                # Simple heartbeat without spamming stdout
-                print(".", end="", flush=True)
-        except Exception:
-            # Drop on network issues to avoid blocking camera
-            pass
+            jpg, capture_ts, seq = frame_queue.get(timeout=0.1)  # one audio chunk
+        except queue.Empty:
+            if len(audio_ring):
+                post_frame(None)  # video stalled: audio only
+            continue
+
+        if post_frame(jpg, capture_ts, seq):
+            log.info("frame sent", extra={"key": "frame_sent", "seq": seq, "bytes": len(jpg)})
 
 def main():
     print("Starting split-stream MJPEG sender (low-latency).")
+    use_server_codecs()
     threading.Thread(target=mjpeg_reader_proc, daemon=True).start()
     threading.Thread(target=audio_worker, daemon=True).start()
     threading.Thread(target=sender, daemon=True).start()
     while True:
-        time.sleep(1)
+        time.sleep(LATENCY_REPORT_S)
+        log.info("send stats", extra={"fps": f"{send_fps.value:.1f}",
+                                      "kib_s": f"{send_bps.value / 1024:.0f}",
+                                      "dropped": frames_dropped.value,
+                                      "frame_queue": f"{frame_queue.qsize()}/{frame_queue.maxsize}",
+                                      "audio_sent": audio_sent.value,
+                                      "audio_dropped": audio_ring.dropped,
+                                      "audio_ring": f"{len(audio_ring)}/{audio_ring.capacity}",
+                                      "audio_codec": CODEC_NAMES[audio_encoder.codec_id],
+                                      "encode_p95_ms": f"{audio_encode_seconds.quantile(0.95) * 1000:.2f}"})
+        if latency.hops:
+            log.info("latency %s", latency.summary())
 
 if __name__ == "__main__":
     try:
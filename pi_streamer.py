@@ -7,7 +7,6 @@ Raspberry Pi video/audio streamer for ArduCam (robust version)
 
 import cv2
 import numpy as np
-import base64
 import asyncio
 import websockets
 import json
@@ -18,6 +17,14 @@ import time
 import os
 import glob
 
+from audio_codec import CODEC_NONE, make_encoder
+from metrics import latency
+from rate_control import AdaptiveController, build_ladder
+from service_log import get_logger
+from stream_protocol import (
+    PROTO_BINARY, PROTO_JSON, hello_message, legacy_json_message, pack_media,
+)
+
 # ================== CONFIG ==================
 SERVER_IP = "10.189.65.41"   # <-- set to your Mac's reachable IP (you used this already)
 SERVER_PORT = 8765
@@ -27,11 +34,24 @@ FRAME_HEIGHT = 480
 FPS          = 30
 JPEG_QUALITY = 80
 
+# Adaptive rate control: FRAME_*/FPS/JPEG_QUALITY become the upper bound and
+# the controller steps down (quality, then fps/resolution) on congestion.
+ADAPTIVE_RATE       = True
+TARGET_LATENCY_S    = 0.25
+MIN_JPEG_QUALITY    = 35
+DROP_TOLERANCE      = 0.10   # the 2-deep video queue drops some frames by design
+SEND_IDLE_S         = 0.005  # sender's poll interval when no frame or audio is waiting
+
 # Camera backends to try, in order
 TRY_V4L2_DIRECT     = True   # cv2.VideoCapture(index, cv2.CAP_V4L2) with MJPG
 TRY_GST_V4L2SRC     = True   # GStreamer pipeline using v4l2src (for UVC or v4l2-mapped cams)
 TRY_GST_LIBCAMERA   = True   # GStreamer pipeline using libcamerasrc (for CSI/MIPI cams)
 
+# Forward the camera's own MJPEG buffers instead of decode + re-encode.
+# Falls back automatically if the backend hands us decoded BGR anyway.
+PASSTHROUGH_JPEG    = True
+CPU_REPORT_INTERVAL = 10.0   # seconds between capture CPU cost reports
+
 # Audio settings
 ENABLE_AUDIO        = True   # set False to silent-run
 AUDIO_FORMAT        = pyaudio.paInt16
@@ -39,8 +59,15 @@ AUDIO_CHANNELS      = 1
 AUDIO_RATE          = 16000   # lower = lighter CPU/bw; keep it mono
 AUDIO_CHUNK         = 1024
 AUDIO_DEVICE_INDEX  = None    # None => auto-pick first input device
+AUDIO_CODEC         = "adpcm"  # binary framing only: "adpcm", "opus" (needs opuslib on both ends), or None for PCM
+
+# Wire format
+PREFER_BINARY       = True    # offer binary framing; server may still pick JSON
+HELLO_TIMEOUT_S     = 1.0     # old servers never answer the hello
 # ============================================
 
+log = get_logger("pi_streamer")
+
 
 def list_video_nodes():
     return sorted(glob.glob("/dev/video*"))
@@ -63,7 +90,8 @@ def pick_first_video_index():
 def open_camera_robust():
     """
     Try several ways to open a camera and set sane parameters.
-    Returns an opened cv2.VideoCapture or None.
+    Returns (cv2.VideoCapture, backend_name, passthrough) or (None, None, False).
+    `passthrough` means frames should come out as still-compressed JPEG bytes.
     """
     # 1) Direct V4L2 on an index (best for UVC USB cams)
     if TRY_V4L2_DIRECT:
@@ -76,8 +104,13 @@ def open_camera_robust():
             cap.set(cv2.CAP_PROP_FRAME_HEIGHT, FRAME_HEIGHT)
             cap.set(cv2.CAP_PROP_FPS, FPS)
             if cap.isOpened():
-                print(f"[video] V4L2 direct opened /dev/video{idx} (MJPG)")
-                return cap
+                passthrough = False
+                if PASSTHROUGH_JPEG:
+                    # Ask OpenCV not to decode: read() returns the raw MJPG buffer
+                    passthrough = bool(cap.set(cv2.CAP_PROP_CONVERT_RGB, 0))
+                mode = "passthrough" if passthrough else "decode"
+                print(f"[video] V4L2 direct opened /dev/video{idx} (MJPG, {mode})")
+                return cap, "v4l2", passthrough
             else:
                 cap.release()
 
@@ -86,16 +119,24 @@ def open_camera_robust():
         # Prefer /dev/video0
         dev = "/dev/video0" if os.path.exists("/dev/video0") else (list_video_nodes()[0] if list_video_nodes() else None)
         if dev:
+            caps = f"image/jpeg,framerate={FPS}/1,width={FRAME_WIDTH},height={FRAME_HEIGHT}"
+            if PASSTHROUGH_JPEG:
+                # appsink gets the camera's JPEG buffers untouched
+                cap = cv2.VideoCapture(f"v4l2src device={dev} ! {caps} ! appsink", cv2.CAP_GSTREAMER)
+                if cap.isOpened():
+                    print(f"[video] GStreamer v4l2src opened {dev} (MJPEG, passthrough)")
+                    return cap, "gst-v4l2src", True
+                cap.release()
             # Ask for MJPEG from camera and decode on CPU
             pipeline = (
                 f"v4l2src device={dev} ! "
-                f"image/jpeg,framerate={FPS}/1,width={FRAME_WIDTH},height={FRAME_HEIGHT} ! "
+                f"{caps} ! "
                 f"jpegdec ! videoconvert ! appsink"
             )
             cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
             if cap.isOpened():
                 print(f"[video] GStreamer v4l2src opened {dev} (MJPEG)")
-                return cap
+                return cap, "gst-v4l2src", False
 
     # 3) GStreamer via libcamerasrc (CSI/MIPI cams using libcamera)
     if TRY_GST_LIBCAMERA:
@@ -107,10 +148,25 @@ def open_camera_robust():
         cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
         if cap.isOpened():
             print("[video] GStreamer libcamerasrc opened (CSI/MIPI)")
-            return cap
+            return cap, "gst-libcamera", False
 
     print("[video] ERROR: Could not open any camera. Check /dev/video*, libcamera, or cabling.")
-    return None
+    return None, None, False
+
+def as_jpeg_bytes(frame):
+    """
+    Return the JPEG bytes if `frame` is a still-compressed buffer
+    (1-D or 1xN uint8 starting with SOI), else None.
+    """
+    if frame is None or frame.dtype != np.uint8:
+        return None
+    if frame.ndim == 2 and frame.shape[0] == 1:
+        frame = frame[0]
+    if frame.ndim != 1 or frame.size < 4:
+        return None
+    if frame[0] != 0xFF or frame[1] != 0xD8:
+        return None
+    return frame.tobytes()
 
 def pick_audio_input_index(p):
     """
@@ -156,17 +212,15 @@ def pick_audio_rate(p, dev_index, candidates=(16000, 48000, 44100, 32000, 22050,
 class VideoAudioStreamer:
     def __init__(self):
         # ---- Camera ----
-        self.cap = open_camera_robust()
+        self.cap, self.video_backend, self.passthrough = open_camera_robust()
         if self.cap is None:
             print("[video] Continuing without video (no camera).")
-        else:
-            # Try to ensure JPEG quality on encode
-            self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
 
         # ---- Audio ----
         self.audio_stream = None
         self.audio = None
         self.audio_rate = None
+        self.audio_encoder = None  # audio_codec encoder for binary framing, once the rate is known
 
         if ENABLE_AUDIO:
             try:
@@ -185,6 +239,9 @@ class VideoAudioStreamer:
                     else:
                         print(f"[audio] Chosen sample rate: {chosen_rate} Hz")
                         self.audio_rate = chosen_rate
+                        self.audio_encoder = make_encoder(AUDIO_CODEC, chosen_rate, AUDIO_CHANNELS)
+                        if self.audio_encoder is not None:
+                            print(f"[audio] Codec: {type(self.audio_encoder).__name__}")
                         self.audio_stream = self.audio.open(
                             format=AUDIO_FORMAT,
                             channels=AUDIO_CHANNELS,
@@ -200,33 +257,95 @@ class VideoAudioStreamer:
             print("[audio] Disabled by config.")
 
 
-        # Queues for thread communication
-        self.video_queue = queue.Queue(maxsize=10)
+        # ---- Rate control ----
+        self.controller = None
+        if ADAPTIVE_RATE:
+            ladder = build_ladder(top_resolution=(FRAME_WIDTH, FRAME_HEIGHT), top_fps=FPS,
+                                  quality_max=JPEG_QUALITY, quality_min=MIN_JPEG_QUALITY)
+            self.controller = AdaptiveController(target_latency=TARGET_LATENCY_S,
+                                                 drop_tolerance=DROP_TOLERANCE, ladder=ladder)
+
+        # Queues for thread communication (short video queue: stale frames are useless)
+        self.video_queue = queue.Queue(maxsize=2)
         self.audio_queue = queue.Queue(maxsize=10)
 
         self.running = True
 
+    def current_profile(self):
+        """(width, height, fps, quality) to capture at right now."""
+        if self.controller is None:
+            return FRAME_WIDTH, FRAME_HEIGHT, FPS, JPEG_QUALITY
+        return self.controller.update()
+
     def capture_video(self):
         """Capture video frames in separate thread"""
         if self.cap is None:
             return
+        cpu_total = 0.0
+        cpu_frames = 0
+        last_report = time.time()
+        last_frame_ts = 0.0
         while self.running:
+            cpu_start = time.thread_time()
             ret, frame = self.cap.read()
             if not ret:
                 # Give camera a moment, then retry
                 time.sleep(0.02)
                 continue
-            # Encode to JPEG
-            ok, buffer = cv2.imencode('.jpg', frame, getattr(self, "encode_params", []))
-            if not ok:
-                continue
-            jpg_as_text = base64.b64encode(buffer).decode('utf-8')
+            capture_ts = time.time()
+
+            width, height, fps, quality = self.current_profile()
+            if fps < FPS and capture_ts - last_frame_ts < 1.0 / fps:
+                continue  # controller asked for a lower frame rate
+            last_frame_ts = capture_ts
+            degraded = quality < JPEG_QUALITY or (width, height) != (FRAME_WIDTH, FRAME_HEIGHT)
+
+            jpg = as_jpeg_bytes(frame) if self.passthrough else None
+            if jpg is None and self.passthrough:
+                # Backend ignored the request and decoded anyway
+                print(f"[video] {self.video_backend}: no compressed frames; falling back to re-encode")
+                self.passthrough = False
+                if self.video_backend == "v4l2":
+                    self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                    continue
+            if jpg is not None and degraded:
+                # Passthrough frames are full size/quality; re-encode smaller
+                frame = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+                jpg = None
+                if frame is None:
+                    continue
+            if jpg is None:
+                if frame.shape[1] != width or frame.shape[0] != height:
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                # Encode to JPEG
+                ok, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+                if not ok:
+                    continue
+                jpg = buffer.tobytes()
+
+            cpu_total += time.thread_time() - cpu_start
+            cpu_frames += 1
+            if capture_ts - last_report >= CPU_REPORT_INTERVAL and cpu_frames:
+                mode = "passthrough" if self.passthrough and not degraded else "decode+encode"
+                log.info("capture stats", extra={"key": "capture_stats", "backend": self.video_backend,
+                                                 "mode": mode, "frames": cpu_frames,
+                                                 "cpu_ms_per_frame": f"{cpu_total / cpu_frames * 1000:.2f}",
+                                                 "profile": f"{width}x{height}@{fps}", "quality": quality})
+                if latency.hops:
+                    log.info("latency %s", latency.summary(), extra={"key": "latency"})
+                cpu_total, cpu_frames, last_report = 0.0, 0, capture_ts
+
+            # Keep raw JPEG bytes; base64 only happens if we fall back to JSON
+            item = (jpg, capture_ts)
             try:
-                self.video_queue.put_nowait(jpg_as_text)
+                self.video_queue.put_nowait(item)
             except queue.Full:
+                # Uplink is behind: that's a congestion signal
+                if self.controller is not None:
+                    self.controller.on_drop()
                 try:
                     _ = self.video_queue.get_nowait()
-                    self.video_queue.put_nowait(jpg_as_text)
+                    self.video_queue.put_nowait(item)
                 except Exception:
                     pass
 
@@ -237,23 +356,71 @@ class VideoAudioStreamer:
         while self.running:
             try:
                 audio_data = self.audio_stream.read(AUDIO_CHUNK, exception_on_overflow=False)
-                audio_b64 = base64.b64encode(audio_data).decode('utf-8')
                 try:
-                    self.audio_queue.put_nowait(audio_b64)
+                    self.audio_queue.put_nowait(audio_data)
                 except queue.Full:
                     try:
                         _ = self.audio_queue.get_nowait()
-                        self.audio_queue.put_nowait(audio_b64)
+                        self.audio_queue.put_nowait(audio_data)
                     except Exception:
                         pass
             except Exception:
                 # keep going; drop this chunk
                 time.sleep(0.005)
 
+    async def negotiate(self, websocket):
+        """
+        Offer binary framing; fall back to JSON if the server doesn't answer.
+        Returns (protocol, audio codec names the server decodes).
+        """
+        if not PREFER_BINARY:
+            return PROTO_JSON, []
+        try:
+            await websocket.send(hello_message())
+            reply = await asyncio.wait_for(websocket.recv(), timeout=HELLO_TIMEOUT_S)
+            data = json.loads(reply)
+            if data.get("type") == "hello" and data.get("protocol") == PROTO_BINARY:
+                # no list: a server from before codecs, which only takes raw PCM
+                return PROTO_BINARY, data.get("codecs", [])
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            log.warning("hello failed, using JSON: %s", e, extra={"key": "hello"})
+        return PROTO_JSON, []
+
+    def connection_encoder(self, codecs):
+        """A fresh audio encoder for one connection, limited to what the server decodes (None: raw PCM)."""
+        if self.audio_encoder is None:
+            return None
+        encoder = make_encoder(AUDIO_CODEC, self.audio_rate, AUDIO_CHANNELS, accepted=codecs)
+        if encoder is None or encoder.codec_id != self.audio_encoder.codec_id:
+            log.warning("server can't decode %s audio, sending %s", AUDIO_CODEC,
+                        type(encoder).__name__ if encoder else "raw PCM", extra={"key": "codec_fallback"})
+        return encoder
+
+    async def read_acks(self, websocket):
+        """
+        Read everything the server sends on a binary connection: acks feed the
+        rate controller, if any. Runs even without one, or unread acks pile up
+        and the keepalive pong is never processed.
+        """
+        try:
+            async for reply in websocket:
+                if isinstance(reply, bytes):
+                    continue
+                try:
+                    data = json.loads(reply)
+                except ValueError:
+                    continue
+                if data.get("type") == "ack" and self.controller is not None:
+                    self.controller.on_ack(data.get("seq"))
+        except Exception:
+            pass
+
     async def stream_data(self):
         """Stream video and audio to server with resilient keepalive and pacing."""
         uri = f"ws://{SERVER_IP}:{SERVER_PORT}"
-        print(f"[net] Target: {uri}")
+        log.info("target %s", uri)
         while self.running:
             try:
                 async with websockets.connect(
@@ -262,13 +429,20 @@ class VideoAudioStreamer:
                     ping_interval=20,          # send ping every 20s
                     ping_timeout=10            # wait up to 10s for pong
                 ) as websocket:
-                    print(f"[net] Connected to server at {uri}")
+                    protocol, codecs = await self.negotiate(websocket)
+                    encoder = self.connection_encoder(codecs) if protocol == PROTO_BINARY else None
+                    log.info("connected", extra={"key": "connected", "uri": uri, "framing": protocol})
+                    acks = None
+                    if protocol == PROTO_BINARY:
+                        acks = asyncio.ensure_future(self.read_acks(websocket))
+                    seq = 0
                     while self.running:
                         video_frame = None
+                        capture_ts = None
                         audio_data = None
 
                         try:
-                            video_frame = self.video_queue.get_nowait()
+                            video_frame, capture_ts = self.video_queue.get_nowait()
                         except queue.Empty:
                             pass
 
@@ -277,26 +451,43 @@ class VideoAudioStreamer:
                         except queue.Empty:
                             pass
 
-                        if video_frame is not None or audio_data is not None:
-                            message = {
-                                "type": "stream",
-                                "video": video_frame,
-                                "audio": audio_data,
-                                "audio_rate": getattr(self, "audio_rate", 16000),
-                                "timestamp": time.time(),
-                            }
-                            try:
-                                await websocket.send(json.dumps(message))
-                            except Exception as e:
-                                print(f"[net] Send error: {e}")
-                                break
-
-                        # ~30 FPS pacing while still allowing audio-only periods
-                        await asyncio.sleep(0.03)
+                        if video_frame is None and audio_data is None:
+                            await asyncio.sleep(SEND_IDLE_S)
+                            continue
+                        rate = getattr(self, "audio_rate", None) or 16000
+                        ts = capture_ts or time.time()
+                        if protocol == PROTO_BINARY:
+                            codec = CODEC_NONE
+                            if audio_data is not None and encoder is not None:
+                                audio_data = encoder.encode(audio_data)
+                                codec = encoder.codec_id
+                            message = pack_media(seq, ts, video_frame, audio_data, rate, audio_codec=codec)
+                        else:
+                            message = legacy_json_message(video_frame, audio_data, rate, ts)
+                        if video_frame is not None:
+                            latency.observe("pi_send", ts, seq)
+                        sent_at = time.monotonic()
+                        try:
+                            await websocket.send(message)
+                        except Exception as e:
+                            log.warning("send failed: %s", e, extra={"key": "send_error", "seq": seq})
+                            break
+                        if self.controller is not None and video_frame is not None:
+                            if acks is not None:
+                                self.controller.note_sent(seq)
+                            else:
+                                # No acks from old servers: time the socket write
+                                self.controller.note_sent()
+                                self.controller.on_latency(time.monotonic() - sent_at)
+                        seq += 1
+
+                        # let read_acks and the websocket run; no fixed pause while frames are waiting
+                        await asyncio.sleep(0)
+                    if acks is not None:
+                        acks.cancel()
 
             except Exception as e:
-                print(f"[net] Connection error: {e}")
-                print("[net] Reconnecting in 5 seconds...")
+                log.warning("connection failed, reconnecting in 5 s: %s", e, extra={"key": "connection_error"})
                 await asyncio.sleep(5)
 
     def start(self):
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Closed-loop rate controller for the Pi senders.
+
+The controller walks a ladder of (width, height, fps, jpeg quality) profiles
+ordered from most to least expensive: quality drops first, then frame rate,
+then resolution. It is AIMD-style:
+
+- congestion (smoothed latency over target, local queue drops, loss above
+  a tolerance) moves down the ladder immediately, two rungs if severe
+- a clean probe window with latency well under target moves up one rung
+
+Feedback comes from whatever the sender can observe: send latency
+(`on_latency`), frames dropped on the Pi (`on_drop`), frames lost in
+transit (`on_loss`), and server acknowledgements (`note_sent` + `on_ack`,
+unacknowledged frames count as lost after ACK_TIMEOUT_S).
+
+Run this file directly to drive the controller over a simulated link (local
+TCP sockets through a proxy with configurable bandwidth, delay and loss) and
+check that it converges under the latency target.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+Profile = namedtuple("Profile", "width height fps quality")
+
+# ================== DEFAULTS ==================
+TARGET_LATENCY_S = 0.25      # send-to-ack budget the controller aims for
+TOP_RESOLUTION   = (640, 480)
+TOP_FPS          = 30
+QUALITY_MAX      = 80
+QUALITY_MIN      = 35
+QUALITY_STEP     = 10
+# Below minimum quality: trade frame rate and resolution alternately
+LADDER_TAIL      = ((640, 480, 20), (640, 480, 15), (480, 360, 15),
+                    (480, 360, 10), (320, 240, 10), (320, 240, 5))
+UPDATE_INTERVAL  = 0.5       # seconds between decisions
+PROBE_INTERVAL   = 2.0       # clean seconds required before stepping up
+ACK_TIMEOUT_S    = 1.0       # unacknowledged this long => lost
+LOSS_TOLERANCE   = 0.10      # random link loss below this isn't congestion
+DROP_TOLERANCE   = 0.0       # fraction of frames the Pi may drop locally
+# ==============================================
+
+
+def build_ladder(top_resolution=TOP_RESOLUTION, top_fps=TOP_FPS, quality_max=QUALITY_MAX,
+                 quality_min=QUALITY_MIN, quality_step=QUALITY_STEP, tail=LADDER_TAIL):
+    """Profiles from best to cheapest: quality first, then fps/resolution."""
+    qualities = list(range(quality_max, quality_min - 1, -quality_step))
+    if qualities[-1] != quality_min:
+        qualities.append(quality_min)
+    w, h = top_resolution
+    ladder = [Profile(w, h, top_fps, q) for q in qualities]
+    ladder += [Profile(w, h, fps, quality_min) for w, h, fps in tail]
+    return ladder
+
+
+class AdaptiveController:
+    def __init__(self, target_latency=TARGET_LATENCY_S, ladder=None,
+                 update_interval=UPDATE_INTERVAL, probe_interval=PROBE_INTERVAL,
+                 ack_timeout=ACK_TIMEOUT_S, loss_tolerance=LOSS_TOLERANCE,
+                 drop_tolerance=DROP_TOLERANCE, start_level=0, clock=time.monotonic):
+        self.target = target_latency
+        self.ladder = ladder or build_ladder()
+        self.update_interval = update_interval
+        self.probe_interval = probe_interval
+        self.ack_timeout = ack_timeout
+        self.loss_tolerance = loss_tolerance
+        self.drop_tolerance = drop_tolerance
+        self.clock = clock
+        self.level = min(start_level, len(self.ladder) - 1)
+
+        self.lock = threading.Lock()
+        self.ewma = None
+        self.window_max = 0.0
+        self.window_drops = 0
+        self.window_sent = 0
+        self.window_lost = 0
+        self.last_update = clock()
+        self.clean_since = clock()
+        self.changes = 0
+        self.pending = {}  # seq -> send time, awaiting server ack
+
+    @property
+    def profile(self):
+        return self.ladder[self.level]
+
+    @property
+    def inflight(self):
+        return len(self.pending)
+
+    # ---- feedback ----
+    def on_latency(self, seconds):
+        """A measured send latency (HTTP round trip, WebSocket drain, ack RTT)."""
+        with self.lock:
+            self.ewma = seconds if self.ewma is None else 0.8 * self.ewma + 0.2 * seconds
+            if seconds > self.window_max:
+                self.window_max = seconds
+
+    def on_drop(self, count=1):
+        """Frames discarded on the Pi because the uplink couldn't keep up."""
+        with self.lock:
+            self.window_drops += count
+
+    def on_loss(self, count=1):
+        """Frames that left the Pi but never made it (timeouts, errors)."""
+        with self.lock:
+            self.window_lost += count
+
+    def note_sent(self, seq=None):
+        """Record a send; with `seq`, wait for on_ack(seq) to measure latency."""
+        with self.lock:
+            self.window_sent += 1
+            if seq is not None:
+                self.pending[seq] = self.clock()
+
+    def on_ack(self, seq):
+        with self.lock:
+            sent = self.pending.pop(seq, None)
+        if sent is not None:
+            self.on_latency(self.clock() - sent)
+
+    def _expire_pending(self, now):
+        cutoff = now - self.ack_timeout
+        stale = [s for s, t in self.pending.items() if t < cutoff]
+        for s in stale:
+            del self.pending[s]
+        self.window_lost += len(stale)
+
+    # ---- decision ----
+    def update(self):
+        """Re-evaluate; returns the (possibly new) profile. Cheap to call per frame."""
+        now = self.clock()
+        if now - self.last_update < self.update_interval:
+            return self.profile
+        with self.lock:
+            self._expire_pending(now)
+            ewma, peak, drops = self.ewma, self.window_max, self.window_drops
+            loss_rate = self.window_lost / max(self.window_sent, 1)
+            drop_rate = drops / max(self.window_sent + drops, 1)
+            self.window_max = 0.0
+            self.window_drops = self.window_sent = self.window_lost = 0
+            self.last_update = now
+
+            old = self.level
+            congested = (drop_rate > self.drop_tolerance or loss_rate > self.loss_tolerance
+                         or (ewma is not None and ewma > self.target))
+            if congested:
+                severe = drops > 2 or (ewma is not None and ewma > 2 * self.target)
+                self.level = min(self.level + (2 if severe else 1), len(self.ladder) - 1)
+                self.clean_since = now
+            elif ewma is not None and peak < self.target and ewma < 0.8 * self.target:
+                if now - self.clean_since >= self.probe_interval and self.level > 0:
+                    self.level -= 1
+                    self.clean_since = now
+                    # judge the probe on fresh samples only
+                    self.ewma = None
+            else:
+                self.clean_since = now
+            if self.level != old:
+                self.changes += 1
+        return self.profile
+
+
+# ---------------------------------------------------------------------------
+# Simulated-link harness
+# ---------------------------------------------------------------------------
+
+def _estimate_jpeg_bytes(p):
+    """Rough JPEG size for a 4:2:0 camera frame at a given quality."""
+    return int(p.width * p.height * (0.04 + 0.003 * p.quality))
+
+
+class _LinkProxy:
+    """
+    Forwards length-prefixed messages between two local sockets, imposing a
+    bottleneck bandwidth (FIFO serialisation), one-way delay and random loss.
+    """
+
+    def __init__(self, bandwidth_bps, delay_s, loss, seed=7):
+        import heapq
+        import random
+        import socket
+
+        self.heapq = heapq
+        self.rng = random.Random(seed)
+        self.bandwidth = bandwidth_bps
+        self.delay = delay_s
+        self.loss = loss
+        self.link_free_at = 0.0
+        self.events = []
+        self.cv = threading.Condition()
+        self.running = True
+
+        self.sender_sock, self.proxy_in = socket.socketpair()
+        self.proxy_out, self.receiver_sock = socket.socketpair()
+        threading.Thread(target=self._pump_forward, daemon=True).start()
+        threading.Thread(target=self._pump_acks, daemon=True).start()
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    @staticmethod
+    def _recv_msg(sock):
+        hdr = _recv_exact(sock, 4)
+        if hdr is None:
+            return None
+        return _recv_exact(sock, int.from_bytes(hdr, "big"))
+
+    def _schedule(self, at, sock, payload):
+        with self.cv:
+            self.heapq.heappush(self.events, (at, id(payload), sock, payload))
+            self.cv.notify()
+
+    def _pump_forward(self):
+        while self.running:
+            msg = self._recv_msg(self.proxy_in)
+            if msg is None:
+                return
+            now = time.monotonic()
+            start = max(now, self.link_free_at)
+            self.link_free_at = start + len(msg) * 8 / self.bandwidth
+            if self.rng.random() < self.loss:
+                continue
+            self._schedule(self.link_free_at + self.delay, self.proxy_out, msg)
+
+    def _pump_acks(self):
+        while self.running:
+            msg = self._recv_msg(self.proxy_out)
+            if msg is None:
+                return
+            self._schedule(time.monotonic() + self.delay, self.proxy_in, msg)
+
+    def _deliver(self):
+        while self.running:
+            with self.cv:
+                while not self.events:
+                    self.cv.wait()
+                at, _, sock, payload = self.events[0]
+                wait = at - time.monotonic()
+                if wait > 0:
+                    self.cv.wait(wait)
+                    continue
+                self.heapq.heappop(self.events)
+            sock.sendall(len(payload).to_bytes(4, "big") + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        part = sock.recv(n - len(buf))
+        if not part:
+            return None
+        buf += part
+    return bytes(buf)
+
+
+def simulate(bandwidth_bps, delay_s, loss, duration=12.0, target=TARGET_LATENCY_S,
+             max_inflight=3, verbose=True):
+    """Run the controller against a simulated link. Returns (profile, tail latencies)."""
+    link = _LinkProxy(bandwidth_bps, delay_s, loss)
+    ctl = AdaptiveController(target_latency=target)
+    latencies = []  # (t, latency)
+    t0 = time.monotonic()
+
+    def receiver():
+        while True:
+            msg = _LinkProxy._recv_msg(link.receiver_sock)
+            if msg is None:
+                return
+            ack = msg[:4]  # seq
+            link.receiver_sock.sendall(len(ack).to_bytes(4, "big") + ack)
+
+    def ack_reader():
+        while True:
+            msg = _LinkProxy._recv_msg(link.sender_sock)
+            if msg is None:
+                return
+            seq = int.from_bytes(msg, "big")
+            with ctl.lock:
+                sent = ctl.pending.get(seq)
+            if sent is not None:
+                latencies.append((time.monotonic() - t0, time.monotonic() - sent))
+            ctl.on_ack(seq)
+
+    threading.Thread(target=receiver, daemon=True).start()
+    threading.Thread(target=ack_reader, daemon=True).start()
+
+    seq = 0
+    next_frame = time.monotonic()
+    last_print = 0.0
+    while time.monotonic() - t0 < duration:
+        p = ctl.update()
+        now = time.monotonic()
+        if now < next_frame:
+            time.sleep(next_frame - now)
+        next_frame = max(next_frame + 1.0 / p.fps, time.monotonic())
+
+        if ctl.inflight >= max_inflight:
+            # latest-wins sender queue: this frame never leaves the Pi
+            ctl.on_drop()
+            continue
+
+        payload = seq.to_bytes(4, "big") + bytes(_estimate_jpeg_bytes(p))
+        ctl.note_sent(seq)
+        link.sender_sock.sendall(len(payload).to_bytes(4, "big") + payload)
+        seq += 1
+
+        elapsed = time.monotonic() - t0
+        if verbose and elapsed - last_print >= 1.0:
+            last_print = elapsed
+            recent = [l for t, l in latencies if t > elapsed - 1.0]
+            med = sorted(recent)[len(recent) // 2] * 1000 if recent else float("nan")
+            print(f"  t={elapsed:5.1f}s level={ctl.level:2d} {p.width}x{p.height}@{p.fps} "
+                  f"q={p.quality:2d} p50={med:6.1f} ms")
+
+    link.running = False
+    tail = [l for t, l in latencies if t > duration * 0.6]
+    return ctl.profile, tail
+
+
+def _main():
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Drive AdaptiveController over a simulated link")
+    ap.add_argument("--duration", type=float, default=12.0)
+    ap.add_argument("--target-ms", type=float, default=TARGET_LATENCY_S * 1000)
+    args = ap.parse_args()
+    target = args.target_ms / 1000
+
+    scenarios = [
+        ("good wifi", 20e6, 0.010, 0.0),
+        ("degraded", 3e6, 0.040, 0.01),
+        ("field link", 1e6, 0.060, 0.03),
+    ]
+    ok = True
+    for name, bw, delay, loss in scenarios:
+        print(f"{name}: {bw / 1e6:.1f} Mbit/s, {delay * 1000:.0f} ms, {loss:.0%} loss")
+        profile, tail = simulate(bw, delay, loss, duration=args.duration, target=target)
+        tail.sort()
+        p50 = tail[len(tail) // 2] if tail else float("inf")
+        p95 = tail[int(len(tail) * 0.95)] if tail else float("inf")
+        converged = p50 < target
+        ok &= converged
+        print(f"  -> {profile}, tail p50={p50 * 1000:.0f} ms p95={p95 * 1000:.0f} ms "
+              f"{'CONVERGED' if converged else 'NOT CONVERGED'}\n")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    _main()
@@ -3,8 +3,9 @@
 Mac server that receives stream from Pi and hosts doctor interface
 """
 
-from flask import Flask, render_template_string
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, render_template_string, request
+from flask_socketio import SocketIO, emit, join_room
+from socketio import packet as sio_packet
 import asyncio
 import websockets
 import json
@@ -13,17 +14,60 @@ import base64
 import logging
 import time  # <-- required for /api/annotated_stream
 
+from annotation_batch import AnnotationBatcher, AnnotationLog, compact
+from audio_codec import CODEC_NONE, decodable_codecs, make_decoder
+from audio_engine import OUTPUT_RATE, Mixer, float32_to_int16
+from broadcast_hub import BroadcastHub
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, instrument_flask, latency
+from service_log import get_logger
+from stream_protocol import (
+    ProtocolError, ack_message, choose_protocol, hello_reply, unpack_media,
+)
+
 # Disable Flask development server warning noise
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
+log = get_logger('server')
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'telemedicine-hackathon'
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+instrument_flask(app)
 
 # Global variables for stream data
 current_frame = None
-current_audio = None
-current_annotations = []
+current_annotations = AnnotationLog()  # compacted, capped; what late joiners and the AR glasses get
+BATCH_ROOM = 'annotation_batch'  # pages that asked for annotation_batch events in their connect auth
+LEGACY_ROOM = 'new_annotation'  # older pages, still sent one new_annotation per item
+legacy_annotation_clients = set()  # sids in LEGACY_ROOM, so batches skip the per-item loop when empty
+
+# Doctor clients: video is latest-wins per client, audio gets a short queue
+stream_hub = BroadcastHub({"video": 1, "audio": 25})
+# Every Pi connection and talking doctor page, resampled to OUTPUT_RATE and mixed
+audio_mixer = Mixer()
+MAX_CLIENT_BACKLOG = 2  # engine.io packets already queued before we hold back
+DECODABLE_CODECS = decodable_codecs()  # offered in the hello reply; opus only with opuslib
+
+# /metrics
+frames_ingested = REGISTRY.counter('ingest_frames_total', 'Frames received from Pis.')
+bytes_ingested = REGISTRY.counter('ingest_bytes_total', 'Bytes received from Pis.')
+REGISTRY.rate('ingest_fps', 'Frames received per second (last 10 s).', frames_ingested)
+REGISTRY.rate('ingest_bytes_per_second', 'Bytes received per second (last 10 s).', bytes_ingested)
+pi_connections = REGISTRY.gauge('pi_connections', 'Connected Pi websockets.')
+REGISTRY.gauge('hub_subscribers', 'Doctor clients subscribed to the stream.', fn=lambda: len(stream_hub))
+hub_dropped = REGISTRY.counter('hub_dropped_total', 'Packets skipped for clients that fell behind.',
+                               ('channel',))
+for _channel in stream_hub.limits:
+    hub_dropped.labels(_channel).set_function(lambda ch=_channel: stream_hub.dropped(ch))
+audio_undecodable = REGISTRY.counter('audio_undecodable_total',
+                                     'Pi audio chunks dropped because they failed to decode.')
+backlog_unknown = REGISTRY.counter('client_backlog_unknown_total',
+                                   "Backlog checks that failed because engine.io's private queue API was missing.")
+annotations_received = REGISTRY.counter('annotations_received_total', 'Annotation events from doctor pages.')
+annotation_batches = REGISTRY.counter('annotation_batches_total', 'Coalesced annotation broadcasts.')
+REGISTRY.gauge('annotations_stored', 'Annotations kept for late joiners.', fn=lambda: len(current_annotations))
+REGISTRY.gauge('audio_parties', 'Pis and doctor microphones in the audio mix.', fn=lambda: len(audio_mixer))
+REGISTRY.counter('audio_mix_dropped_samples_total', 'Samples dropped from parties too far ahead of the mix.',
+                 fn=lambda: audio_mixer.dropped)
 
 # HTML template for doctor interface
 HTML_TEMPLATE = '''
@@ -42,6 +86,8 @@ HTML_TEMPLATE = '''
         .tool-btn.active { background: #007bff; color: white; }
         .color-picker { width: 50px; height: 40px; margin: 5px; vertical-align: middle; }
         .clear-btn { background: #dc3545; color: white; }
+        .mic-btn { margin: 5px; padding: 10px 20px; border: none; border-radius: 4px; cursor: pointer; font-size: 16px; }
+        .mic-btn.active { background: #28a745; color: white; }
         .status { padding: 10px; margin-bottom: 20px; border-radius: 4px; }
         .status.connected { background: #28a745; }
         .status.disconnected { background: #dc3545; }
@@ -72,11 +118,12 @@ HTML_TEMPLATE = '''
             <span id="widthDisplay">3px</span>
 
             <button class="tool-btn clear-btn" onclick="clearDrawing()">🗑️ Clear All</button>
+            <button id="micBtn" class="mic-btn" onclick="toggleMic()">🎤 Talk</button>
         </div>
     </div>
 
     <script>
-        const socket = io();
+        const socket = io({ auth: { features: ['annotation_batch'] } });
         // WebAudio setup
         const AudioContext = window.AudioContext || window.webkitAudioContext;
         const audioCtx = new AudioContext();
@@ -102,9 +149,59 @@ HTML_TEMPLATE = '''
             document.getElementById('status').textContent = 'Disconnected from server';
         });
 
+        // capture->render ages, reported to the server's /metrics every 5 s
+        let renderAges = [];
+        setInterval(() => {
+            if (renderAges.length) {
+                socket.emit('latency_report', { hop: 'browser_render', ages: renderAges });
+                renderAges = [];
+            }
+        }, 5000);
+
+        // other doctors' annotations, coalesced by the server (annotation_batch.py)
+        function drawAnnotation(a) {
+            drawingCtx.strokeStyle = a.color || '#ff0000';
+            drawingCtx.lineWidth = a.lineWidth || 3;
+            switch (a.tool) {
+                case 'pen':
+                    drawingCtx.beginPath(); drawingCtx.moveTo(a.startX, a.startY); drawingCtx.lineTo(a.endX, a.endY); drawingCtx.stroke();
+                    break;
+                case 'stroke':
+                    if (!a.points || !a.points.length) break;
+                    drawingCtx.beginPath(); drawingCtx.moveTo(a.points[0].x, a.points[0].y);
+                    for (const p of a.points.slice(1)) drawingCtx.lineTo(p.x, p.y);
+                    drawingCtx.stroke();
+                    break;
+                case 'arrow':
+                    drawArrow(a.startX, a.startY, a.endX, a.endY);
+                    break;
+                case 'circle':
+                    drawingCtx.beginPath(); drawingCtx.arc(a.centerX, a.centerY, a.radius, 0, 2 * Math.PI); drawingCtx.stroke();
+                    break;
+                case 'rectangle':
+                    drawingCtx.beginPath(); drawingCtx.rect(a.startX, a.startY, a.width, a.height); drawingCtx.stroke();
+                    break;
+                case 'text':
+                    drawingCtx.font = '20px Arial'; drawingCtx.fillStyle = a.color || '#ff0000';
+                    drawingCtx.fillText(a.text, a.x, a.y);
+                    break;
+            }
+        }
+
+        socket.on('annotation_batch', (data) => {
+            for (const a of data.items || []) drawAnnotation(a);
+        });
+
+        socket.on('annotations_cleared', () => {
+            drawingCtx.clearRect(0, 0, drawingCanvas.width, drawingCanvas.height);
+        });
+
         socket.on('video_frame', (data) => {
             const img = new Image();
-            img.onload = () => { videoCtx.drawImage(img, 0, 0, 640, 480); };
+            img.onload = () => {
+                videoCtx.drawImage(img, 0, 0, 640, 480);
+                if (data.ts && renderAges.length < 500) renderAges.push(Date.now() / 1000 - data.ts);
+            };
             img.src = 'data:image/jpeg;base64,' + data.frame;
         });
 
@@ -134,6 +231,33 @@ HTML_TEMPLATE = '''
             src.start();
         }
 
+        // Microphone: int16 chunks at this AudioContext's rate; server.py resamples
+        // and mixes them with the Pis (and other doctors), minus our own voice
+        let micStream = null, micNode = null;
+        async function toggleMic() {
+            const btn = document.getElementById('micBtn');
+            if (micNode) {
+                micNode.disconnect();
+                micStream.getTracks().forEach(t => t.stop());
+                micNode = null;
+                btn.classList.remove('active');
+                socket.emit('doctor_audio_end');
+                return;
+            }
+            micStream = await navigator.mediaDevices.getUserMedia({ audio: true });
+            resumeAudio();
+            micNode = audioCtx.createScriptProcessor(4096, 1, 1);
+            micNode.onaudioprocess = (e) => {
+                const f = e.inputBuffer.getChannelData(0);
+                const pcm = new Int16Array(f.length);
+                for (let i = 0; i < f.length; i++) pcm[i] = Math.max(-1, Math.min(1, f[i])) * 32767;
+                socket.emit('doctor_audio', { chunk: pcm.buffer, rate: audioCtx.sampleRate });
+            };
+            audioCtx.createMediaStreamSource(micStream).connect(micNode);
+            micNode.connect(audioCtx.destination);  // outputs silence; processing only runs when connected
+            btn.classList.add('active');
+        }
+
         function setTool(tool) {
             currentTool = tool;
             document.querySelectorAll('.tool-btn').forEach(btn => btn.classList.remove('active'));
@@ -232,46 +356,165 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+# --- Fan-out to doctor clients ---
+def encode_event(event, data):
+    """Serialize a Socket.IO event once so every subscriber can reuse it."""
+    return sio_packet.Packet(sio_packet.EVENT, namespace='/', data=[event, data]).encode()
+
+def client_backlog(eio_sid):
+    """
+    Packets engine.io still has queued for this client. This reads engine.io
+    internals; if they change, pacing is off (0) and each failed check is
+    counted in client_backlog_unknown_total and logged.
+    """
+    try:
+        return socketio.server.eio._get_socket(eio_sid).queue.qsize()
+    except KeyError:
+        return 0  # client gone; its sender exits on unsubscribe
+    except Exception as e:
+        backlog_unknown.inc()
+        log.warning("client backlog unavailable, sending unpaced: %s", e, extra={'key': 'client_backlog'})
+        return 0
+
+def stream_sender(sid, sub):
+    """
+    Per-client sender thread: hands pre-encoded packets to engine.io, but
+    only once the client has drained its backlog, so a slow client keeps
+    just the newest frame in its hub queue instead of an ever-growing one.
+    """
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        while not sub.closed:
+            while client_backlog(eio_sid) > MAX_CLIENT_BACKLOG and not sub.closed:
+                time.sleep(0.005)
+            for channel, (encoded, capture_ts, seq, per_client) in sub.drain(timeout=1.0):
+                socketio.server.eio.send(eio_sid, per_client.get(sid, encoded) if per_client else encoded)
+                if channel == "video":
+                    latency.observe("server_emit", capture_ts, seq)
+    except Exception as e:
+        log.warning("hub sender stopped: %s", e, extra={'sid': sid})
+    finally:
+        stream_hub.unsubscribe(sid)
+
 # --- WebSocket server for Pi connection ---
+def publish_stream(video_b64, capture_ts=None, seq=None):
+    """
+    Update the latest frame for the web UI and hand one encoded packet to
+    the broadcast hub (with the frame's capture time and seq, for latency
+    tracking). Never blocks on doctor clients.
+    """
+    global current_frame
+    current_frame = video_b64
+
+    if not len(stream_hub) or current_frame is None:
+        return
+    stream_hub.publish("video", (encode_event("video_frame", {
+        "frame": current_frame,
+        "ts": capture_ts,
+        "seq": seq,
+    }), capture_ts, seq, None))
+
+def audio_event(samples):
+    return encode_event("audio_chunk", {
+        "chunk": base64.b64encode(float32_to_int16(samples)).decode("ascii"),
+        "rate": OUTPUT_RATE,
+    })
+
+def publish_audio(key, pcm, rate):
+    """
+    Mix one party's s16le chunk, ("pi", peer) or ("doctor", sid), into what
+    doctor clients hear, at OUTPUT_RATE. Encoded once for everyone; a doctor
+    who is talking gets the mix without their own voice.
+    """
+    audio_mixer.push(key, pcm, rate)
+    block = audio_mixer.mix()
+    if block is None or not len(stream_hub):
+        return
+    own = {k[1]: audio_event(block.without(k)) for k in block.parts if k[0] == "doctor"}
+    stream_hub.publish("audio", (audio_event(block.samples), None, None, own))
+
 async def pi_websocket_handler(websocket, path=None):
     """Handle incoming stream from Raspberry Pi (compatible with websockets >=10)."""
-    global current_frame, current_audio
     frame_count = 0
+    peer = getattr(websocket, "remote_address", None)
+    audio_decoders = {}  # (codec, rate) -> audio_codec decoder, per connection (opus keeps state)
+    pi_connections.inc()
     try:
-        peer = getattr(websocket, "remote_address", None)
-        print(f"Raspberry Pi connected from {peer}")
+        log.info("Raspberry Pi connected", extra={'peer': peer})
 
         async for message in websocket:
+            bytes_ingested.inc(len(message))
+            if isinstance(message, bytes):
+                # Binary framing (negotiated via hello): raw JPEG/PCM payloads
+                try:
+                    pkt = unpack_media(message)
+                except ProtocolError as e:
+                    log.warning("bad binary frame: %s", e, extra={'key': 'ws_bad_frame', 'peer': peer})
+                    continue
+                if pkt.video:
+                    latency.observe("server_ingest", pkt.capture_ts, pkt.seq)
+                    frames_ingested.inc()
+                rate = pkt.audio_rate or 16000
+                pcm = pkt.audio
+                if pcm and pkt.audio_codec != CODEC_NONE:
+                    # The page plays raw PCM: decode compressed audio once here for all clients.
+                    # A codec we can't decode costs this chunk of audio, never the connection.
+                    key = (pkt.audio_codec, rate)
+                    try:
+                        if key not in audio_decoders:
+                            audio_decoders[key] = make_decoder(pkt.audio_codec, rate)
+                        pcm = audio_decoders[key].decode(pcm)
+                    except Exception as e:
+                        audio_undecodable.inc()
+                        log.warning("dropping undecodable audio: %s", e,
+                                    extra={'key': 'ws_bad_audio', 'peer': peer, 'codec': pkt.audio_codec})
+                        pcm = None
+                if pcm:
+                    publish_audio(("pi", peer), pcm, rate)
+                if pkt.video:
+                    # Browsers still consume base64; encode once here for all clients
+                    publish_stream(base64.b64encode(pkt.video).decode("ascii"), pkt.capture_ts, pkt.seq)
+                # Lets the Pi's rate controller measure ingest latency
+                await websocket.send(ack_message(pkt.seq))
+                if pkt.video:
+                    frame_count += 1
+                    log.info("frames received", extra={'key': 'ws_frame', 'peer': peer,
+                                                       'seq': pkt.seq, 'frames': frame_count})
+                continue
+
             try:
                 data = json.loads(message)
             except Exception as e:
-                print(f"[WS] JSON parse error: {e}")
+                log.warning("JSON parse error: %s", e, extra={'key': 'ws_bad_json', 'peer': peer})
                 continue
 
-            if data.get("type") == "stream":
-                # Update latest frame/audio in memory for the web UI
-                current_frame = data.get("video")
-                current_audio = data.get("audio")
+            if data.get("type") == "hello":
+                protocol = choose_protocol(data)
+                await websocket.send(hello_reply(protocol, codecs=DECODABLE_CODECS))
+                log.info("Pi negotiated framing", extra={'peer': peer, 'protocol': protocol})
+                continue
 
-                # Debug logging every ~30 frames to avoid spam
-                if current_frame:
+            if data.get("type") == "stream":
+                # Legacy JSON framing from older Pis
+                if data.get("video"):
+                    latency.observe("server_ingest", data.get("timestamp"))
+                    frames_ingested.inc()
+                if data.get("audio"):
+                    publish_audio(("pi", peer), base64.b64decode(data["audio"]), data.get("audio_rate", 16000))
+                if data.get("video"):
+                    publish_stream(data["video"], data.get("timestamp"))
+
+                if data.get("video"):
                     frame_count += 1
-                    if frame_count % 30 == 0:
-                        print(f"[DEBUG] Received {frame_count} frames")
-
-                # Emit to clients
-                if current_audio is not None:
-                    socketio.emit("audio_chunk", {
-                        "chunk": current_audio,
-                        "rate": data.get("audio_rate", 16000),
-                    })
-                if current_frame is not None:
-                    socketio.emit("video_frame", {"frame": current_frame})
+                    log.info("frames received", extra={'key': 'ws_frame', 'peer': peer,
+                                                       'frames': frame_count})
 
     except Exception as e:
-        print(f"Pi connection error: {e}")
+        log.warning("Pi connection error: %s", e, extra={'peer': peer})
     finally:
-        print("Raspberry Pi disconnected")
+        audio_mixer.remove(("pi", peer))
+        pi_connections.dec()
+        log.info("Raspberry Pi disconnected", extra={'peer': peer, 'frames': frame_count})
 
 def start_pi_websocket():
     """Start WebSocket server for Pi in a dedicated asyncio loop inside this thread."""
@@ -285,7 +528,7 @@ def start_pi_websocket():
             ping_interval=20,
             ping_timeout=10,
         ):
-            print("[WS] Listening on ws://0.0.0.0:8765")
+            log.info("listening on ws://0.0.0.0:8765")
             # Run forever
             await asyncio.Future()
     asyncio.run(main())
@@ -297,31 +540,102 @@ def index():
 
 # SocketIO handlers
 @socketio.on('connect')
-def handle_connect():
-    print('Doctor interface connected')
+def handle_connect(auth=None):
+    log.info("doctor interface connected", extra={'sid': request.sid})
     emit('connection_status', {'status': 'connected'})
+    sub = stream_hub.subscribe(request.sid)
+    socketio.start_background_task(stream_sender, request.sid, sub)
+    features = (auth or {}).get('features', []) if isinstance(auth, dict) else []
+    if 'annotation_batch' not in features:
+        # older page: only knows new_annotation, one raw item per event
+        legacy_annotation_clients.add(request.sid)
+        join_room(LEGACY_ROOM)
+        return
+    join_room(BATCH_ROOM)
+    # late joiner: everything drawn so far, in one message
+    annotations = current_annotations.annotations()
+    if annotations:
+        emit('annotation_batch', {'items': annotations})
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    stream_hub.unsubscribe(request.sid)
+    audio_mixer.remove(("doctor", request.sid))
+    annotation_batcher.discard(request.sid)
+    current_annotations.end_strokes(request.sid)
+    legacy_annotation_clients.discard(request.sid)
+
+@socketio.on('latency_report')
+def handle_latency_report(data):
+    """Capture->render ages measured by the doctor page"""
+    for age in (data or {}).get('ages', [])[:500]:
+        latency.observe_age('browser_render', age)
+
+@socketio.on('doctor_audio')
+def handle_doctor_audio(data):
+    """Doctor microphone: s16le mono at the page's rate, mixed in for everyone else"""
+    if not isinstance(data, dict) or not isinstance(data.get('chunk'), bytes):
+        return
+    publish_audio(("doctor", request.sid), data['chunk'], int(data.get('rate') or OUTPUT_RATE))
+
+@socketio.on('doctor_audio_end')
+def handle_doctor_audio_end():
+    audio_mixer.remove(("doctor", request.sid))
+
+def broadcast_annotations(sid, items):
+    """
+    One message per sender per batch window, pen segments joined into
+    strokes. Pages that didn't ask for batches get the raw items as
+    new_annotation events, as before.
+    """
+    if legacy_annotation_clients:
+        for item in items:
+            socketio.emit('new_annotation', item, to=LEGACY_ROOM, skip_sid=sid)
+    items = compact(items)
+    current_annotations.add(sid, items)
+    annotation_batches.inc()
+    socketio.emit('annotation_batch', {'items': items}, to=BATCH_ROOM, skip_sid=sid)
+
+annotation_batcher = AnnotationBatcher(broadcast_annotations)
 
 @socketio.on('annotation')
 def handle_annotation(data):
-    """Handle drawing annotations from doctor"""
-    global current_annotations
-    current_annotations.append(data)
-    socketio.emit('new_annotation', data, include_self=False)
+    """Handle drawing annotations from doctor (queued for the next batch)"""
+    if not isinstance(data, dict):
+        return
+    annotations_received.inc()
+    annotation_batcher.add(request.sid, data)
 
 @socketio.on('clear_annotations')
 def handle_clear():
     """Clear all annotations"""
-    global current_annotations
-    current_annotations = []
-    socketio.emit('annotations_cleared')
+    def clear():
+        current_annotations.clear()
+        socketio.emit('annotations_cleared')
+
+    # drop what hasn't gone out yet too, or it would reappear after the clear;
+    # no batch is emitted between the discard and the clear
+    annotation_batcher.discard(then=clear)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text: ingest rates, hub drops/subscribers, request and frame latency"""
+    return Response(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
 
 # API endpoint for AR glasses
 @app.route('/api/annotated_stream')
 def get_annotated_stream():
-    """Get current frame with annotations for AR glasses"""
+    """
+    Get current frame with annotations for AR glasses. ?format=packed sends
+    the annotations as base64 of annotation_codec.pack() instead of JSON.
+    """
+    if request.args.get('format') == 'packed':
+        annotations = base64.b64encode(current_annotations.packed()).decode('ascii')
+    else:
+        annotations = current_annotations.annotations()
     return {
         'frame': current_frame,
-        'annotations': current_annotations,
+        'annotations': annotations,
         'timestamp': time.time()
     }
 
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Shared logging for the services: queue-backed, rate-limited, structured.
+
+Callers only build a LogRecord and put it on an in-memory queue; a
+QueueListener thread formats it and writes stderr. So a request or ingest
+thread never blocks on a flushed console write (which is what the old
+per-frame print(".", flush=True) heartbeats did).
+
+Rate limiting is per message key: the `key` extra if given, else the
+logger plus the unformatted message. Up to RATE_BURST records per key get
+through every RATE_INTERVAL_S; the rest are counted, and the next one let
+through says how many were suppressed. That turns a per-frame log line
+into a periodic heartbeat with a count.
+
+Any other `extra` fields are appended as key=value:
+
+    log = get_logger("mac")
+    log.info("frame received", extra={"session": sid, "seq": 42, "key": "frame"})
+    -> 12:00:01.234 INFO mac: frame received session=abc seq=42 (+29 suppressed)
+
+Run this file directly for a comparison against print(flush=True).
+"""
+
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+# === CONFIG ===
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+RATE_INTERVAL_S = 5.0
+RATE_BURST = 1
+QUEUE_SIZE = 10_000  # records waiting for the writer; beyond this they're dropped
+# ==============
+
+ROOT = "telemed"
+# attributes every LogRecord has; anything else came in via extra=
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "key"}
+
+
+class RateLimitFilter(logging.Filter):
+    """Let RATE_BURST records per key through per interval; count the rest."""
+
+    def __init__(self, interval=RATE_INTERVAL_S, burst=RATE_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}  # key -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR and not hasattr(record, "key"):
+            key = (record.name, record.msg, record.levelno)
+        else:
+            key = getattr(record, "key", None) or (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        record.suppressed = suppressed
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s.%(msecs)03d %(levelname)s %(shortname)s: %(message)s", "%H:%M:%S")
+
+    def format(self, record):
+        record.shortname = record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name
+        line = super().format(record)
+        fields = " ".join(f"{k}={v}" for k, v in vars(record).items()
+                          if k not in _STANDARD and k not in ("suppressed", "shortname"))
+        if fields:
+            line += " " + fields
+        if getattr(record, "suppressed", 0):
+            line += f" (+{record.suppressed} suppressed)"
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread, not here. Records are
+        # only shared in-process, so there's no need to pickle-proof them.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_lock = threading.Lock()
+
+
+def setup(level=LOG_LEVEL, stream=None):
+    """Install the queue handler and writer thread (idempotent)."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        q = queue.Queue(QUEUE_SIZE)
+        out = logging.StreamHandler(stream or sys.stderr)
+        out.setFormatter(StructuredFormatter())
+        _listener = logging.handlers.QueueListener(q, out)
+        _listener.start()
+
+        handler = _QueueHandler(q)
+        handler.addFilter(RateLimitFilter())
+        root = logging.getLogger(ROOT)
+        root.addHandler(handler)
+        root.setLevel(level)
+        root.propagate = False
+
+
+def shutdown():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name):
+    """Logger `telemed.<name>` with the shared handler installed."""
+    setup()
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def _slow_pipe():
+    """Write end of a pipe drained slowly, like a terminal that can't keep up."""
+    r, w = os.pipe()
+
+    def drain():
+        while os.read(r, 4096):
+            time.sleep(0.002)
+
+    threading.Thread(target=drain, daemon=True).start()
+    return os.fdopen(w, "w")
+
+
+def _bench(n=5000):
+    line = "frame received session=bench seq=%d " + "x" * 100
+
+    def timed(fn):
+        worst = 0.0
+        t0 = time.perf_counter()
+        for i in range(n):
+            t = time.perf_counter()
+            fn(i)
+            worst = max(worst, time.perf_counter() - t)
+        return (time.perf_counter() - t0) / n * 1e6, worst * 1e3
+
+    out = _slow_pipe()
+    printed = timed(lambda i: print(line % i, flush=True, file=out))
+
+    setup(stream=_slow_pipe())
+    log = get_logger("bench")
+    limited = timed(lambda i: log.info("frame received", extra={"session": "bench", "seq": i, "key": "frame"}))
+    queued = timed(lambda i: log.info(line, i, extra={"key": i}))
+    shutdown()
+    print(f"{n} lines to a slowly drained pipe, caller-side cost:")
+    for label, (mean, worst) in (("print(flush=True)", printed), ("rate-limited heartbeat", limited),
+                                 ("every line queued", queued)):
+        print(f"  {label:>22}: {mean:7.1f} us mean, {worst:6.2f} ms worst")
+
+
+if __name__ == "__main__":
+    log = get_logger("demo")
+    for seq in range(100):
+        log.info("frame received", extra={"session": "abc123", "seq": seq, "key": "frame"})
+        time.sleep(0.1)
+    log.warning("upload ended", extra={"session": "abc123", "frames": 100})
+    shutdown()
+    _bench()
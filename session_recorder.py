@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Append-only on-disk recording of a session, seekable by time.
+
+Layout, one directory per session under RECORDINGS_DIR:
+
+    <session_id>/seg_00000.rec   back-to-back stream_protocol media messages
+    <session_id>/seg_00001.rec   (next segment once SEGMENT_MAX_BYTES is hit)
+    <session_id>/index           sparse time index: (capture_ts, segment, offset)
+
+Records reuse the binary framing from stream_protocol.py (header with
+capture timestamp + raw JPEG + raw audio), so a segment can be read with
+read_media() or fed straight back into /frame_stream. An index entry is
+written at most every INDEX_INTERVAL_S, so seeking is a bisect over the
+index plus a short forward scan.
+
+Ingest only appends to a bounded queue; a background thread does all the
+file I/O. If the disk falls behind, records are dropped (and counted)
+rather than blocking the Pi upload or growing memory.
+
+Run this file directly for a write/seek self-test and throughput numbers.
+"""
+
+import bisect
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from stream_protocol import ProtocolError, pack_media, read_media
+
+# === CONFIG ===
+RECORDINGS_DIR = os.environ.get("RECORDINGS_DIR", "recordings")
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+INDEX_INTERVAL_S = 1.0
+MAX_PENDING = 256  # queued records (~8 s of video at 30 fps)
+# ==============
+
+INDEX_ENTRY = struct.Struct("!dIQ")
+_SAFE_ID = re.compile(r"^[\w.-]+$")
+
+
+def recording_dir(session_id, root=RECORDINGS_DIR):
+    """Directory for a session's recording; rejects ids that aren't plain names."""
+    if not _SAFE_ID.match(session_id) or session_id.startswith("."):
+        raise ValueError(f"bad session id {session_id!r}")
+    return os.path.join(root, session_id)
+
+
+def _segment_path(directory, n):
+    return os.path.join(directory, f"seg_{n:05d}.rec")
+
+
+class SessionRecorder:
+    def __init__(self, session_id, root=RECORDINGS_DIR, segment_max_bytes=SEGMENT_MAX_BYTES,
+                 index_interval=INDEX_INTERVAL_S, max_pending=MAX_PENDING):
+        self.dir = recording_dir(session_id, root)
+        os.makedirs(self.dir, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        self.index_interval = index_interval
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.written = 0
+        self.dropped = 0
+        self.seq = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def record(self, capture_ts, video=None, audio=None, audio_rate=0, audio_seq=None, audio_ts=None,
+               audio_codec=0):
+        """Queue one record. Never blocks; returns False if it had to be dropped."""
+        if self.closed:
+            return False
+        self.seq += 1
+        try:
+            self.pending.put_nowait((self.seq, capture_ts, video, audio, audio_rate,
+                                     audio_seq, audio_ts, audio_codec))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                print(f"[record] Disk behind, dropped {self.dropped} records")
+            return False
+
+    def close(self, timeout=5.0):
+        """Flush what is queued and stop the writer thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join(timeout)
+
+    def _writer(self):
+        segment_no = 0
+        while os.path.exists(_segment_path(self.dir, segment_no + 1)):
+            segment_no += 1
+        seg = open(_segment_path(self.dir, segment_no), "ab")
+        index = open(os.path.join(self.dir, "index"), "ab")
+        last_indexed = None
+        try:
+            while True:
+                item = self.pending.get()
+                batch = [item]
+                # drain whatever else is waiting, then flush once
+                while item is not None:
+                    try:
+                        item = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+
+                for rec in batch:
+                    if rec is None:
+                        continue
+                    seq, ts, video, audio, rate, audio_seq, audio_ts, codec = rec
+                    if seg.tell() >= self.segment_max_bytes:
+                        seg.close()
+                        segment_no += 1
+                        seg = open(_segment_path(self.dir, segment_no), "ab")
+                        last_indexed = None  # every segment starts with an index entry
+                    if video and (last_indexed is None or ts - last_indexed >= self.index_interval):
+                        index.write(INDEX_ENTRY.pack(ts, segment_no, seg.tell()))
+                        last_indexed = ts
+                    seg.write(pack_media(seq, ts, video, audio, rate,
+                                         audio_seq=audio_seq, audio_ts=audio_ts, audio_codec=codec))
+                    self.written += 1
+                # data before index, so the index never points past the data
+                seg.flush()
+                index.flush()
+                if batch[-1] is None:
+                    return
+        except OSError as e:
+            print(f"[record] Recording stopped: {e}")
+            self.closed = True
+        finally:
+            seg.close()
+            index.close()
+
+
+class RecordingReader:
+    """Seekable view of a recording directory (may still be being written)."""
+
+    def __init__(self, session_id, root=RECORDINGS_DIR):
+        self.dir = recording_dir(session_id, root)
+        if not os.path.isdir(self.dir):
+            raise FileNotFoundError(self.dir)
+        self.load_index()
+
+    def load_index(self):
+        with open(os.path.join(self.dir, "index"), "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        entries = [INDEX_ENTRY.unpack_from(data, off) for off in range(0, usable, INDEX_ENTRY.size)]
+        self.times = [e[0] for e in entries]
+        self.positions = [(e[1], e[2]) for e in entries]
+
+    @property
+    def start_ts(self):
+        return self.times[0] if self.times else None
+
+    @property
+    def end_ts(self):
+        return self.times[-1] if self.times else None
+
+    def seek(self, ts):
+        """(segment, offset) of the last index entry at or before ts: O(log n)."""
+        if not self.times:
+            return None
+        i = bisect.bisect_right(self.times, ts) - 1
+        return self.positions[max(i, 0)]
+
+    def packets(self, ts=None):
+        """Yield stream_protocol Packets from time ts (absolute) to the end."""
+        pos = self.seek(ts if ts is not None else float("-inf"))
+        if pos is None:
+            return
+        segment_no, offset = pos
+        while os.path.exists(_segment_path(self.dir, segment_no)):
+            with open(_segment_path(self.dir, segment_no), "rb") as f:
+                f.seek(offset)
+                while True:
+                    try:
+                        pkt = read_media(f)
+                    except ProtocolError:
+                        return  # tail of a recording still being written
+                    if pkt is None:
+                        break
+                    if ts is None or pkt.capture_ts >= ts:
+                        yield pkt
+            segment_no += 1
+            offset = 0
+
+
+def _self_test(frames=3000, fps=30):
+    import shutil
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    try:
+        rec = SessionRecorder("selftest", root=root, segment_max_bytes=8 * 1024 * 1024)
+        jpeg = os.urandom(20_000)
+        t0 = 1_700_000_000.0
+        start = time.perf_counter()
+        queued = 0.0
+        for i in range(frames):
+            # a real source is paced by the camera; don't outrun the writer
+            while rec.pending.qsize() > MAX_PENDING // 2:
+                time.sleep(0.001)
+            t = time.perf_counter()
+            rec.record(t0 + i / fps, jpeg, b"\0" * 1024 if i % 3 == 0 else None, 48000)
+            queued += time.perf_counter() - t
+        rec.close(timeout=60)
+        elapsed = time.perf_counter() - start
+        print(f"record(): {queued / frames * 1e6:.1f} us/frame on the ingest thread")
+        print(f"writer: {rec.written} records in {elapsed:.2f}s "
+              f"({rec.written / elapsed:.0f}/s), {rec.dropped} dropped "
+              f"({len(os.listdir(rec.dir)) - 1} segments)")
+
+        reader = RecordingReader("selftest", root=root)
+        print(f"index: {len(reader.times)} entries for {frames / fps:.0f}s")
+        for t in (0.0, 12.34, 60.0, frames / fps - 0.5):
+            start = time.perf_counter()
+            first = next(reader.packets(t0 + t))
+            us = (time.perf_counter() - start) * 1e6
+            assert t0 + t <= first.capture_ts < t0 + t + 1 / fps + 1e-6, (t, first.capture_ts - t0)
+            print(f"  seek t={t:7.2f}s -> frame at {first.capture_ts - t0:7.3f}s in {us:.0f} us")
+        total = sum(1 for _ in reader.packets())
+        assert total == rec.written, (total, rec.written)
+        print(f"full scan: {total} records OK")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    _self_test()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Binary WebSocket framing between pi_streamer.py and server.py.
+
+Every media message is one WebSocket *binary* message:
+
+    32-byte header | JPEG bytes (video_len) | PCM bytes (audio_len)
+
+Header (network byte order):
+    magic      2s   b"AR"
+    version    B    PROTOCOL_VERSION
+    msg_type   B    MSG_MEDIA
+    flags      B    FLAG_AUDIO_META | audio codec id << AUDIO_CODEC_SHIFT
+    (pad)      3x
+    seq        I    per-connection frame counter
+    capture_ts d    time.time() when the frame was captured
+    audio_rate I    Hz of the PCM payload (0 if no audio)
+    video_len  I
+    audio_len  I
+
+With FLAG_AUDIO_META set, the audio payload starts with AUDIO_META
+(audio_seq I, audio_ts d): the chunk's own sequence number and capture
+time, which jitter_buffer.py keys on. Parsers strip it off and return it
+as Packet.audio_seq / Packet.audio_ts (None without the flag).
+
+Bits 1-3 of flags give the audio codec (audio_codec.py ids; 0 is the
+uncompressed audio senders used before codecs), returned as
+Packet.audio_codec.
+
+Negotiation rides on the existing JSON text messages so old peers keep
+working: the Pi sends {"type": "hello", "protocols": [...]} and waits briefly
+for {"type": "hello", "protocol": ...}. An old server ignores the hello, the
+Pi times out and falls back to the legacy {"type": "stream"} JSON messages.
+The server's hello also lists the audio "codecs" it can decode (names from
+audio_codec.py); a Pi sends nothing else, and raw PCM (codec 0) to a server
+whose hello has no list.
+On binary connections the server acknowledges each media message with
+{"type": "ack", "seq": n} so the Pi's rate controller can measure latency.
+
+The same messages are self-delimiting (the header carries both payload
+lengths), so pi.py also sends them back-to-back in one chunked HTTP body to
+mac.py's /frame_stream; read_media() parses that byte stream.
+
+Run this file directly for a bytes/frame + CPU/frame benchmark of both
+encodings.
+"""
+
+import asyncio
+import base64
+import json
+import struct
+import time
+from collections import namedtuple
+
+PROTOCOL_VERSION = 1
+PROTO_BINARY = "bin1"
+PROTO_JSON = "json"
+
+MAGIC = b"AR"
+MSG_MEDIA = 1
+
+FLAG_AUDIO_META = 0x01
+AUDIO_CODEC_SHIFT = 1
+AUDIO_CODEC_MASK = 0x07 << AUDIO_CODEC_SHIFT
+
+HEADER = struct.Struct("!2sBBB3xIdIII")
+HEADER_SIZE = HEADER.size
+AUDIO_META = struct.Struct("!Id")
+
+Packet = namedtuple("Packet", "msg_type flags seq capture_ts audio_rate video audio audio_seq audio_ts audio_codec",
+                    defaults=(None, None, 0))
+
+
+class ProtocolError(ValueError):
+    """Raised when a binary message can't be parsed."""
+
+
+def pack_media(seq, capture_ts, video=None, audio=None, audio_rate=0, flags=0, audio_seq=None, audio_ts=None,
+               audio_codec=0):
+    """Build one binary media message from raw JPEG / PCM (or audio_codec) bytes."""
+    video = video or b""
+    audio = audio or b""
+    meta = b""
+    if audio:
+        flags |= (audio_codec << AUDIO_CODEC_SHIFT) & AUDIO_CODEC_MASK
+    if audio and audio_seq is not None:
+        flags |= FLAG_AUDIO_META
+        meta = AUDIO_META.pack(audio_seq & 0xFFFFFFFF, audio_ts if audio_ts is not None else capture_ts)
+    header = HEADER.pack(
+        MAGIC, PROTOCOL_VERSION, MSG_MEDIA, flags,
+        seq & 0xFFFFFFFF, capture_ts, audio_rate if audio else 0,
+        len(video), len(meta) + len(audio),
+    )
+    return b"".join((header, video, meta, audio))
+
+
+def _parse_header(buf):
+    if len(buf) < HEADER_SIZE:
+        raise ProtocolError(f"short message ({len(buf)} bytes)")
+    magic, version, msg_type, flags, seq, ts, rate, vlen, alen = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ProtocolError("bad magic")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported version {version}")
+    return msg_type, flags, seq, ts, rate, vlen, alen
+
+
+def _packet(msg_type, flags, seq, ts, rate, video, audio):
+    codec = (flags & AUDIO_CODEC_MASK) >> AUDIO_CODEC_SHIFT
+    if flags & FLAG_AUDIO_META and len(audio) >= AUDIO_META.size:
+        audio_seq, audio_ts = AUDIO_META.unpack_from(audio)
+        return Packet(msg_type, flags, seq, ts, rate, video, audio[AUDIO_META.size:], audio_seq, audio_ts, codec)
+    return Packet(msg_type, flags, seq, ts, rate, video, audio, None, None, codec)
+
+
+def unpack_media(message):
+    """
+    Parse a binary media message. The returned video/audio fields are
+    memoryviews into `message` (empty views when absent) — no copies.
+    """
+    msg_type, flags, seq, ts, rate, vlen, alen = _parse_header(message)
+    if HEADER_SIZE + vlen + alen > len(message):
+        raise ProtocolError("truncated payload")
+    view = memoryview(message)
+    video = view[HEADER_SIZE:HEADER_SIZE + vlen]
+    audio = view[HEADER_SIZE + vlen:HEADER_SIZE + vlen + alen]
+    return _packet(msg_type, flags, seq, ts, rate, video, audio)
+
+
+def iter_media(buf):
+    """
+    Yield Packets from back-to-back media messages in a buffer (bytes, mmap,
+    ...). Fields are memoryviews into buf. Stops quietly at a truncated tail.
+    """
+    view = memoryview(buf)
+    off = 0
+    while off + HEADER_SIZE <= len(view):
+        msg_type, flags, seq, ts, rate, vlen, alen = _parse_header(view[off:off + HEADER_SIZE])
+        body = off + HEADER_SIZE
+        end = body + vlen + alen
+        if end > len(view):
+            return
+        yield _packet(msg_type, flags, seq, ts, rate, view[body:body + vlen], view[body + vlen:end])
+        off = end
+
+
+def _read_exact(stream, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        chunk = stream.read(n - got)
+        if not chunk:
+            return None
+        view[got:got + len(chunk)] = chunk
+        got += len(chunk)
+    return buf
+
+
+def read_media(stream, max_payload=16 * 1024 * 1024):
+    """
+    Read the next media message from a blocking byte stream (file-like with
+    read()). Returns a Packet, or None at a clean end of stream.
+    """
+    header = _read_exact(stream, HEADER_SIZE)
+    if header is None:
+        return None
+    msg_type, flags, seq, ts, rate, vlen, alen = _parse_header(header)
+    if vlen + alen > max_payload:
+        raise ProtocolError(f"payload too large ({vlen + alen} bytes)")
+    payload = _read_exact(stream, vlen + alen) if vlen + alen else bytearray()
+    if payload is None:
+        raise ProtocolError("stream ended mid-message")
+    view = memoryview(payload)
+    return _packet(msg_type, flags, seq, ts, rate, view[:vlen], view[vlen:])
+
+
+async def read_media_async(reader, max_payload=16 * 1024 * 1024):
+    """read_media() for asyncio/aiohttp stream readers with readexactly()."""
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("stream ended mid-header")
+    msg_type, flags, seq, ts, rate, vlen, alen = _parse_header(header)
+    if vlen + alen > max_payload:
+        raise ProtocolError(f"payload too large ({vlen + alen} bytes)")
+    try:
+        payload = await reader.readexactly(vlen + alen) if vlen + alen else b""
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("stream ended mid-message")
+    view = memoryview(payload)
+    return _packet(msg_type, flags, seq, ts, rate, view[:vlen], view[vlen:])
+
+
+def hello_message(protocols=(PROTO_BINARY, PROTO_JSON)):
+    """Client hello listing the framings we can speak, most preferred first."""
+    return json.dumps({"type": "hello", "version": PROTOCOL_VERSION, "protocols": list(protocols)})
+
+
+def choose_protocol(hello, supported=(PROTO_BINARY, PROTO_JSON)):
+    """Server side: pick the first protocol from the client's list we support."""
+    for proto in hello.get("protocols", []):
+        if proto in supported:
+            return proto
+    return PROTO_JSON
+
+
+def hello_reply(protocol, codecs=None):
+    """Server hello: the chosen framing and, if given, the audio codec names it decodes."""
+    reply = {"type": "hello", "version": PROTOCOL_VERSION, "protocol": protocol}
+    if codecs is not None:
+        reply["codecs"] = list(codecs)
+    return json.dumps(reply)
+
+
+def ack_message(seq):
+    return json.dumps({"type": "ack", "seq": seq})
+
+
+def legacy_json_message(video, audio, audio_rate, capture_ts):
+    """The pre-binary {"type": "stream"} text message, built from raw bytes."""
+    return json.dumps({
+        "type": "stream",
+        "video": base64.b64encode(video).decode("ascii") if video else None,
+        "audio": base64.b64encode(audio).decode("ascii") if audio else None,
+        "audio_rate": audio_rate,
+        "timestamp": capture_ts,
+    })
+
+
+def _bench(frames=500, jpeg_size=40_000, pcm_size=2048):
+    """Compare legacy JSON+base64 against binary framing on synthetic payloads."""
+    import os
+
+    video = os.urandom(jpeg_size)
+    audio = os.urandom(pcm_size)
+
+    def run(fn):
+        start = time.process_time()
+        out = None
+        for _ in range(frames):
+            out = fn()
+        return (time.process_time() - start) / frames * 1e6, out
+
+    # Pi side: build the message from raw capture bytes
+    json_tx_us, json_msg = run(lambda: legacy_json_message(video, audio, 16000, time.time()))
+    bin_tx_us, bin_msg = run(lambda: pack_media(1, time.time(), video, audio, 16000))
+
+    # Server side: parse and produce the base64 string the browser still needs
+    def json_rx():
+        data = json.loads(json_msg)
+        return data["video"]
+
+    def bin_rx():
+        pkt = unpack_media(bin_msg)
+        return base64.b64encode(pkt.video).decode("ascii")
+
+    json_rx_us, _ = run(json_rx)
+    bin_rx_us, _ = run(bin_rx)
+
+    print(f"payload: jpeg={jpeg_size} B, pcm={pcm_size} B, {frames} frames")
+    print(f"{'':8}{'bytes/frame':>14}{'pi us/frame':>14}{'server us/frame':>18}")
+    print(f"{'json':8}{len(json_msg.encode()):>14}{json_tx_us:>14.1f}{json_rx_us:>18.1f}")
+    print(f"{'binary':8}{len(bin_msg):>14}{bin_tx_us:>14.1f}{bin_rx_us:>18.1f}")
+
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Synthetic Pi: replay recorded media into server.py or mac.py without a camera.
+
+Sources (memory-mapped, so M simulated Pis share one copy of the data):
+  * a recording made by session_recorder.py (a session directory or a single
+    seg_*.rec file of stream_protocol records), or
+  * a directory of JPEG files, optionally with --pcm FILE (raw s16le mono at
+    --audio-rate), sliced into one audio chunk per frame.
+
+Protocols:
+  ws           server.py's WebSocket, as VideoAudioStreamer.stream_data sends it
+               (hello negotiation, binary framing with acks, JSON fallback)
+  http         pi.py's per-frame JSON POST to /frame
+  http-stream  pi.py's long-lived chunked POST to /frame_stream
+
+    python3 synthetic_pi.py recordings/20250101_120000 --url ws://localhost:8765 --pis 20
+    python3 synthetic_pi.py frames/ --pcm mic.raw --url http://localhost:5000 \\
+        --protocol http-stream --pis 50 --speed 2 --duration 60
+
+Each simulated Pi runs as an asyncio task in this one process; per-Pi
+frame counts, send latency (and ack RTT on ws) are summarised at the end.
+"""
+
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import mmap
+import os
+import time
+
+from audio_codec import CODEC_NONE, CODEC_PCM
+from stream_protocol import (
+    PROTO_BINARY, PROTO_JSON, ProtocolError, hello_message, iter_media,
+    legacy_json_message, pack_media,
+)
+
+DEFAULT_FPS = 30
+DEFAULT_AUDIO_RATE = 16000
+HELLO_TIMEOUT_S = 1.0
+
+
+# ---------------------------------------------------------------------------
+# Sources: lists of (offset_s, video, audio) over memory-mapped files
+# ---------------------------------------------------------------------------
+
+def _mmap_file(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RecordingSource:
+    """stream_protocol records from session_recorder segments; zero-copy views."""
+
+    audio_format = "as-recorded"
+
+    def __init__(self, path):
+        files = sorted(glob.glob(os.path.join(path, "seg_*.rec"))) if os.path.isdir(path) else [path]
+        if not files:
+            raise FileNotFoundError(f"no seg_*.rec in {path}")
+        self.maps = [_mmap_file(f) for f in files if os.path.getsize(f)]
+        self.items = []
+        self.audio_rate = 0
+        first_ts = None
+        for mm in self.maps:
+            try:
+                for pkt in iter_media(mm):
+                    first_ts = pkt.capture_ts if first_ts is None else first_ts
+                    self.audio_rate = self.audio_rate or pkt.audio_rate
+                    self.items.append((pkt.capture_ts - first_ts, pkt.video or None, pkt.audio or None))
+            except ProtocolError as e:
+                print(f"[source] {e}; using the records before it")
+
+
+class JpegDirSource:
+    """*.jpg files played at --fps, plus an optional raw PCM file."""
+
+    audio_format = "pcm"
+
+    def __init__(self, path, fps=DEFAULT_FPS, pcm=None, audio_rate=DEFAULT_AUDIO_RATE):
+        files = sorted(glob.glob(os.path.join(path, "*.jpg")) + glob.glob(os.path.join(path, "*.jpeg")))
+        if not files:
+            raise FileNotFoundError(f"no JPEGs in {path}")
+        self.maps = [_mmap_file(f) for f in files]
+        self.audio_rate = audio_rate if pcm else 0
+        audio = memoryview(_mmap_file(pcm)) if pcm else None
+        per_frame = int(audio_rate / fps) * 2  # s16 mono bytes per frame interval
+        self.items = []
+        for i, mm in enumerate(self.maps):
+            chunk = None
+            if audio is not None and per_frame:
+                start = (i * per_frame) % max(len(audio) - per_frame, 1)
+                chunk = audio[start:start + per_frame]
+            self.items.append((i / fps, memoryview(mm), chunk))
+
+
+def open_source(args):
+    if os.path.isdir(args.source) and not glob.glob(os.path.join(args.source, "seg_*.rec")):
+        return JpegDirSource(args.source, args.fps, args.pcm, args.audio_rate)
+    return RecordingSource(args.source)
+
+
+# ---------------------------------------------------------------------------
+# Simulated Pis
+# ---------------------------------------------------------------------------
+
+class PiStats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self.send_latency = []
+        self.ack_rtt = []
+
+
+def schedule(source, speed, loop_forever, stop_at):
+    """Yield (due_monotonic, seq, item) at the recording's pace / speed."""
+    start = time.monotonic()
+    seq = 0
+    period = source.items[-1][0] + 1 / DEFAULT_FPS if source.items else 0
+    rounds = 0
+    while True:
+        for item in source.items:
+            due = start + (rounds * period + item[0]) / speed if speed > 0 else time.monotonic()
+            if due > stop_at:
+                return
+            yield due, seq, item
+            seq += 1
+        rounds += 1
+        if not loop_forever:
+            return
+
+
+async def _pace(due):
+    delay = due - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def run_ws_pi(n, url, source, args, stats, stop_at):
+    import websockets
+
+    async with websockets.connect(url, max_size=4 * 1024 * 1024, ping_interval=20, ping_timeout=10) as ws:
+        protocol = PROTO_JSON
+        try:
+            await ws.send(hello_message())
+            reply = json.loads(await asyncio.wait_for(ws.recv(), timeout=HELLO_TIMEOUT_S))
+            if reply.get("type") == "hello" and reply.get("protocol") == PROTO_BINARY:
+                protocol = PROTO_BINARY
+        except asyncio.TimeoutError:
+            pass
+        sent_at = {}
+
+        async def read_acks():
+            async for reply in ws:
+                if isinstance(reply, str):
+                    data = json.loads(reply)
+                    t = sent_at.pop(data.get("seq"), None)
+                    if data.get("type") == "ack" and t is not None:
+                        stats.ack_rtt.append(time.monotonic() - t)
+
+        acks = asyncio.ensure_future(read_acks()) if protocol == PROTO_BINARY else None
+        rate = source.audio_rate or DEFAULT_AUDIO_RATE
+        try:
+            for due, seq, (offset, video, audio) in schedule(source, args.speed, args.loop, stop_at):
+                await _pace(due)
+                ts = time.time()
+                if protocol == PROTO_BINARY:
+                    message = pack_media(seq, ts, video, audio, rate)
+                else:
+                    message = legacy_json_message(video, audio, rate, ts)
+                t0 = time.monotonic()
+                sent_at[seq & 0xFFFFFFFF] = t0
+                await ws.send(message)
+                stats.send_latency.append(time.monotonic() - t0)
+                stats.frames += 1
+                stats.bytes += len(message)
+                if len(sent_at) > 1000:
+                    sent_at.clear()
+        finally:
+            if acks is not None:
+                acks.cancel()
+
+
+async def run_http_pi(n, url, source, args, stats, stop_at, http):
+    params = {"session_id": f"{args.session_prefix}{n}"} if args.session_prefix else None
+    rate = source.audio_rate or DEFAULT_AUDIO_RATE
+    # pi.py: bare samples, the stream parameters alongside (recordings go as recorded)
+    fmt = {"codec": CODEC_PCM, "rate": rate, "channels": 1} if source.audio_format == "pcm" else None
+    for due, seq, (offset, video, audio) in schedule(source, args.speed, args.loop, stop_at):
+        await _pace(due)
+        body = {
+            "img": base64.b64encode(video).decode() if video is not None else None,
+            "audio": base64.b64encode(audio).decode() if audio is not None else None,
+        }
+        if fmt and audio is not None:
+            body["audio_format"] = fmt
+        t0 = time.monotonic()
+        try:
+            async with http.post(f"{url}/frame", json=body, params=params) as r:
+                await r.read()
+                if r.status != 200:
+                    stats.errors += 1
+                    continue
+        except Exception:
+            stats.errors += 1
+            continue
+        stats.send_latency.append(time.monotonic() - t0)
+        stats.frames += 1
+        stats.bytes += len(body["img"] or "") + len(body["audio"] or "")
+
+
+async def run_http_stream_pi(n, url, source, args, stats, stop_at, http):
+    params = {"session_id": f"{args.session_prefix}{n}"} if args.session_prefix else None
+    rate = source.audio_rate or DEFAULT_AUDIO_RATE
+    codec = CODEC_PCM if source.audio_format == "pcm" else CODEC_NONE
+
+    async def body():
+        for due, seq, (offset, video, audio) in schedule(source, args.speed, args.loop, stop_at):
+            await _pace(due)
+            t0 = time.monotonic()
+            message = pack_media(seq, time.time(), video, audio, rate, audio_codec=codec)
+            yield message
+            # time until the transport took the chunk
+            stats.send_latency.append(time.monotonic() - t0)
+            stats.frames += 1
+            stats.bytes += len(message)
+
+    async with http.post(f"{url}/frame_stream", data=body(), params=params,
+                         headers={"Content-Type": "application/octet-stream"}) as r:
+        await r.read()
+        if r.status != 200:
+            stats.errors += 1
+
+
+async def simulate(args):
+    source = open_source(args)
+    print(f"source: {len(source.items)} items from {args.source} "
+          f"({type(source).__name__}, audio {source.audio_rate or 'none'} Hz)")
+    stop_at = time.monotonic() + args.duration if args.duration else float("inf")
+    stats = [PiStats() for _ in range(args.pis)]
+    url = args.url.rstrip("/")
+
+    http = None
+    if args.protocol != "ws":
+        import aiohttp
+        http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0),
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_connect=5))
+
+    async def one(n):
+        # stagger so M Pis don't send in lock-step
+        await asyncio.sleep(n * args.stagger)
+        try:
+            if args.protocol == "ws":
+                await run_ws_pi(n, url, source, args, stats[n], stop_at)
+            elif args.protocol == "http":
+                await run_http_pi(n, url, source, args, stats[n], stop_at, http)
+            else:
+                await run_http_stream_pi(n, url, source, args, stats[n], stop_at, http)
+        except Exception as e:
+            stats[n].errors += 1
+            print(f"[pi {n}] stopped: {e!r}")
+
+    t0 = time.monotonic()
+    try:
+        await asyncio.gather(*(one(n) for n in range(args.pis)))
+    finally:
+        if http is not None:
+            await http.close()
+    report(stats, time.monotonic() - t0, args.protocol)
+
+
+def _pct(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+
+def report(stats, elapsed, protocol):
+    frames = sum(s.frames for s in stats)
+    latency = [x for s in stats for x in s.send_latency]
+    rtt = [x for s in stats for x in s.ack_rtt]
+    print(f"\n{len(stats)} Pis over {protocol}, {elapsed:.1f}s")
+    print(f"  frames: {frames} ({frames / elapsed:.0f}/s total, {frames / elapsed / len(stats):.1f}/s per Pi)")
+    print(f"  upload: {sum(s.bytes for s in stats) / elapsed / 1e6:.2f} MB/s")
+    print(f"  send latency p50/p99: {_pct(latency, 0.5):.1f} / {_pct(latency, 0.99):.1f} ms")
+    if rtt:
+        print(f"  ack RTT p50/p99: {_pct(rtt, 0.5):.1f} / {_pct(rtt, 0.99):.1f} ms")
+    print(f"  errors: {sum(s.errors for s in stats)}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded media as M simulated Pis.")
+    ap.add_argument("source", help="recording dir / seg_*.rec file, or a directory of JPEGs")
+    ap.add_argument("--url", default="ws://localhost:8765",
+                    help="ws://host:8765 (server.py) or http://host:5000 (mac.py)")
+    ap.add_argument("--protocol", choices=("ws", "http", "http-stream"),
+                    help="default: ws for ws:// URLs, http-stream otherwise")
+    ap.add_argument("--pis", type=int, default=1, help="simulated Pis")
+    ap.add_argument("--speed", type=float, default=1.0, help="pace multiplier (0 = as fast as possible)")
+    ap.add_argument("--duration", type=float, default=0, help="stop after N seconds (0 = no limit)")
+    ap.add_argument("--loop", action="store_true", help="repeat the source until --duration")
+    ap.add_argument("--stagger", type=float, default=0.01, help="start offset between Pis (s)")
+    ap.add_argument("--session-prefix", default="synthetic-",
+                    help="mac.py: Pi n uploads to ?session_id=<prefix><n> ('' = current session)")
+    ap.add_argument("--fps", type=float, default=DEFAULT_FPS, help="JPEG directory frame rate")
+    ap.add_argument("--pcm", help="raw s16le mono PCM to pair with a JPEG directory")
+    ap.add_argument("--audio-rate", type=int, default=DEFAULT_AUDIO_RATE)
+    args = ap.parse_args()
+    if args.protocol is None:
+        args.protocol = "ws" if args.url.startswith("ws") else "http-stream"
+    asyncio.run(simulate(args))
+
+
+if __name__ == "__main__":
+    main()